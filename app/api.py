@@ -1,15 +1,94 @@
-"""Minimal ASGI application exposing the adaptive English level test API and UI."""
+"""Minimal ASGI application exposing the adaptive English level test API and UI.
+
+Requests that :func:`~app.http_router.blocking` reports as pure CPU work on
+in-memory sessions are dispatched on the event loop. Everything that may
+wait on disk or on another request (static files, finishing a test, evicted
+or busy sessions, synchronous durability modes) runs on a thread pool of
+``workers`` threads, so one slow SQLite commit does not stall every
+connection served by the loop. Request bodies are received straight into a
+single buffer, sized from ``Content-Length`` when the client sends it, and
+each route's latency is recorded in :class:`RouteTimings`.
+
+Audio responses are handed to the server with the ``zerocopysend`` extension
+when it offers one, and are otherwise streamed in chunks read on the pool.
+"""
 from __future__ import annotations
 
-from typing import Iterable, Tuple
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, Optional, Tuple
 
-from .http_router import dispatch
+from .http_router import blocking, dispatch, dispatch_inline, route_name
+from .media import FileRegion
+from .server import STATS_PATH
+from .service import start_background_tasks, stop_background_tasks
+
+ASGI_THREADS_ENV = "ADAPTIVE_TEST_ASGI_THREADS"
+MAX_BODY_BYTES = 1024 * 1024
+
+
+@dataclass
+class RouteTiming:
+    count: int = 0
+    offloaded: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        return asdict(self)
+
+
+class RouteTimings:
+    """Latency per route template; only updated from the event loop thread."""
+
+    def __init__(self) -> None:
+        self._routes: Dict[str, RouteTiming] = {}
+
+    def record(self, route: str, seconds: float, offloaded: bool) -> None:
+        timing = self._routes.get(route)
+        if timing is None:
+            timing = self._routes[route] = RouteTiming()
+        timing.count += 1
+        timing.offloaded += offloaded
+        timing.total_seconds += seconds
+        if seconds > timing.max_seconds:
+            timing.max_seconds = seconds
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        return {route: timing.to_dict() for route, timing in sorted(self._routes.items())}
+
+
+class _BodyTooLarge(Exception):
+    pass
 
 
 class AdaptiveASGIApp:
     """Lightweight ASGI app that reuses the service layer via :mod:`http_router`."""
 
+    def __init__(self, workers: Optional[int] = None, max_body_bytes: int = MAX_BODY_BYTES) -> None:
+        self.workers = workers or int(os.environ.get(ASGI_THREADS_ENV, "32"))
+        self.max_body_bytes = max_body_bytes
+        self.timings = RouteTimings()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="asgi-blocking")
+        return self._executor
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
     async def __call__(self, scope, receive, send):  # type: ignore[override]
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
         if scope["type"] != "http":
             await send(
                 {
@@ -21,18 +100,30 @@ class AdaptiveASGIApp:
             await send({"type": "http.response.body", "body": b"Not found"})
             return
 
+        started = time.perf_counter()
         method = scope.get("method", "GET")
         path = scope.get("path", "/")
-        body_chunks = []
-
-        if method in {"POST", "PUT", "PATCH"}:
-            while True:
-                message = await receive()
-                body_chunks.append(message.get("body", b""))
-                if not message.get("more_body"):
-                    break
-
-        status, headers, body = dispatch(method, path, b"".join(body_chunks))
+        request_headers = {
+            key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope.get("headers", ())
+        }
+
+        offloaded = False
+        if method == "GET" and path == STATS_PATH:
+            status, headers, body = self._stats_response()
+        else:
+            try:
+                payload = await self._receive_body(receive, request_headers) if method in {"POST", "PUT", "PATCH"} else b""
+            except _BodyTooLarge:
+                status, headers, body = _error(413, "Request body too large")
+            else:
+                response = None if blocking(method, path) else dispatch_inline(method, path, payload, request_headers)
+                offloaded = response is None
+                if offloaded:
+                    loop = asyncio.get_running_loop()
+                    response = await loop.run_in_executor(
+                        self._pool(), dispatch, method, path, payload, request_headers
+                    )
+                status, headers, body = response
         if method == "HEAD":
             body = b""
 
@@ -43,7 +134,85 @@ class AdaptiveASGIApp:
                 "headers": _encode_headers(headers.items()),
             }
         )
-        await send({"type": "http.response.body", "body": body})
+        if isinstance(body, FileRegion):
+            await self._send_file(scope, send, body)
+        else:
+            await send({"type": "http.response.body", "body": body})
+        self.timings.record(route_name(method, path), time.perf_counter() - started, offloaded)
+
+    async def _send_file(self, scope, send, region: FileRegion) -> None:
+        if not region.length:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with region.path.open("rb") as handle:
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": handle,
+                        "offset": region.offset,
+                        "count": region.length,
+                    }
+                )
+            return
+        loop = asyncio.get_running_loop()
+        chunks = region.chunks()
+        while True:
+            chunk = await loop.run_in_executor(self._pool(), next, chunks, b"")
+            await send({"type": "http.response.body", "body": chunk, "more_body": bool(chunk)})
+            if not chunk:
+                return
+
+    async def _receive_body(self, receive, headers: Dict[str, str]) -> bytes:
+        try:
+            expected = int(headers.get("content-length", ""))
+        except ValueError:
+            expected = -1
+        if expected > self.max_body_bytes:
+            raise _BodyTooLarge()
+        # Chunks are copied into one buffer as they arrive instead of being
+        # collected and joined; with a Content-Length it is allocated once.
+        buffer = bytearray(expected) if expected > 0 else bytearray()
+        size = 0
+        while True:
+            message = await receive()
+            chunk = message.get("body", b"")
+            if chunk:
+                end = size + len(chunk)
+                if end > self.max_body_bytes:
+                    raise _BodyTooLarge()
+                if end <= len(buffer):
+                    buffer[size:end] = chunk
+                else:
+                    del buffer[size:]
+                    buffer += chunk
+                size = end
+            if not message.get("more_body"):
+                break
+        del buffer[size:]
+        return buffer
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._pool()
+                start_background_tasks()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                stop_background_tasks()
+                self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _stats_response(self) -> Tuple[int, Dict[str, str], bytes]:
+        body = json.dumps({"workers": self.workers, "routes": self.timings.to_dict()}).encode("utf-8")
+        return 200, {"Content-Type": "application/json; charset=utf-8", "Content-Length": str(len(body))}, body
+
+
+def _error(status: int, message: str) -> Tuple[int, Dict[str, str], bytes]:
+    body = json.dumps({"detail": message}).encode("utf-8")
+    return status, {"Content-Type": "application/json; charset=utf-8", "Content-Length": str(len(body))}, body
 
 
 def _encode_headers(headers: Iterable[Tuple[str, str]]) -> Iterable[Tuple[bytes, bytes]]:
@@ -51,11 +220,11 @@ def _encode_headers(headers: Iterable[Tuple[str, str]]) -> Iterable[Tuple[bytes,
         yield key.encode("latin-1"), value.encode("latin-1")
 
 
-def create_app() -> AdaptiveASGIApp:
-    return AdaptiveASGIApp()
+def create_app(workers: Optional[int] = None) -> AdaptiveASGIApp:
+    return AdaptiveASGIApp(workers)
 
 
 app = create_app()
 
 
-__all__ = ["AdaptiveASGIApp", "app", "create_app"]
+__all__ = ["ASGI_THREADS_ENV", "AdaptiveASGIApp", "RouteTiming", "RouteTimings", "app", "create_app"]
@@ -0,0 +1,291 @@
+"""Compiled, memory-mapped item bank snapshots.
+
+The generators in :mod:`app.item_bank` are the source format of the bank.
+``python -m app.build_bank`` compiles them into a versioned binary file
+made of a fixed-size parameter block and a deduplicated string table::
+
+    header   magic, format version, item count, bank digest, block offsets
+    params   one record per item: a, b, c, max_plays and string references
+    strings  UTF-8 table; stems, options and metadata are stored as JSON
+
+At startup :func:`load_item_bank` memory-maps the snapshot and returns
+:class:`SnapshotItem` views. Numeric parameters are unpacked when the view
+is created, while stems, options and metadata are decoded on first access,
+so cold start does not depend on the size of the text in the bank.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import struct
+from functools import cached_property
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+from app.cat_engine import Item
+
+BASE_DIR = Path(__file__).resolve().parent
+DATA_DIR = BASE_DIR.parent / "data"
+
+SNAPSHOT_PATH = DATA_DIR / "item_bank.bin"
+
+MAGIC = b"AELTBANK"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<8sHHI32sQQQQ")
+_STRING_FIELDS = ("id", "domain", "model", "stem", "options", "correct_key", "metadata", "steps")
+_RECORD = struct.Struct("<dddI" + "II" * len(_STRING_FIELDS))
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+class SnapshotError(ValueError):
+    """Raised when a snapshot is missing, truncated or of another format."""
+
+
+def encode_snapshot(items: Iterable[Item]) -> bytes:
+    """Serialise ``items`` into the snapshot format."""
+
+    strings = bytearray()
+    offsets: dict[bytes, Tuple[int, int]] = {}
+
+    def intern(value: Optional[str]) -> Tuple[int, int]:
+        if value is None:
+            return (0, 0xFFFFFFFF)
+        encoded = value.encode("utf-8")
+        ref = offsets.get(encoded)
+        if ref is None:
+            ref = (len(strings), len(encoded))
+            offsets[encoded] = ref
+            strings.extend(encoded)
+        return ref
+
+    params = bytearray()
+    count = 0
+    for item in items:
+        correct = item.correct_key
+        if not isinstance(correct, int):
+            correct = list(correct)
+        refs = (
+            intern(item.id),
+            intern(item.domain),
+            intern(item.model),
+            intern(item.stem),
+            intern(_dumps(item.options)),
+            intern(_dumps(correct)),
+            intern(None if item.metadata is None else _dumps(item.metadata)),
+            intern(None if item.step_difficulties is None else _dumps(item.step_difficulties)),
+        )
+        params.extend(
+            _RECORD.pack(
+                float(item.irt_a),
+                float(item.irt_b),
+                float(item.irt_c),
+                int(item.max_plays),
+                *(value for ref in refs for value in ref),
+            )
+        )
+        count += 1
+
+    digest = hashlib.sha256(bytes(params) + bytes(strings)).digest()
+    params_offset = _HEADER.size
+    strings_offset = params_offset + len(params)
+    header = _HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        0,
+        count,
+        digest,
+        params_offset,
+        len(params),
+        strings_offset,
+        len(strings),
+    )
+    return header + bytes(params) + bytes(strings)
+
+
+def write_snapshot(items: Iterable[Item], path: Path = SNAPSHOT_PATH) -> str:
+    """Atomically write a snapshot of ``items`` to ``path`` and return its version."""
+
+    payload = encode_snapshot(items)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix(path.suffix + ".tmp")
+    with open(temporary, "wb") as handle:
+        handle.write(payload)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(temporary, path)
+    return BankSnapshot(payload).version
+
+
+class _StringTable:
+    """Decodes strings from the snapshot buffer; shared by all item views.
+
+    Items reference this table rather than the :class:`BankSnapshot` that
+    lists them, so no reference cycle delays releasing the mapped buffer.
+    """
+
+    __slots__ = ("buffer", "offset", "owner")
+
+    def __init__(self, buffer: memoryview, offset: int, owner: object) -> None:
+        self.buffer = buffer
+        self.offset = offset
+        self.owner = owner
+
+    def get(self, offset: int, length: int) -> Optional[str]:
+        if length == 0xFFFFFFFF:
+            return None
+        start = self.offset + offset
+        return str(self.buffer[start : start + length], "utf-8")
+
+
+class BankSnapshot:
+    """Read-only view over an encoded snapshot held in any buffer.
+
+    ``owner`` is kept alive for as long as the snapshot or any of its items
+    are reachable (for example the ``mmap`` or shared-memory segment).
+    """
+
+    def __init__(self, buffer: Buffer, owner: object = None) -> None:
+        self._buffer = memoryview(buffer)
+        if len(self._buffer) < _HEADER.size:
+            raise SnapshotError("Snapshot is truncated")
+        (
+            magic,
+            version,
+            _reserved,
+            self.count,
+            self.digest,
+            self._params_offset,
+            params_size,
+            self._strings_offset,
+            strings_size,
+        ) = _HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise SnapshotError("Not an item bank snapshot")
+        if version != FORMAT_VERSION:
+            raise SnapshotError(f"Unsupported snapshot format version: {version}")
+        if params_size != self.count * _RECORD.size or len(self._buffer) < self._strings_offset + strings_size:
+            raise SnapshotError("Snapshot is truncated")
+        self.strings = _StringTable(self._buffer, self._strings_offset, owner)
+        self._items: Optional[List["SnapshotItem"]] = None
+
+    @classmethod
+    def open(cls, path: Path = SNAPSHOT_PATH) -> "BankSnapshot":
+        """Memory-map the snapshot stored at ``path``."""
+
+        with open(path, "rb") as handle:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped, owner=mapped)
+
+    @property
+    def version(self) -> str:
+        """Hex digest of the parameter block and string table."""
+
+        return self.digest.hex()
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def items(self) -> List["SnapshotItem"]:
+        if self._items is None:
+            self._items = [SnapshotItem(self, index) for index in range(self.count)]
+        return self._items
+
+    def record(self, index: int) -> Tuple:
+        return _RECORD.unpack_from(self._buffer, self._params_offset + index * _RECORD.size)
+
+    def string(self, offset: int, length: int) -> Optional[str]:
+        return self.strings.get(offset, length)
+
+
+class SnapshotItem(Item):
+    """:class:`Item` whose text fields are decoded from a snapshot on demand."""
+
+    def __init__(self, snapshot: BankSnapshot, index: int) -> None:
+        record = snapshot.record(index)
+        self._strings = snapshot.strings
+        self._refs = record[4:]
+        self.irt_a, self.irt_b, self.irt_c, self.max_plays = record[:4]
+
+    def _text(self, field: str) -> Optional[str]:
+        slot = _STRING_FIELDS.index(field) * 2
+        return self._strings.get(self._refs[slot], self._refs[slot + 1])
+
+    def _json(self, field: str):
+        raw = self._text(field)
+        return None if raw is None else json.loads(raw)
+
+    @cached_property
+    def id(self) -> str:  # type: ignore[override]
+        return self._text("id")
+
+    @cached_property
+    def domain(self) -> str:  # type: ignore[override]
+        return self._text("domain")
+
+    @cached_property
+    def model(self) -> str:  # type: ignore[override]
+        return self._text("model")
+
+    @cached_property
+    def stem(self) -> str:  # type: ignore[override]
+        return self._text("stem")
+
+    @cached_property
+    def options(self) -> List[str]:  # type: ignore[override]
+        return self._json("options")
+
+    @cached_property
+    def correct_key(self) -> Sequence[int] | int:  # type: ignore[override]
+        return self._json("correct_key")
+
+    @cached_property
+    def metadata(self):  # type: ignore[override]
+        return self._json("metadata")
+
+    @cached_property
+    def step_difficulties(self) -> Optional[List[float]]:  # type: ignore[override]
+        return self._json("steps")
+
+
+def _dumps(value: object) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_item_bank(path: Path = SNAPSHOT_PATH, store_path: Optional[Path] = None) -> Sequence[Item]:
+    """Return the bank for this process.
+
+    Sources are tried in order: a bank published in shared memory (when
+    :data:`app.shared_bank.SHARED_BANK_ENV` is set), the SQLite ``items``
+    table at ``store_path`` when it holds active items, the compiled snapshot
+    at ``path``, and finally the generated bank.
+    """
+
+    from app.item_store import ItemBankRepository
+    from app.shared_bank import attached_bank_from_env
+
+    try:
+        shared = attached_bank_from_env()
+    except (OSError, ValueError):
+        shared = None
+    if shared is not None:
+        return shared.items
+    try:
+        repository = ItemBankRepository(store_path)
+        repository.reload()
+    except sqlite3.Error:
+        repository = None
+    if repository:
+        return repository.items()
+    try:
+        return BankSnapshot.open(path).items
+    except (OSError, ValueError):
+        from app.item_bank import ITEMS
+
+        return ITEMS
@@ -0,0 +1,33 @@
+"""Command line entry point that compiles the generated item bank into a snapshot or the database."""
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+
+from .bank_snapshot import SNAPSHOT_PATH, write_snapshot
+from .item_store import ItemBankRepository
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compile the item bank into a binary snapshot")
+    parser.add_argument("--output", default=str(SNAPSHOT_PATH), help=f"Snapshot path (default: {SNAPSHOT_PATH})")
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        help="Import the items into the SQLite items table instead of writing a snapshot",
+    )
+    args = parser.parse_args()
+
+    from .item_bank import build_items
+
+    items = build_items()
+    if args.store:
+        version = ItemBankRepository().save(items)
+        print(f"Stored {len(items)} items in the database (version stamp {version})")
+        return
+    version = write_snapshot(items, Path(args.output))
+    print(f"Wrote {len(items)} items to {args.output} (version {version[:12]})")
+
+
+if __name__ == "__main__":
+    main()
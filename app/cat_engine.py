@@ -1,10 +1,21 @@
 """Core CAT engine utilities implementing IRT calculations and adaptive item selection."""
 from __future__ import annotations
 
+from collections.abc import Mapping
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, Iterable, List, Optional, Sequence
+from itertools import count
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+import hashlib
 import math
+import os
+import struct
+import threading
+import weakref
+
+from app.estimators import EapEstimator, EapGrid, MapEstimator
+from app.item_matrix import InformationTable, ItemMatrix, PeakIndex, build_domain_matrices
+from app.session_state import ItemCatalog, ItemHistory, Response, ResponseLog, SeenItems
 
 
 CAT_PARTS = ["grammar", "vocabulary", "english_in_use", "listening"]
@@ -14,6 +25,10 @@ DOMAIN_TARGETS = {
     "english_in_use": 16,
     "listening": 12,
 }
+ESTIMATION_METHODS = ("map", "eap")
+SELECTION_STRATEGIES = ("table", "peak", "scan")
+# Names the ranking strategy of the registered bank; exact scans by default.
+SELECTION_ENV = "ADAPTIVE_TEST_SELECTION"
 
 
 @dataclass
@@ -39,17 +54,7 @@ class Item:
         return (int(self.correct_key),)
 
 
-@dataclass
-class Response:
-    item_id: str
-    score: float
-    theta_before: float
-    theta_after: float
-    se_after: float
-    raw_response: Dict[str, object] | None = None
-
-
-@dataclass
+@dataclass(slots=True)
 class Session:
     id: str
     start_level: str
@@ -59,22 +64,33 @@ class Session:
     se: float
     part_index: int = 0
     finished: bool = False
-    responses: List[Response] = field(default_factory=list)
+    responses: ResponseLog = field(init=False)
     plays: Dict[str, int] = field(default_factory=dict)
-    seen_items: set[str] = field(default_factory=set)
+    seen_items: SeenItems = field(init=False)
     pending_item_id: Optional[str] = None
     part_counts: Dict[str, int] = field(default_factory=lambda: {part: 0 for part in CAT_PARTS})
-    item_history: Dict[str, Item] = field(default_factory=dict)
+    item_history: ItemHistory = field(init=False)
     first_name: str = ""
     last_name: str = ""
     started_at: datetime = field(default_factory=datetime.utcnow)
     paused: bool = True
     upcoming_domain: Optional[str] = None
+    estimation: str = "map"
+    estimator: Optional[MapEstimator | EapEstimator] = field(default=None, repr=False, compare=False)
+    bank: ItemBank = field(default=None, repr=False, compare=False)  # type: ignore[assignment]
 
     def current_domain(self) -> str:
         return CAT_PARTS[self.part_index]
 
     def __post_init__(self) -> None:
+        if self.estimation not in ESTIMATION_METHODS:
+            raise ValueError(f"Unsupported estimation method: {self.estimation}")
+        if self.bank is None:
+            self.bank = current_bank()
+        catalog = self.bank.catalog
+        self.responses = ResponseLog(catalog)
+        self.seen_items = SeenItems(catalog)
+        self.item_history = ItemHistory(catalog)
         if self.upcoming_domain is None and CAT_PARTS:
             self.upcoming_domain = CAT_PARTS[self.part_index]
 
@@ -103,6 +119,14 @@ class Session:
         ):
             self.advance_part()
 
+    def lookup_item(self, item_id: str) -> Optional[Item]:
+        """Find ``item_id`` in the session history or the bank pinned to the session."""
+
+        item = self.item_history.get(item_id)
+        if item is None:
+            item = self.bank.lookup.get(item_id)
+        return item
+
     def resume_current_part(self) -> None:
         self.paused = False
         self.upcoming_domain = CAT_PARTS[self.part_index]
@@ -222,6 +246,34 @@ def log_likelihood_derivatives(
     return first, second
 
 
+def _sync_estimator(session: Session, method: str) -> MapEstimator | EapEstimator:
+    """Return the session estimator, absorbing responses it has not seen yet.
+
+    The estimator normally trails ``session.responses`` by the one answer the
+    service appends after the theta update returns. It is rebuilt from the
+    history only when the two have diverged, a different method is requested
+    or the item bank grid was replaced.
+    """
+
+    estimator = session.estimator
+    if method == "eap":
+        stale = not isinstance(estimator, EapEstimator) or estimator.grid is not session.bank.eap_grid
+    else:
+        stale = not isinstance(estimator, MapEstimator)
+    if stale or len(estimator) > len(session.responses):
+        if method == "eap":
+            estimator = EapEstimator(session.bank.eap_grid, session.prior_mu, session.prior_sigma)
+        else:
+            estimator = MapEstimator(session.prior_mu, session.prior_sigma)
+        session.estimator = estimator
+    for record in session.responses[len(estimator) :]:
+        previous = session.lookup_item(record.item_id)
+        if previous is None:
+            continue
+        estimator.add(previous, record.score)
+    return estimator
+
+
 def update_theta_map(
     session: Session,
     item: Item,
@@ -229,61 +281,208 @@ def update_theta_map(
     max_iter: int = 25,
     tolerance: float = 1e-4,
 ) -> tuple[float, float]:
-    theta = session.theta
-    responses: list[tuple[Item, float]] = []
-    for record in session.responses:
-        previous = session.item_history.get(record.item_id)
-        if previous is None:
-            previous = it_lookup.get(record.item_id)
-        if previous is None:
-            continue
-        responses.append((previous, record.score))
-    responses.append((item, score))
-    for _ in range(max_iter):
-        ll1, ll2 = log_likelihood_derivatives(theta, responses)
-        prior1 = (session.prior_mu - theta) / (session.prior_sigma ** 2)
-        prior2 = -1.0 / (session.prior_sigma ** 2)
-        numerator = ll1 + prior1
-        denominator = ll2 + prior2
-        if abs(denominator) < 1e-6:
-            break
-        theta_new = theta - numerator / denominator
-        if abs(theta_new - theta) < tolerance:
-            theta = theta_new
-            break
-        theta = theta_new
-    info = sum(fisher_information(it, theta) for it, _ in responses)
-    if info <= 0:
-        se = float("inf")
-    else:
-        se = 1.0 / math.sqrt(info)
-    return theta, se
+    estimator = _sync_estimator(session, "map")
+    estimator.add(item, score)
+    return estimator.estimate(session.theta, max_iter=max_iter, tolerance=tolerance)
+
+
+def update_theta_eap(session: Session, item: Item, score: float) -> tuple[float, float]:
+    """EAP update: multiply the grid posterior by the item likelihood column."""
+
+    estimator = _sync_estimator(session, "eap")
+    estimator.add(item, score)
+    return estimator.estimate()
+
+
+def update_theta(session: Session, item: Item, score: float) -> tuple[float, float]:
+    """Update theta with the estimator configured on ``session``."""
+
+    if session.estimation == "eap":
+        return update_theta_eap(session, item, score)
+    return update_theta_map(session, item, score)
+
+
+class ItemBank:
+    """Immutable, versioned item bank with everything selection needs.
+
+    A bank is never modified after construction. :func:`register_item_bank`
+    builds a new one and publishes it by rebinding a single module reference,
+    so concurrent readers always see either the old or the new bank in full.
+    Sessions keep a reference to the bank they started with; a version is
+    released as soon as the last session pinned to it goes away.
+    """
+
+    def __init__(
+        self,
+        items: Iterable[Item],
+        selection: str = "scan",
+        version: Optional[int] = None,
+        source: object = None,
+    ) -> None:
+        if selection not in SELECTION_STRATEGIES:
+            raise ValueError(f"Unsupported selection strategy: {selection}")
+        self.version = next(_bank_versions) if version is None else version
+        self.selection = selection
+        self.source = source
+        self.catalog = ItemCatalog(items)
+        self.items = self.catalog.items
+        self.lookup: Dict[str, Item] = {item.id: item for item in self.items}
+        self.matrices = build_domain_matrices(self.items)
+        self.rankers: Dict[str, InformationTable | PeakIndex] = {}
+        if selection == "table":
+            self.rankers = {domain: InformationTable(matrix) for domain, matrix in self.matrices.items()}
+        elif selection == "peak":
+            self.rankers = {domain: PeakIndex(matrix) for domain, matrix in self.matrices.items()}
+        self.eap_grid = EapGrid(items=self.items)
+        self.fingerprint = _bank_fingerprint(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __repr__(self) -> str:
+        return f"ItemBank(version={self.version}, items={len(self.items)}, selection={self.selection!r})"
+
+    def serves(self, candidate_items: object) -> bool:
+        """Whether ``candidate_items`` is the item sequence this bank was built from."""
+
+        return candidate_items is None or candidate_items is self.source or candidate_items is self.items
 
+    def domain_matrix(self, domain: str) -> ItemMatrix:
+        return self.matrices.get(domain) or ItemMatrix(())
 
-it_lookup: Dict[str, Item] = {}
 
+def _bank_fingerprint(items: Sequence[Item]) -> bytes:
+    """Content digest identifying a bank (and its item positions) across processes."""
 
-def register_item_bank(items: Iterable[Item]) -> None:
-    it_lookup.clear()
+    digest = hashlib.sha256()
     for item in items:
-        it_lookup[item.id] = item
+        digest.update(item.id.encode("utf-8"))
+        digest.update(struct.pack("<ddd", item.irt_a, item.irt_b, item.irt_c))
+    return digest.digest()[:8]
 
 
-def select_next_item(session: Session, candidate_items: Iterable[Item]) -> Optional[Item]:
+class _CurrentLookup(Mapping):
+    """Read-only ``item_id -> Item`` view of whichever bank is current."""
+
+    def __getitem__(self, item_id: str) -> Item:
+        return _current_bank.lookup[item_id]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(_current_bank.lookup)
+
+    def __len__(self) -> int:
+        return len(_current_bank.lookup)
+
+
+_bank_versions = count(1)
+_bank_swap_lock = threading.Lock()
+_live_banks: "weakref.WeakValueDictionary[int, ItemBank]" = weakref.WeakValueDictionary()
+_current_bank = ItemBank((), selection="scan", version=0)
+it_lookup: Mapping[str, Item] = _CurrentLookup()
+
+
+def current_bank() -> ItemBank:
+    """The bank new sessions are pinned to."""
+
+    return _current_bank
+
+
+def live_bank_versions() -> List[int]:
+    """Versions of banks still referenced by the current pointer or by sessions."""
+
+    return sorted(_live_banks)
+
+
+def bank_with_fingerprint(fingerprint: bytes) -> Optional[ItemBank]:
+    """The current or a still-live bank whose :attr:`ItemBank.fingerprint` matches."""
+
+    bank = _current_bank
+    if bank.fingerprint == fingerprint:
+        return bank
+    for bank in list(_live_banks.values()):
+        if bank.fingerprint == fingerprint:
+            return bank
+    return None
+
+
+def register_item_bank(items: Iterable[Item], selection: str = "scan") -> ItemBank:
+    """Build a new :class:`ItemBank` from ``items`` and make it current.
+
+    ``selection`` picks how candidates are ranked: ``"scan"`` scores every
+    candidate exactly on each call, ``"peak"`` keeps a peak-sorted index
+    whose bounded search returns the same item, and ``"table"`` interpolates
+    information precomputed on a theta grid, which is faster still but may
+    rank near-ties differently. The bank is fully built before it is
+    published, so in-flight requests never observe a partially filled
+    lookup.
+    """
+
+    global _current_bank
+    bank = ItemBank(items, selection=selection, source=items)
+    with _bank_swap_lock:
+        # A slower concurrent registration must not replace a newer bank.
+        if bank.version < _current_bank.version:
+            return bank
+        _live_banks[bank.version] = bank
+        _current_bank = bank
+    return bank
+
+
+def selection_from_env(environ: Mapping[str, str] = os.environ) -> str:
+    """The strategy named by :data:`SELECTION_ENV`, ``"scan"`` if unset."""
+
+    selection = environ.get(SELECTION_ENV) or "scan"
+    if selection not in SELECTION_STRATEGIES:
+        raise ValueError(f"Invalid {SELECTION_ENV}: {selection}")
+    return selection
+
+
+def _best_candidate(session: Session, matrix: ItemMatrix, seen: bytearray) -> Optional[int]:
+    ranker = session.bank.rankers.get(session.current_domain())
+    if ranker is not None and ranker.matrix is matrix and ranker.covers(session.theta):
+        return ranker.best_index(session.theta, seen)
+    return matrix.best_index(session.theta, seen)
+
+
+def _most_informative(session: Session, candidate_items: Iterable[Item]) -> Optional[Item]:
+    """Score ``candidate_items`` one by one, without building an :class:`ItemMatrix` per call."""
+
+    domain = session.current_domain()
+    seen = session.seen_items
+    best: Optional[Item] = None
+    best_value = -math.inf
+    for item in candidate_items:
+        if item.domain != domain or item.id in seen:
+            continue
+        value = fisher_information(item, session.theta)
+        if best is None or value > best_value:
+            best = item
+            best_value = value
+    return best
+
+
+def select_next_item(session: Session, candidate_items: Optional[Iterable[Item]] = None) -> Optional[Item]:
+    """Pick the most informative unseen item of the current domain.
+
+    Candidates default to the bank pinned to ``session``, ranked with its
+    per-domain matrix (and index, if the bank has one); any other iterable
+    is scored item by item.
+    """
+
     if session.pending_item_id:
-        return it_lookup.get(session.pending_item_id)
-    domain_items = [
-        item
-        for item in candidate_items
-        if item.domain == session.current_domain() and item.id not in session.seen_items
-    ]
-    if not domain_items:
+        return session.lookup_item(session.pending_item_id)
+    if session.bank.serves(candidate_items):
+        matrix = session.bank.domain_matrix(session.current_domain())
+        best_index = _best_candidate(session, matrix, matrix.seen_mask(session.seen_items))
+        best_item = None if best_index is None else matrix.items[best_index]
+    else:
+        best_item = _most_informative(session, candidate_items)  # type: ignore[arg-type]
+    if best_item is None:
         # advance to next part if possible
         session.advance_part()
         if session.finished:
             return None
         return select_next_item(session, candidate_items)
-    best_item = max(domain_items, key=lambda item: fisher_information(item, session.theta))
     session.seen_items.add(best_item.id)
     session.pending_item_id = best_item.id
     session.item_history[best_item.id] = best_item
@@ -1,10 +1,22 @@
-"""SQLite persistence helpers for recording adaptive test sessions."""
+"""SQLite persistence helpers for recording adaptive test sessions.
+
+Connections are long-lived: every thread gets one writer connection per
+database file, opened in WAL mode, and reporting queries use a separate
+read-only connection so they never wait behind (or block) writers. A
+thread's connections are closed when the thread ends, so servers that start
+a thread per connection do not accumulate SQLite handles. Each
+helper issues the same SQL text on every call, so the per-connection
+statement cache of :mod:`sqlite3` reuses the prepared statements.
+"""
 from __future__ import annotations
 
+import os
 import sqlite3
+import threading
+import weakref
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
 
 
 BASE_DIR = Path(__file__).resolve().parent
@@ -13,15 +25,163 @@ DATA_DIR.mkdir(exist_ok=True)
 
 DB_PATH = DATA_DIR / "adaptive_test.db"
 
+ITEM_COLUMNS = (
+    "id",
+    "domain",
+    "stem",
+    "options",
+    "correct_key",
+    "model",
+    "irt_a",
+    "irt_b",
+    "irt_c",
+    "max_plays",
+    "tags",
+    "metadata",
+    "step_difficulties",
+)
 
-def _connect() -> sqlite3.Connection:
-    connection = sqlite3.connect(DB_PATH)
-    connection.row_factory = sqlite3.Row
-    return connection
+STATEMENT_CACHE_SIZE = 128
 
+# WAL keeps readers and the writer out of each other's way; with WAL,
+# ``synchronous=NORMAL`` only fsyncs at checkpoints while staying corruption-safe.
+_WRITER_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-8192",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+_READER_PRAGMAS = (
+    "PRAGMA cache_size=-4096",
+    "PRAGMA busy_timeout=5000",
+)
 
-def init_db() -> None:
-    with _connect() as connection:
+
+class _ThreadConnections:
+    """One thread's connections; dropped with the thread-local storage when the thread ends."""
+
+    __slots__ = ("writer", "reader", "opened", "__weakref__")
+
+    def __init__(self) -> None:
+        self.writer: Optional[sqlite3.Connection] = None
+        self.reader: Optional[sqlite3.Connection] = None
+        self.opened: List[sqlite3.Connection] = []
+
+
+def _close_all(connections: List[sqlite3.Connection]) -> None:
+    while connections:
+        connections.pop().close()
+
+
+class ConnectionPool:
+    """Per-thread writer and read-only connections to one database file."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.pid = os.getpid()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Weak, so the pool never keeps a finished thread's connections alive.
+        self._threads: "weakref.WeakSet[_ThreadConnections]" = weakref.WeakSet()
+
+    def writer(self) -> sqlite3.Connection:
+        holder = self._holder()
+        if holder.writer is None:
+            holder.writer = self._open(holder, sqlite3.connect(self.path, **self._options()), _WRITER_PRAGMAS)
+        return holder.writer
+
+    def reader(self) -> sqlite3.Connection:
+        holder = self._holder()
+        if holder.reader is None:
+            uri = self.path.resolve().as_uri() + "?mode=ro"
+            holder.reader = self._open(holder, sqlite3.connect(uri, uri=True, **self._options()), _READER_PRAGMAS)
+        return holder.reader
+
+    def _holder(self) -> _ThreadConnections:
+        holder = getattr(self._local, "connections", None)
+        if holder is None:
+            holder = _ThreadConnections()
+            # Runs when the thread exits and its thread-local storage is freed.
+            weakref.finalize(holder, _close_all, holder.opened)
+            self._local.connections = holder
+            with self._lock:
+                self._threads.add(holder)
+        return holder
+
+    @staticmethod
+    def _options() -> Dict[str, object]:
+        # Each connection is only used by the thread that opened it; the
+        # check is disabled so :meth:`close` and the thread-exit finalizer
+        # may run from any thread.
+        return {"check_same_thread": False, "cached_statements": STATEMENT_CACHE_SIZE}
+
+    @staticmethod
+    def _open(
+        holder: _ThreadConnections, connection: sqlite3.Connection, pragmas: Sequence[str]
+    ) -> sqlite3.Connection:
+        connection.row_factory = sqlite3.Row
+        for pragma in pragmas:
+            connection.execute(pragma)
+        holder.opened.append(connection)
+        return connection
+
+    def open_connections(self) -> int:
+        with self._lock:
+            return sum(len(holder.opened) for holder in self._threads)
+
+    def close(self) -> None:
+        with self._lock:
+            holders = list(self._threads)
+        for holder in holders:
+            holder.writer = holder.reader = None
+            _close_all(holder.opened)
+
+
+_pools: Dict[Path, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(path: Optional[Path] = None) -> ConnectionPool:
+    key = Path(path or DB_PATH)
+    pool = _pools.get(key)
+    # Connections must not cross ``fork``; a child process opens its own.
+    if pool is None or pool.pid != os.getpid():
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None or pool.pid != os.getpid():
+                pool = _pools[key] = ConnectionPool(key)
+    return pool
+
+
+def _connect(path: Optional[Path] = None) -> sqlite3.Connection:
+    """This thread's long-lived writer connection; ``with`` commits or rolls back."""
+
+    return _pool(path).writer()
+
+
+def _read(path: Optional[Path] = None) -> sqlite3.Connection:
+    """This thread's read-only connection for reporting queries."""
+
+    return _pool(path).reader()
+
+
+def close_connections(path: Optional[Path] = None) -> None:
+    """Close pooled connections for ``path`` (every database when ``None``)."""
+
+    with _pools_lock:
+        if path is None:
+            pools = list(_pools.values())
+            _pools.clear()
+        else:
+            pool = _pools.pop(Path(path), None)
+            pools = [] if pool is None else [pool]
+    for pool in pools:
+        pool.close()
+
+
+def init_db(path: Optional[Path] = None) -> None:
+    with _connect(path) as connection:
         connection.execute(
             """
             CREATE TABLE IF NOT EXISTS tests (
@@ -49,14 +209,146 @@ def init_db() -> None:
             )
             """
         )
-        connection.commit()
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS plays (
+                test_id TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                play INTEGER NOT NULL,
+                played_at TEXT NOT NULL,
+                PRIMARY KEY (test_id, item_id)
+            )
+            """
+        )
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                id TEXT PRIMARY KEY,
+                domain TEXT NOT NULL,
+                stem TEXT NOT NULL,
+                options TEXT NOT NULL,
+                correct_key TEXT NOT NULL,
+                model TEXT NOT NULL,
+                irt_a REAL NOT NULL,
+                irt_b REAL NOT NULL,
+                irt_c REAL NOT NULL DEFAULT 0,
+                max_plays INTEGER NOT NULL DEFAULT 0,
+                tags TEXT NOT NULL DEFAULT '[]',
+                metadata TEXT,
+                step_difficulties TEXT,
+                exposure_count INTEGER NOT NULL DEFAULT 0,
+                active INTEGER NOT NULL DEFAULT 1,
+                version INTEGER NOT NULL,
+                created_at TEXT NOT NULL
+            )
+            """
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_items_domain_b ON items (domain, irt_b)")
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_items_model ON items (model)")
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_responses_test ON responses (test_id)")
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_items_version ON items (version)")
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS session_blobs (
+                id TEXT PRIMARY KEY,
+                state BLOB NOT NULL,
+                finished INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT NOT NULL
+            )
+            """
+        )
 
 
 def reset_db() -> None:
     with _connect() as connection:
         connection.execute("DELETE FROM responses")
+        connection.execute("DELETE FROM plays")
         connection.execute("DELETE FROM tests")
-        connection.commit()
+
+
+TEST_START_SQL = """
+    INSERT INTO tests (id, first_name, last_name, start_level, started_at, current_part, paused)
+    VALUES (?, ?, ?, ?, ?, ?, 1)
+    ON CONFLICT(id) DO UPDATE SET
+        first_name=excluded.first_name,
+        last_name=excluded.last_name,
+        start_level=excluded.start_level,
+        started_at=excluded.started_at,
+        current_part=excluded.current_part,
+        paused=1,
+        finished_at=NULL
+"""
+
+TEST_STATE_SQL = """
+    UPDATE tests
+       SET current_part = ?,
+           paused = ?
+     WHERE id = ?
+"""
+
+RESPONSE_SQL = """
+    INSERT INTO responses (test_id, item_id, domain, score, answered_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# Only inserts when the test has exactly ``position`` responses so far.
+RESPONSE_AT_SQL = """
+    INSERT INTO responses (test_id, item_id, domain, score, answered_at)
+    SELECT ?, ?, ?, ?, ?
+     WHERE (SELECT COUNT(*) FROM responses WHERE test_id = ?) = ?
+"""
+
+# Only moves an item to play ``n`` when play ``n - 1`` is the latest one.
+PLAY_AT_SQL = """
+    INSERT INTO plays (test_id, item_id, play, played_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(test_id, item_id) DO UPDATE SET
+        play=excluded.play,
+        played_at=excluded.played_at
+     WHERE plays.play = excluded.play - 1
+"""
+
+TEST_FINISH_SQL = """
+    UPDATE tests
+       SET finished_at = ?,
+           paused = 0,
+           current_part = NULL
+     WHERE id = ?
+"""
+
+
+def start_params(
+    test_id: str,
+    first_name: str,
+    last_name: str,
+    start_level: str,
+    started_at: datetime,
+    upcoming_part: Optional[str],
+) -> Tuple:
+    return (test_id, first_name, last_name, start_level, started_at.isoformat(), upcoming_part)
+
+
+def state_params(test_id: str, current_part: Optional[str], paused: bool) -> Tuple:
+    return (current_part, int(paused), test_id)
+
+
+def response_params(test_id: str, item_id: str, domain: str, score: float, answered_at: datetime) -> Tuple:
+    return (test_id, item_id, domain, score, answered_at.isoformat())
+
+
+def finish_params(test_id: str, finished_at: datetime) -> Tuple:
+    return (finished_at.isoformat(), test_id)
+
+
+def execute_batch(statements: Iterable[Tuple[str, Sequence[object]]], path: Optional[Path] = None) -> int:
+    """Run ``(sql, params)`` pairs in one transaction and return how many ran."""
+
+    count = 0
+    with _connect(path) as connection:
+        for sql, params in statements:
+            connection.execute(sql, params)
+            count += 1
+    return count
 
 
 def record_test_start(
@@ -69,77 +361,252 @@ def record_test_start(
 ) -> None:
     with _connect() as connection:
         connection.execute(
-            """
-            INSERT INTO tests (id, first_name, last_name, start_level, started_at, current_part, paused)
-            VALUES (?, ?, ?, ?, ?, ?, 1)
-            ON CONFLICT(id) DO UPDATE SET
-                first_name=excluded.first_name,
-                last_name=excluded.last_name,
-                start_level=excluded.start_level,
-                started_at=excluded.started_at,
-                current_part=excluded.current_part,
-                paused=1,
-                finished_at=NULL
-            """,
-            (
-                test_id,
-                first_name,
-                last_name,
-                start_level,
-                started_at.isoformat(),
-                upcoming_part,
-            ),
+            TEST_START_SQL,
+            start_params(test_id, first_name, last_name, start_level, started_at, upcoming_part),
         )
-        connection.commit()
 
 
 def update_test_state(test_id: str, current_part: Optional[str], paused: bool) -> None:
     with _connect() as connection:
-        connection.execute(
-            """
-            UPDATE tests
-               SET current_part = ?,
-                   paused = ?
-             WHERE id = ?
-            """,
-            (current_part, int(paused), test_id),
-        )
-        connection.commit()
+        connection.execute(TEST_STATE_SQL, state_params(test_id, current_part, paused))
 
 
 def record_response(test_id: str, item_id: str, domain: str, score: float, answered_at: datetime) -> None:
     with _connect() as connection:
-        connection.execute(
+        connection.execute(RESPONSE_SQL, response_params(test_id, item_id, domain, score, answered_at))
+
+
+def record_response_at(
+    position: int,
+    test_id: str,
+    item_id: str,
+    domain: str,
+    score: float,
+    answered_at: datetime,
+    path: Optional[Path] = None,
+) -> bool:
+    """Record the answer at ``position`` of the test's response log, unless that position is taken.
+
+    The count and the insert run in one immediate transaction, so of two
+    processes recording the same position only one succeeds.
+    """
+
+    connection = _connect(path)
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        cursor = connection.execute(
+            RESPONSE_AT_SQL, (*response_params(test_id, item_id, domain, score, answered_at), test_id, position)
+        )
+    return cursor.rowcount == 1
+
+
+def record_play_at(play: int, test_id: str, item_id: str, played_at: datetime, path: Optional[Path] = None) -> bool:
+    """Register play ``play`` of an item unless it, or a later one, is already registered."""
+
+    with _connect(path) as connection:
+        cursor = connection.execute(PLAY_AT_SQL, (test_id, item_id, play, played_at.isoformat()))
+    return cursor.rowcount == 1
+
+
+def play_state(test_id: str, item_id: str, path: Optional[Path] = None) -> Tuple[int, bool]:
+    """The latest registered play of an item and whether the test has answered it."""
+
+    row = (
+        _read(path)
+        .execute(
             """
-            INSERT INTO responses (test_id, item_id, domain, score, answered_at)
-            VALUES (?, ?, ?, ?, ?)
+            SELECT (SELECT play FROM plays WHERE test_id = ? AND item_id = ?),
+                   EXISTS (SELECT 1 FROM responses WHERE test_id = ? AND item_id = ?)
             """,
-            (test_id, item_id, domain, score, answered_at.isoformat()),
+            (test_id, item_id, test_id, item_id),
         )
-        connection.commit()
+        .fetchone()
+    )
+    return int(row[0] or 0), bool(row[1])
 
 
 def record_test_finish(test_id: str, finished_at: datetime) -> None:
     with _connect() as connection:
+        connection.execute(TEST_FINISH_SQL, finish_params(test_id, finished_at))
+
+
+def save_session_blob(session_id: str, state: bytes, finished: bool, path: Optional[Path] = None) -> None:
+    with _connect(path) as connection:
         connection.execute(
             """
-            UPDATE tests
-               SET finished_at = ?,
-                   paused = 0,
-                   current_part = NULL
-             WHERE id = ?
+            INSERT INTO session_blobs (id, state, finished, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                state=excluded.state,
+                finished=excluded.finished,
+                updated_at=excluded.updated_at
             """,
-            (finished_at.isoformat(), test_id),
+            (session_id, state, int(finished), datetime.utcnow().isoformat()),
         )
-        connection.commit()
+
+
+def load_session_blob(session_id: str, path: Optional[Path] = None) -> Optional[bytes]:
+    row = _connect(path).execute("SELECT state FROM session_blobs WHERE id = ?", (session_id,)).fetchone()
+    return None if row is None else bytes(row[0])
+
+
+def delete_session_blob(session_id: str, path: Optional[Path] = None) -> None:
+    with _connect(path) as connection:
+        connection.execute("DELETE FROM session_blobs WHERE id = ?", (session_id,))
+
+
+def iter_session_blobs(path: Optional[Path] = None, batch: int = 256) -> Iterator[sqlite3.Row]:
+    """Stored session blobs in ``batch``-sized pages, for journal compaction.
+
+    Only one page is in memory at a time, and no read transaction stays open
+    between pages.
+    """
+
+    last = 0
+    while True:
+        rows = (
+            _read(path)
+            .execute(
+                "SELECT rowid, id, state, finished FROM session_blobs WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last, batch),
+            )
+            .fetchall()
+        )
+        yield from rows
+        if len(rows) < batch:
+            return
+        last = rows[-1]["rowid"]
+
+
+def count_session_blobs(exclude: Iterable[str] = (), path: Optional[Path] = None) -> int:
+    """Number of stored session blobs whose id is not in ``exclude``."""
+
+    connection = _read(path)
+    (total,) = connection.execute("SELECT COUNT(*) FROM session_blobs").fetchone()
+    ids = list(exclude)
+    # Stay below SQLite's limit on bound parameters.
+    for start in range(0, len(ids), 500):
+        chunk = ids[start : start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        (matched,) = connection.execute(
+            f"SELECT COUNT(*) FROM session_blobs WHERE id IN ({placeholders})", chunk
+        ).fetchone()
+        total -= matched
+    return int(total)
+
+
+def clear_session_blobs(path: Optional[Path] = None) -> None:
+    with _connect(path) as connection:
+        connection.execute("DELETE FROM session_blobs")
+
+
+def items_version(path: Optional[Path] = None) -> int:
+    """Highest version stamp in the ``items`` table (``0`` when empty)."""
+
+    row = _read(path).execute("SELECT COALESCE(MAX(version), 0) FROM items").fetchone()
+    return int(row[0])
+
+
+def upsert_items(rows: Iterable[Mapping[str, object]], path: Optional[Path] = None) -> int:
+    """Insert or update item rows and return the version stamp they were written with.
+
+    Rows whose content is unchanged keep their previous version, so incremental
+    reloads only pick up items that actually changed.
+    """
+
+    columns = ", ".join(ITEM_COLUMNS)
+    placeholders = ", ".join("?" for _ in ITEM_COLUMNS)
+    updates = ", ".join(f"{name}=excluded.{name}" for name in ITEM_COLUMNS[1:])
+    changed = " OR ".join(f"items.{name} IS NOT excluded.{name}" for name in ITEM_COLUMNS[1:])
+    with _connect(path) as connection:
+        version = int(connection.execute("SELECT COALESCE(MAX(version), 0) FROM items").fetchone()[0]) + 1
+        created_at = datetime.utcnow().isoformat()
+        connection.executemany(
+            f"""
+            INSERT INTO items ({columns}, active, version, created_at)
+            VALUES ({placeholders}, 1, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                {updates},
+                active=1,
+                version=excluded.version
+            WHERE items.active = 0 OR {changed}
+            """,
+            ([row[name] for name in ITEM_COLUMNS] + [version, created_at] for row in rows),
+        )
+    return version
+
+
+def retire_items(item_ids: Sequence[str], path: Optional[Path] = None) -> int:
+    """Mark items inactive with a new version stamp so reloads drop them."""
+
+    with _connect(path) as connection:
+        version = int(connection.execute("SELECT COALESCE(MAX(version), 0) FROM items").fetchone()[0]) + 1
+        connection.executemany(
+            "UPDATE items SET active = 0, version = ? WHERE id = ? AND active = 1",
+            ((version, item_id) for item_id in item_ids),
+        )
+    return version
+
+
+def fetch_items(
+    domain: Optional[str] = None,
+    since_version: int = 0,
+    path: Optional[Path] = None,
+) -> List[sqlite3.Row]:
+    """Load item rows in one query, optionally for a domain or changed rows only.
+
+    A full domain load is ordered by difficulty and uses the ``(domain, irt_b)``
+    index; otherwise rows come back in insertion order. Incremental loads
+    (``since_version > 0``) include retired rows so callers can drop them.
+    """
+
+    clauses = ["version > ?"]
+    params: List[object] = [since_version]
+    if since_version == 0:
+        clauses.append("active = 1")
+    if domain is not None:
+        clauses.append("domain = ?")
+        params.append(domain)
+    order = "irt_b, id" if domain is not None else "rowid"
+    return _read(path).execute(
+        f"SELECT *, rowid FROM items WHERE {' AND '.join(clauses)} ORDER BY {order}",
+        params,
+    ).fetchall()
 
 
 __all__ = [
+    "ConnectionPool",
     "DB_PATH",
+    "ITEM_COLUMNS",
+    "PLAY_AT_SQL",
+    "RESPONSE_AT_SQL",
+    "RESPONSE_SQL",
+    "TEST_FINISH_SQL",
+    "TEST_START_SQL",
+    "TEST_STATE_SQL",
+    "clear_session_blobs",
+    "close_connections",
+    "count_session_blobs",
+    "delete_session_blob",
+    "execute_batch",
+    "fetch_items",
+    "finish_params",
     "init_db",
+    "items_version",
+    "iter_session_blobs",
+    "load_session_blob",
+    "play_state",
+    "record_play_at",
     "record_response",
+    "record_response_at",
     "record_test_finish",
     "record_test_start",
     "reset_db",
+    "response_params",
+    "retire_items",
+    "save_session_blob",
+    "start_params",
+    "state_params",
     "update_test_state",
+    "upsert_items",
 ]
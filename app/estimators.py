@@ -0,0 +1,378 @@
+"""Incremental ability estimators attached to CAT sessions.
+
+:class:`MapEstimator` keeps the parameters of every answered item in compact
+columns so that each new answer only appends one row instead of rebuilding
+the full response history. Binary (2PL/3PL) items share one set of columns
+because the 2PL is the 3PL with ``c = 0``; GPCM items keep their own columns
+with step difficulties padded to a common width.
+
+:class:`EapEstimator` instead keeps a posterior over a fixed quadrature grid
+and multiplies in one precomputed likelihood column per answer, so theta and
+SE come from the posterior moments without any iteration.
+"""
+from __future__ import annotations
+
+from array import array
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+import math
+import threading
+
+from app.item_matrix import MODEL_GPCM, item_steps, model_code, np
+
+if TYPE_CHECKING:  # pragma: no cover - imported for type hints only
+    from app.cat_engine import Item
+
+
+_EPS = 1e-9
+
+
+class MapEstimator:
+    """Maximum a posteriori estimator that grows one answer at a time.
+
+    :meth:`estimate` warm-starts Newton-Raphson from the previous theta and
+    falls back to bisection on the score function when the second derivative
+    degenerates or Newton stops making progress.
+    """
+
+    def __init__(self, prior_mu: float, prior_sigma: float) -> None:
+        self.prior_mu = prior_mu
+        self.prior_sigma = prior_sigma
+        self.count = 0
+        self._bin_a = array("d")
+        self._bin_b = array("d")
+        self._bin_c = array("d")
+        self._bin_score = array("d")
+        self._gpcm_a = array("d")
+        self._gpcm_score = array("d")
+        self._gpcm_counts = array("B")
+        self._gpcm_steps = array("d")
+        self._gpcm_width = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, item: "Item", score: float) -> None:
+        """Append the answer to ``item`` to the estimator state."""
+
+        self.count += 1
+        if model_code(item.model) == MODEL_GPCM:
+            steps = item_steps(item)
+            if len(steps) > self._gpcm_width:
+                self._repad_steps(len(steps))
+            self._gpcm_a.append(float(item.irt_a))
+            self._gpcm_score.append(float(score))
+            self._gpcm_counts.append(len(steps))
+            self._gpcm_steps.extend(steps)
+            self._gpcm_steps.extend([0.0] * (self._gpcm_width - len(steps)))
+            return
+        self._bin_a.append(float(item.irt_a))
+        self._bin_b.append(float(item.irt_b))
+        self._bin_c.append(float(item.irt_c))
+        self._bin_score.append(float(score))
+
+    def _repad_steps(self, width: int) -> None:
+        previous = self._gpcm_width
+        padded = array("d")
+        for row in range(len(self._gpcm_a)):
+            padded.extend(self._gpcm_steps[row * previous : (row + 1) * previous])
+            padded.extend([0.0] * (width - previous))
+        self._gpcm_steps = padded
+        self._gpcm_width = width
+
+    def log_likelihood_derivatives(self, theta: float) -> Tuple[float, float]:
+        """First and second derivatives of the log-likelihood at ``theta``."""
+
+        if np is not None:
+            return self._derivatives_numpy(theta)
+        return self._derivatives_python(theta)
+
+    def information(self, theta: float) -> float:
+        """Total Fisher information of the answered items at ``theta``."""
+
+        total = 0.0
+        exp = math.exp
+        for a, b, c in zip(self._bin_a, self._bin_b, self._bin_c):
+            base = _logistic(a * (theta - b), exp)
+            p = min(max(c + (1.0 - c) * base, _EPS), 1.0 - _EPS)
+            total += a * a * ((p - c) ** 2 / max((1.0 - c) ** 2, _EPS)) * ((1.0 - p) / p)
+        for row, a in enumerate(self._gpcm_a):
+            _, variance = self._gpcm_moments(row, theta)
+            total += a * a * variance
+        return total
+
+    def estimate(self, theta: float, max_iter: int = 25, tolerance: float = 1e-4) -> Tuple[float, float]:
+        """Return the MAP theta and its standard error, starting from ``theta``."""
+
+        variance = self.prior_sigma ** 2
+        converged = False
+        for _ in range(max_iter):
+            ll1, ll2 = self.log_likelihood_derivatives(theta)
+            numerator = ll1 + (self.prior_mu - theta) / variance
+            denominator = ll2 - 1.0 / variance
+            if abs(denominator) < 1e-6:
+                break
+            theta_new = theta - numerator / denominator
+            if not math.isfinite(theta_new):
+                break
+            if abs(theta_new - theta) < tolerance:
+                theta = theta_new
+                converged = True
+                break
+            theta = theta_new
+        if not converged:
+            theta = self._bisect(theta, tolerance)
+        info = self.information(theta)
+        se = 1.0 / math.sqrt(info) if info > 0 else float("inf")
+        return theta, se
+
+    def _gradient(self, theta: float) -> float:
+        ll1, _ = self.log_likelihood_derivatives(theta)
+        return ll1 + (self.prior_mu - theta) / (self.prior_sigma ** 2)
+
+    def _bisect(self, theta: float, tolerance: float) -> float:
+        if not math.isfinite(theta):
+            theta = self.prior_mu
+        low, high = theta - 1.0, theta + 1.0
+        width = 1.0
+        while self._gradient(low) < 0.0 and width < 64.0:
+            width *= 2.0
+            low = theta - width
+        width = 1.0
+        while self._gradient(high) > 0.0 and width < 64.0:
+            width *= 2.0
+            high = theta + width
+        while high - low > tolerance:
+            middle = 0.5 * (low + high)
+            if self._gradient(middle) > 0.0:
+                low = middle
+            else:
+                high = middle
+        return 0.5 * (low + high)
+
+    def _gpcm_moments(self, row: int, theta: float) -> Tuple[float, float]:
+        a = self._gpcm_a[row]
+        offset = row * self._gpcm_width
+        eta = [0.0]
+        cumulative = 0.0
+        for step in self._gpcm_steps[offset : offset + self._gpcm_counts[row]]:
+            cumulative += a * (theta - step)
+            eta.append(cumulative)
+        top = max(eta)
+        exps = [math.exp(value - top) for value in eta]
+        denom = sum(exps)
+        probs = [value / denom for value in exps]
+        expected = sum(idx * prob for idx, prob in enumerate(probs))
+        variance = sum(((idx - expected) ** 2) * prob for idx, prob in enumerate(probs))
+        return expected, variance
+
+    def _derivatives_python(self, theta: float) -> Tuple[float, float]:
+        first = 0.0
+        second = 0.0
+        exp = math.exp
+        for a, b, c, score in zip(self._bin_a, self._bin_b, self._bin_c, self._bin_score):
+            base = _logistic(a * (theta - b), exp)
+            p = c + (1.0 - c) * base
+            slope = (1.0 - c) * a * base * (1.0 - base)
+            curvature = slope * a * (1.0 - 2.0 * base)
+            p = min(max(p, _EPS), 1.0 - _EPS)
+            spread = p * (1.0 - p)
+            residual = score - p
+            first += residual * slope / spread
+            second += (-slope * slope + residual * curvature) / spread - (
+                residual * slope * slope * (1.0 - 2.0 * p)
+            ) / (spread * spread)
+        for row, (a, score) in enumerate(zip(self._gpcm_a, self._gpcm_score)):
+            expected, variance = self._gpcm_moments(row, theta)
+            first += a * (score - expected)
+            second -= a * a * variance
+        return first, second
+
+    def _derivatives_numpy(self, theta: float) -> Tuple[float, float]:
+        first = 0.0
+        second = 0.0
+        if self._bin_a:
+            a = np.frombuffer(self._bin_a, dtype=np.float64)
+            b = np.frombuffer(self._bin_b, dtype=np.float64)
+            c = np.frombuffer(self._bin_c, dtype=np.float64)
+            score = np.frombuffer(self._bin_score, dtype=np.float64)
+            base = 1.0 / (1.0 + np.exp(np.clip(-a * (theta - b), -700.0, 700.0)))
+            slope = (1.0 - c) * a * base * (1.0 - base)
+            curvature = slope * a * (1.0 - 2.0 * base)
+            p = np.clip(c + (1.0 - c) * base, _EPS, 1.0 - _EPS)
+            spread = p * (1.0 - p)
+            residual = score - p
+            first += float(np.sum(residual * slope / spread))
+            second += float(
+                np.sum(
+                    (-slope * slope + residual * curvature) / spread
+                    - residual * slope * slope * (1.0 - 2.0 * p) / (spread * spread)
+                )
+            )
+        if self._gpcm_a:
+            count = len(self._gpcm_a)
+            width = self._gpcm_width
+            a = np.frombuffer(self._gpcm_a, dtype=np.float64)
+            score = np.frombuffer(self._gpcm_score, dtype=np.float64)
+            steps = np.frombuffer(self._gpcm_steps, dtype=np.float64).reshape(count, width)
+            counts = np.frombuffer(self._gpcm_counts, dtype=np.uint8).astype(np.int64)
+            valid = np.arange(width)[None, :] < counts[:, None]
+            increments = np.where(valid, a[:, None] * (theta - steps), 0.0)
+            eta = np.concatenate([np.zeros((count, 1)), np.cumsum(increments, axis=1)], axis=1)
+            categories = np.concatenate([np.ones((count, 1), dtype=bool), valid], axis=1)
+            eta = np.where(categories, eta, -np.inf)
+            exps = np.exp(eta - eta.max(axis=1, keepdims=True))
+            probs = exps / exps.sum(axis=1, keepdims=True)
+            scores = np.arange(width + 1, dtype=np.float64)[None, :]
+            expected = (probs * scores).sum(axis=1)
+            variance = (((scores - expected[:, None]) ** 2) * probs).sum(axis=1)
+            first += float(np.sum(a * (score - expected)))
+            second -= float(np.sum(a * a * variance))
+        return first, second
+
+
+def _logistic(value: float, exp=math.exp) -> float:
+    if value >= 0:
+        return 1.0 / (1.0 + exp(-value))
+    z = exp(value)
+    return z / (1.0 + z)
+
+
+class EapGrid:
+    """Quadrature grid with per-item likelihood columns for EAP scoring.
+
+    :class:`~app.cat_engine.ItemBank` hands its items to the grid, whose
+    columns are then built once, by the first :class:`EapEstimator` of the
+    bank (:meth:`prepare`); banks only scored with MAP never pay for them.
+    Columns for items outside the bank are built on first use and published
+    under a lock. Every session that shares the bank reuses them, and a new
+    bank gets a fresh grid.
+    """
+
+    def __init__(
+        self, lower: float = -5.0, upper: float = 5.0, points: int = 121, items: Sequence["Item"] = ()
+    ) -> None:
+        step = (upper - lower) / (points - 1)
+        self.points: Sequence[float] = array("d", (lower + idx * step for idx in range(points)))
+        self._columns: Dict[str, List[Sequence[float]]] = {}
+        self._lock = threading.Lock()
+        # Items whose columns :meth:`prepare` still has to build.
+        self._pending: Optional[Sequence["Item"]] = items or None
+        self._prepare_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def prior(self, mu: float, sigma: float) -> Sequence[float]:
+        """Normalised normal prior evaluated on the grid."""
+
+        weights = [math.exp(-0.5 * ((point - mu) / sigma) ** 2) for point in self.points]
+        total = sum(weights)
+        return _as_vector([weight / total for weight in weights])
+
+    def columns(self, item: "Item") -> List[Sequence[float]]:
+        """Likelihood column for every score category of ``item``."""
+
+        cached = self._columns.get(item.id)
+        if cached is None:
+            built = self._build_columns(item)
+            with self._lock:
+                cached = self._columns.setdefault(item.id, built)
+        return cached
+
+    def precompute(self, items: Sequence["Item"]) -> None:
+        """Eagerly build the columns for ``items`` before the grid is shared."""
+
+        for item in items:
+            self.columns(item)
+
+    def prepare(self) -> None:
+        """Build the columns of the grid's items, once; later calls return at once."""
+
+        if self._pending is None:
+            return
+        with self._prepare_lock:
+            if self._pending is not None:
+                self.precompute(self._pending)
+                self._pending = None
+
+    def column(self, item: "Item", score: float) -> Sequence[float]:
+        columns = self.columns(item)
+        category = min(max(int(round(score)), 0), len(columns) - 1)
+        return columns[category]
+
+    def _build_columns(self, item: "Item") -> List[Sequence[float]]:
+        if model_code(item.model) == MODEL_GPCM:
+            steps = item_steps(item)
+            rows: List[List[float]] = [[] for _ in range(len(steps) + 1)]
+            for theta in self.points:
+                eta = [0.0]
+                cumulative = 0.0
+                for step in steps:
+                    cumulative += item.irt_a * (theta - step)
+                    eta.append(cumulative)
+                top = max(eta)
+                exps = [math.exp(value - top) for value in eta]
+                denom = sum(exps)
+                for category, value in enumerate(exps):
+                    rows[category].append(value / denom)
+            return [_as_vector(row) for row in rows]
+        c = item.irt_c
+        success = [
+            min(max(c + (1.0 - c) * _logistic(item.irt_a * (theta - item.irt_b)), _EPS), 1.0 - _EPS)
+            for theta in self.points
+        ]
+        return [_as_vector([1.0 - p for p in success]), _as_vector(success)]
+
+
+class EapEstimator:
+    """Expected a posteriori estimator with multiplicative posterior updates."""
+
+    def __init__(self, grid: EapGrid, prior_mu: float, prior_sigma: float) -> None:
+        grid.prepare()
+        self.grid = grid
+        self.prior_mu = prior_mu
+        self.prior_sigma = prior_sigma
+        self.count = 0
+        self.posterior = grid.prior(prior_mu, prior_sigma)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, item: "Item", score: float) -> None:
+        """Multiply the posterior by the likelihood of ``score`` on ``item``."""
+
+        self.count += 1
+        column = self.grid.column(item, score)
+        if np is not None:
+            updated = self.posterior * column
+            total = float(updated.sum())
+            self.posterior = updated / total if total > 0 else self.grid.prior(self.prior_mu, self.prior_sigma)
+            return
+        updated = [weight * value for weight, value in zip(self.posterior, column)]
+        total = sum(updated)
+        if total > 0:
+            self.posterior = [weight / total for weight in updated]
+        else:  # pragma: no cover - only reachable with degenerate parameters
+            self.posterior = self.grid.prior(self.prior_mu, self.prior_sigma)
+
+    def estimate(self, theta: float = 0.0, max_iter: int = 0, tolerance: float = 0.0) -> Tuple[float, float]:
+        """Posterior mean and standard deviation; the arguments are ignored."""
+
+        points = self.grid.points
+        if np is not None:
+            grid = np.frombuffer(points, dtype=np.float64)
+            mean = float(np.dot(self.posterior, grid))
+            variance = float(np.dot(self.posterior, (grid - mean) ** 2))
+        else:
+            mean = sum(weight * point for weight, point in zip(self.posterior, points))
+            variance = sum(weight * (point - mean) ** 2 for weight, point in zip(self.posterior, points))
+        return mean, math.sqrt(variance) if variance > 0 else float("inf")
+
+
+def _as_vector(values: List[float]) -> Sequence[float]:
+    if np is not None:
+        return np.array(values, dtype=np.float64)
+    return array("d", values)
+
+
+__all__ = ["EapEstimator", "EapGrid", "MapEstimator"]
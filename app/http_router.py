@@ -2,23 +2,37 @@
 from __future__ import annotations
 
 import json
-import mimetypes
 from pathlib import Path
-from typing import Dict, Tuple
-from urllib.parse import urlparse
+from typing import Dict, Mapping, Optional, Tuple, Union
+from urllib.parse import unquote, urlparse
 from uuid import UUID
 
+from .media import FileRegion, MediaAccessDenied, file_response
 from .service import AdaptiveTestService
+from .session_locks import LockBusy
+from .session_token import TOKEN_HEADER
+from .static_assets import assets_from_env
 
 BASE_DIR = Path(__file__).resolve().parent
 TEMPLATE_DIR = BASE_DIR / "templates"
 STATIC_DIR = BASE_DIR / "static"
 
 _service = AdaptiveTestService()
+ASSETS = assets_from_env(STATIC_DIR, TEMPLATE_DIR)
+ASSETS.preload()
+
+# Routes that hand events to the write-behind queue.
+_RECORDING_ACTIONS = frozenset({"answer", "play", "resume", "finish"})
+
+# Audio responses carry a file region that servers send with ``sendfile``.
+Body = Union[bytes, FileRegion]
 
 
 def _json_response(payload: Dict[str, object], status: int = 200) -> Tuple[int, Dict[str, str], bytes]:
-    body = json.dumps(payload).encode("utf-8")
+    return _raw_json_response(json.dumps(payload).encode("utf-8"), status=status)
+
+
+def _raw_json_response(body: bytes, status: int = 200) -> Tuple[int, Dict[str, str], bytes]:
     headers = {
         "Content-Type": "application/json; charset=utf-8",
         "Content-Length": str(len(body)),
@@ -30,28 +44,11 @@ def _json_error(message: str, status: int = 400) -> Tuple[int, Dict[str, str], b
     return _json_response({"detail": message}, status=status)
 
 
-def _serve_static(path: str) -> Tuple[int, Dict[str, str], bytes]:
-    if path in ("", "/"):
-        file_path = TEMPLATE_DIR / "index.html"
-    elif path.startswith("/static/"):
-        candidate = (STATIC_DIR / path[len("/static/") :]).resolve()
-        static_root = STATIC_DIR.resolve()
-        if not str(candidate).startswith(str(static_root)):
-            return _json_error("Not found", status=404)
-        file_path = candidate
-    else:
-        return _json_error("Not found", status=404)
-
-    if not file_path.exists() or not file_path.is_file():
+def _serve_static(path: str, headers: Optional[Mapping[str, str]] = None) -> Tuple[int, Dict[str, str], bytes]:
+    reply = ASSETS.respond(path, headers)
+    if reply is None:
         return _json_error("Not found", status=404)
-
-    content = file_path.read_bytes()
-    content_type, _ = mimetypes.guess_type(str(file_path))
-    headers = {
-        "Content-Type": (content_type or "application/octet-stream"),
-        "Content-Length": str(len(content)),
-    }
-    return 200, headers, content
+    return reply
 
 
 def _parse_json_body(body: bytes) -> Dict[str, object]:
@@ -63,17 +60,110 @@ def _parse_json_body(body: bytes) -> Dict[str, object]:
         raise ValueError("Invalid JSON body") from exc
 
 
-def dispatch(method: str, raw_path: str, body: bytes) -> Tuple[int, Dict[str, str], bytes]:
-    """Dispatch an HTTP request and return a status, headers, and body."""
+def _header(headers: Optional[Mapping[str, str]], name: str) -> Optional[str]:
+    if not headers:
+        return None
+    return headers.get(name) or headers.get(name.lower())
+
+
+_TEST_ACTIONS = frozenset({"next", "resume", "answer", "play", "finish"})
+
+
+def route_name(method: str, raw_path: str) -> str:
+    """Route template of a request for metrics, e.g. ``POST /api/test/{id}/answer``."""
+    path = urlparse(raw_path).path
+    parts = [part for part in path.strip("/").split("/") if part]
+    if not parts or parts[0] != "api":
+        template = "/static/*" if path.startswith("/static/") else ("/" if not parts else "*")
+    elif len(parts) == 3 and parts[1:] == ["test", "start"]:
+        template = path
+    elif len(parts) == 4 and parts[1] == "test" and parts[3] in _TEST_ACTIONS:
+        template = f"/api/test/{{id}}/{parts[3]}"
+    elif len(parts) == 6 and parts[1] == "test" and parts[3] == "audio":
+        template = "/api/test/{id}/audio"
+    elif len(parts) == 3 and parts[1] == "report":
+        template = "/api/report/{id}"
+    elif len(parts) == 2 and parts[1] == "health":
+        template = path
+    else:
+        template = "/api/*"
+    return f"{method} {template}"
+
+
+def blocking(method: str, raw_path: str) -> bool:
+    """Whether dispatching the request may block on disk I/O or on another thread.
+
+    Asynchronous front ends run requests for which this is ``False`` (pure
+    CPU work on in-memory sessions) inline through :func:`dispatch_inline`,
+    and the rest on a thread pool. Requests that record events (start,
+    answer, play, resume, finish) always go to the pool: the write-behind
+    queue makes them wait while it is full, and finishing waits for the
+    commit. With a :class:`~app.session_store.SqliteSessionStore`, requests
+    for cold sessions, which are read back from disk, go there as well.
+    """
+    path = urlparse(raw_path).path
+    if not path.startswith("/api/"):
+        return not ASSETS.cached(path)
+    parts = [part for part in path.strip("/").split("/") if part]
+    if len(parts) == 3 and parts[1:] == ["test", "start"]:
+        return True
+    if len(parts) >= 3 and parts[1] in ("test", "report"):
+        try:
+            test_id = UUID(parts[2])
+        except ValueError:
+            return False
+        action = parts[3] if len(parts) > 3 else ""
+        if action in _RECORDING_ACTIONS or action == "audio":
+            return True  # may wait for the queue or a commit, or reads a file
+        return _service.may_block(test_id)
+    return False
+
+
+def dispatch_inline(
+    method: str,
+    raw_path: str,
+    body: bytes,
+    headers: Optional[Mapping[str, str]] = None,
+) -> Optional[Tuple[int, Dict[str, str], Body]]:
+    """:func:`dispatch` on an event-loop thread, or ``None`` if it would wait.
+
+    :func:`blocking` is only a snapshot: another thread may take the
+    session's lock between that check and this call. The lock is then not
+    waited for; the caller gets ``None`` before anything ran and dispatches
+    the request on its thread pool instead.
+    """
+    try:
+        with _service.nonblocking():
+            return dispatch(method, raw_path, body, headers)
+    except LockBusy:
+        return None
+
+
+def dispatch(
+    method: str,
+    raw_path: str,
+    body: bytes,
+    headers: Optional[Mapping[str, str]] = None,
+) -> Tuple[int, Dict[str, str], Body]:
+    """Dispatch an HTTP request and return a status, headers, and body.
+
+    ``headers`` are the request headers; the stateless session token
+    (:data:`~app.session_token.TOKEN_HEADER`) and the conditional and range
+    headers of static and audio requests are read from them. The body is a
+    :class:`~app.media.FileRegion` for audio and bytes for everything else.
+    """
     path = urlparse(raw_path).path
 
     if not path.startswith("/api/"):
-        return _serve_static(path)
+        return _serve_static(path, headers)
 
     parts = [part for part in path.strip("/").split("/") if part]
     if len(parts) < 2 or parts[0] != "api":
         return _json_error("Not found", status=404)
 
+    if parts[1] == "health" and len(parts) == 2:
+        return _json_response({"status": "ok"})
+
     if parts[1] == "test":
         if len(parts) == 3 and parts[2] == "start":
             if method != "POST":
@@ -93,12 +183,23 @@ def dispatch(method: str, raw_path: str, body: bytes) -> Tuple[int, Dict[str, st
                 return _json_error("Invalid test id")
 
             action = parts[3]
+            token = _header(headers, TOKEN_HEADER)
+            if action == "audio" and len(parts) == 6:
+                if method not in ("GET", "HEAD"):
+                    return _json_error("Method not allowed", status=405)
+                try:
+                    path, limit = _service.audio_file(test_id, unquote(parts[4]), parts[5])
+                    return file_response(path, headers, limit)
+                except MediaAccessDenied as exc:
+                    return _json_error(str(exc), status=403)
+                except (ValueError, FileNotFoundError) as exc:
+                    return _json_error(str(exc) if isinstance(exc, ValueError) else "Audio not found", status=404)
+
             if action == "next" and len(parts) == 4:
                 if method != "GET":
                     return _json_error("Method not allowed", status=405)
                 try:
-                    data = _service.get_next_item(test_id)
-                    return _json_response(data)
+                    return _raw_json_response(_service.get_next_item_json(test_id, token=token))
                 except ValueError as exc:
                     return _json_error(str(exc), status=404)
 
@@ -106,7 +207,7 @@ def dispatch(method: str, raw_path: str, body: bytes) -> Tuple[int, Dict[str, st
                 if method != "POST":
                     return _json_error("Method not allowed", status=405)
                 try:
-                    data = _service.resume_section(test_id)
+                    data = _service.resume_section(test_id, token=token)
                     return _json_response(data)
                 except ValueError as exc:
                     return _json_error(str(exc))
@@ -116,7 +217,7 @@ def dispatch(method: str, raw_path: str, body: bytes) -> Tuple[int, Dict[str, st
                     return _json_error("Method not allowed", status=405)
                 try:
                     payload = _parse_json_body(body)
-                    data = _service.submit_answer(test_id, payload)
+                    data = _service.submit_answer(test_id, payload, token=token)
                     return _json_response(data)
                 except ValueError as exc:
                     return _json_error(str(exc))
@@ -126,7 +227,7 @@ def dispatch(method: str, raw_path: str, body: bytes) -> Tuple[int, Dict[str, st
                     return _json_error("Method not allowed", status=405)
                 try:
                     payload = _parse_json_body(body)
-                    data = _service.record_play(test_id, payload)
+                    data = _service.record_play(test_id, payload, token=token)
                     return _json_response(data)
                 except ValueError as exc:
                     return _json_error(str(exc))
@@ -138,7 +239,7 @@ def dispatch(method: str, raw_path: str, body: bytes) -> Tuple[int, Dict[str, st
                     payload = _parse_json_body(body)
                     if payload and not payload.get("confirm", True):
                         return _json_error("Finish confirmation required")
-                    data = _service.finish_test(test_id)
+                    data = _service.finish_test(test_id, token=token)
                     return _json_response(data)
                 except ValueError as exc:
                     return _json_error(str(exc))
@@ -151,7 +252,7 @@ def dispatch(method: str, raw_path: str, body: bytes) -> Tuple[int, Dict[str, st
         except ValueError:
             return _json_error("Invalid test id")
         try:
-            data = _service.get_report(test_id)
+            data = _service.get_report(test_id, token=_header(headers, TOKEN_HEADER))
             return _json_response(data)
         except ValueError as exc:
             return _json_error(str(exc))
@@ -159,4 +260,4 @@ def dispatch(method: str, raw_path: str, body: bytes) -> Tuple[int, Dict[str, st
     return _json_error("Not found", status=404)
 
 
-__all__ = ["dispatch"]
+__all__ = ["Body", "blocking", "dispatch", "dispatch_inline", "route_name"]
@@ -0,0 +1,449 @@
+"""Column-oriented item parameter storage used for batched CAT calculations.
+
+Each :class:`ItemMatrix` keeps the IRT parameters of one domain as parallel
+columns (``a``, ``b``, ``c``, model code and padded GPCM steps) so that the
+Fisher information of every candidate can be evaluated in a single pass.
+NumPy is used when it is installed; otherwise the columns are stored in
+:mod:`array` buffers and evaluated with a tight pure-Python loop.
+"""
+from __future__ import annotations
+
+from array import array
+from bisect import bisect_left
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple
+import heapq
+import math
+
+try:  # pragma: no cover - exercised only when numpy is installed
+    import numpy as np
+except ImportError:  # pragma: no cover - optional dependency
+    np = None
+
+if TYPE_CHECKING:  # pragma: no cover - imported for type hints only
+    from app.cat_engine import Item
+
+
+MODEL_2PL = 0
+MODEL_3PL = 1
+MODEL_GPCM = 2
+
+MODEL_CODES: Dict[str, int] = {"2pl": MODEL_2PL, "3pl": MODEL_3PL, "gpcm": MODEL_GPCM}
+
+_EPS = 1e-9
+# Root of x * tanh(x) = 1; a = 2x / d maximises the 2PL information at distance d.
+_ENVELOPE_ROOT = 1.1996786402577
+
+
+def model_code(model: str) -> int:
+    """Translate a model name such as ``"3PL"`` into its integer code."""
+
+    try:
+        return MODEL_CODES[model.lower()]
+    except KeyError as exc:
+        raise ValueError(f"Unsupported model: {model}") from exc
+
+
+def item_steps(item: "Item") -> List[float]:
+    """Return the GPCM step difficulties used for ``item``.
+
+    Mirrors :func:`app.cat_engine.gpcm_probabilities`, which derives evenly
+    spaced steps around ``irt_b`` when none were calibrated.
+    """
+
+    if item.step_difficulties:
+        return [float(step) for step in item.step_difficulties]
+    return [item.irt_b + (idx - 0.5) * 0.2 for idx in range(len(item.correct_response()))]
+
+
+class ItemMatrix:
+    """Struct-of-arrays view over the items of a single domain."""
+
+    def __init__(self, items: Iterable["Item"]) -> None:
+        self.items: List["Item"] = list(items)
+        self.index: Dict[str, int] = {item.id: idx for idx, item in enumerate(self.items)}
+        count = len(self.items)
+        steps = [item_steps(item) if model_code(item.model) == MODEL_GPCM else [] for item in self.items]
+        self.step_width = max((len(row) for row in steps), default=0)
+
+        a = array("d", (float(item.irt_a) for item in self.items))
+        b = array("d", (float(item.irt_b) for item in self.items))
+        c = array("d", (float(item.irt_c) for item in self.items))
+        models = array("b", (model_code(item.model) for item in self.items))
+        step_counts = array("B", (len(row) for row in steps))
+        padded = array("d", bytes(8 * count * self.step_width))
+        for row_index, row in enumerate(steps):
+            offset = row_index * self.step_width
+            for step_index, step in enumerate(row):
+                padded[offset + step_index] = step
+
+        if np is not None:
+            self.a = np.array(a, dtype=np.float64)
+            self.b = np.array(b, dtype=np.float64)
+            self.c = np.array(c, dtype=np.float64)
+            self.models = np.array(models, dtype=np.int8)
+            self.step_counts = np.array(step_counts, dtype=np.uint8)
+            self.steps = np.array(padded, dtype=np.float64).reshape(count, self.step_width)
+            self._groups = {
+                code: np.flatnonzero(self.models == code) for code in (MODEL_2PL, MODEL_3PL, MODEL_GPCM)
+            }
+        else:
+            self.a, self.b, self.c = a, b, c
+            self.models = models
+            self.step_counts = step_counts
+            self.steps = padded
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def seen_mask(self, seen_ids: Iterable[str]) -> bytearray:
+        """Return a byte mask with ``1`` for every item whose id is in ``seen_ids``."""
+
+        mask = bytearray(len(self.items))
+        index = self.index
+        for item_id in seen_ids:
+            position = index.get(item_id)
+            if position is not None:
+                mask[position] = 1
+        return mask
+
+    def information(self, theta: float) -> Sequence[float]:
+        """Fisher information of every item at ``theta`` computed in one batch."""
+
+        if np is not None:
+            return self._information_numpy(theta)
+        return self._information_python(theta)
+
+    def best_index(self, theta: float, seen: Optional[Sequence[int]] = None) -> Optional[int]:
+        """Index of the most informative item that is not flagged in ``seen``."""
+
+        if not self.items:
+            return None
+        info = self.information(theta)
+        if np is not None:
+            if seen is not None:
+                blocked = np.frombuffer(bytes(seen), dtype=np.uint8).astype(bool)
+                if blocked.all():
+                    return None
+                info = np.where(blocked, -np.inf, info)
+            return int(np.argmax(info))
+        best: Optional[int] = None
+        best_value = -math.inf
+        for idx, value in enumerate(info):
+            if seen is not None and seen[idx]:
+                continue
+            if best is None or value > best_value:
+                best = idx
+                best_value = value
+        return best
+
+    def _information_numpy(self, theta: float):
+        info = np.zeros(len(self.items), dtype=np.float64)
+        for code, rows in self._groups.items():
+            if rows.size == 0:
+                continue
+            a = self.a[rows]
+            if code == MODEL_GPCM:
+                info[rows] = a * a * self._gpcm_variance_numpy(theta, rows)
+                continue
+            exponent = np.clip(-a * (theta - self.b[rows]), -700.0, 700.0)
+            base = 1.0 / (1.0 + np.exp(exponent))
+            if code == MODEL_2PL:
+                p = np.clip(base, _EPS, 1.0 - _EPS)
+                info[rows] = a * a * p * (1.0 - p)
+            else:
+                c = self.c[rows]
+                p = np.clip(c + (1.0 - c) * base, _EPS, 1.0 - _EPS)
+                denom = np.maximum((1.0 - c) ** 2, _EPS)
+                info[rows] = a * a * ((p - c) ** 2 / denom) * ((1.0 - p) / p)
+        return info
+
+    def _gpcm_variance_numpy(self, theta: float, rows):
+        a = self.a[rows][:, None]
+        steps = self.steps[rows]
+        counts = self.step_counts[rows].astype(np.int64)
+        width = self.step_width
+        valid = np.arange(width)[None, :] < counts[:, None]
+        increments = np.where(valid, a * (theta - steps), 0.0)
+        eta = np.concatenate([np.zeros((len(rows), 1)), np.cumsum(increments, axis=1)], axis=1)
+        categories = np.concatenate([np.ones((len(rows), 1), dtype=bool), valid], axis=1)
+        eta = np.where(categories, eta, -np.inf)
+        exps = np.exp(eta - eta.max(axis=1, keepdims=True))
+        probs = exps / exps.sum(axis=1, keepdims=True)
+        scores = np.arange(width + 1, dtype=np.float64)[None, :]
+        mean = (probs * scores).sum(axis=1, keepdims=True)
+        return (((scores - mean) ** 2) * probs).sum(axis=1)
+
+    def _information_python(self, theta: float) -> List[float]:
+        return [self.item_information(idx, theta) for idx in range(len(self.items))]
+
+    def item_information(self, idx: int, theta: float) -> float:
+        """Fisher information of the single item at ``idx``."""
+
+        a = float(self.a[idx])
+        code = int(self.models[idx])
+        exp = math.exp
+        if code == MODEL_GPCM:
+            width = self.step_width
+            offset = idx * width
+            steps = self.steps if np is None else self.steps.reshape(-1)
+            eta = [0.0]
+            cumulative = 0.0
+            for step_index in range(int(self.step_counts[idx])):
+                cumulative += a * (theta - float(steps[offset + step_index]))
+                eta.append(cumulative)
+            top = max(eta)
+            exps = [exp(value - top) for value in eta]
+            denom = sum(exps)
+            mean = 0.0
+            for score, value in enumerate(exps):
+                mean += score * value / denom
+            variance = 0.0
+            for score, value in enumerate(exps):
+                variance += (score - mean) ** 2 * value / denom
+            return a * a * variance
+        exponent = -a * (theta - float(self.b[idx]))
+        if exponent >= 0:
+            z = exp(-exponent)
+            base = z / (1.0 + z)
+        else:
+            base = 1.0 / (1.0 + exp(exponent))
+        if code == MODEL_2PL:
+            p = min(max(base, _EPS), 1.0 - _EPS)
+            return a * a * p * (1.0 - p)
+        c = float(self.c[idx])
+        p = min(max(c + (1.0 - c) * base, _EPS), 1.0 - _EPS)
+        denom = max((1.0 - c) ** 2, _EPS)
+        return a * a * ((p - c) ** 2 / denom) * ((1.0 - p) / p)
+
+
+class InformationTable:
+    """Fisher information of a domain tabulated on a fixed theta grid.
+
+    Every grid cell stores the information of each item together with the
+    item indices pre-sorted by decreasing information. Selection between two
+    cells linearly interpolates the information and walks both sorted orders
+    with a threshold bound, so it usually stops after a handful of items
+    instead of scoring the whole domain.
+    """
+
+    def __init__(self, matrix: ItemMatrix, lower: float = -4.0, upper: float = 4.0, step: float = 0.05) -> None:
+        self.matrix = matrix
+        self.lower = lower
+        self.step = step
+        self.cells = int(round((upper - lower) / step)) + 1
+        self.upper = lower + (self.cells - 1) * step
+        count = len(matrix)
+        self.values = array("d")
+        self.orders = array("I")
+        for cell in range(self.cells):
+            info = matrix.information(lower + cell * step)
+            if np is not None:
+                order = np.argsort(-np.asarray(info), kind="stable").tolist()
+            else:
+                order = sorted(range(count), key=lambda idx: -info[idx])
+            self.values.extend(info)
+            self.orders.extend(order)
+
+    def covers(self, theta: float) -> bool:
+        return self.lower <= theta <= self.upper
+
+    def information(self, theta: float, index: int) -> float:
+        """Interpolated information of item ``index`` at ``theta``."""
+
+        low, weight = self._cell(theta)
+        count = len(self.matrix)
+        high = min(low + 1, self.cells - 1)
+        values = self.values
+        return (1.0 - weight) * values[low * count + index] + weight * values[high * count + index]
+
+    def best_index(self, theta: float, seen: Optional[Sequence[int]] = None) -> Optional[int]:
+        """Most informative unseen item at ``theta`` using the tabulated values."""
+
+        count = len(self.matrix)
+        if count == 0:
+            return None
+        low, weight = self._cell(theta)
+        high = min(low + 1, self.cells - 1)
+        values, orders = self.values, self.orders
+        low_base, high_base = low * count, high * count
+        if seen is None:
+            seen = bytes(count)
+        if weight == 0.0 or high == low:
+            for position in range(low_base, low_base + count):
+                index = orders[position]
+                if not seen[index]:
+                    return index
+            return None
+        keep = 1.0 - weight
+        best: Optional[int] = None
+        best_value = -math.inf
+        i = j = 0
+        while True:
+            while i < count and seen[orders[low_base + i]]:
+                i += 1
+            while j < count and seen[orders[high_base + j]]:
+                j += 1
+            if i >= count or j >= count:
+                return best
+            first = orders[low_base + i]
+            second = orders[high_base + j]
+            bound = keep * values[low_base + first] + weight * values[high_base + second]
+            if best is not None and best_value >= bound:
+                return best
+            for index in (first, second):
+                value = keep * values[low_base + index] + weight * values[high_base + index]
+                if value > best_value or (value == best_value and best is not None and index < best):
+                    best = index
+                    best_value = value
+            i += 1
+            j += 1
+
+    def _cell(self, theta: float) -> tuple[int, float]:
+        position = (min(max(theta, self.lower), self.upper) - self.lower) / self.step
+        low = min(int(position), self.cells - 1)
+        return low, position - low
+
+
+def peak_location(a: float, b: float, c: float = 0.0) -> float:
+    """Theta at which a 2PL/3PL item is most informative."""
+
+    if c <= 0.0:
+        return b
+    return b + math.log((1.0 + math.sqrt(1.0 + 8.0 * c)) / 2.0) / a
+
+
+def information_envelope(a_low: float, a_high: float, distance: float) -> float:
+    """Upper bound on binary-item information ``distance`` away from ``b``.
+
+    The 3PL information never exceeds the 2PL information with the same
+    ``a`` and ``b``, and ``a**2 * L * (1 - L)`` is maximised over
+    ``[a_low, a_high]`` either at an end point or at ``2 * root / distance``.
+    """
+
+    if distance <= 0.0:
+        return a_high * a_high / 4.0
+    a = min(max(2.0 * _ENVELOPE_ROOT / distance, a_low), a_high)
+    half = 0.5 * a * distance
+    if half > 350.0:
+        return 0.0
+    return a * a / (4.0 * math.cosh(half) ** 2)
+
+
+class _PeakBucket:
+    __slots__ = ("peaks", "indices", "a_low", "a_high", "max_offset", "scale")
+
+    def __init__(self, entries: List[tuple[float, int, float, float, float]]) -> None:
+        entries.sort()
+        self.peaks = array("d", (entry[0] for entry in entries))
+        self.indices = array("I", (entry[1] for entry in entries))
+        self.a_low = min(entry[2] for entry in entries)
+        self.a_high = max(entry[2] for entry in entries)
+        self.max_offset = max(entry[3] for entry in entries)
+        # 3PL information is at most (1 - c) times the matching 2PL information.
+        self.scale = 1.0 - min(entry[4] for entry in entries)
+
+    def bound(self, position: int, theta: float) -> float:
+        distance = max(abs(self.peaks[position] - theta) - self.max_offset, 0.0)
+        envelope = information_envelope(self.a_low, self.a_high, distance)
+        return self.scale * envelope + self.a_high * self.a_high * _EPS
+
+
+class PeakIndex:
+    """Binary items of a domain sorted by information peak, bucketed by ``a``.
+
+    Selection binary-searches the current theta in every bucket and expands
+    outwards in order of the bucket's information bound. The search stops as
+    soon as the best exact information found so far beats every remaining
+    bound, which proves that no item outside the scored window can win.
+    GPCM items have no closed-form peak and are always scored in full.
+    """
+
+    def __init__(self, matrix: ItemMatrix, bucket_width: float = 0.25) -> None:
+        self.matrix = matrix
+        self.full_scan: List[int] = []
+        grouped: Dict[int, List[tuple[float, int, float, float, float]]] = {}
+        for idx in range(len(matrix)):
+            if int(matrix.models[idx]) == MODEL_GPCM:
+                self.full_scan.append(idx)
+                continue
+            a = float(matrix.a[idx])
+            b = float(matrix.b[idx])
+            c = float(matrix.c[idx]) if int(matrix.models[idx]) != MODEL_2PL else 0.0
+            peak = peak_location(a, b, c)
+            grouped.setdefault(int(a // bucket_width), []).append((peak, idx, a, peak - b, min(max(c, 0.0), 1.0)))
+        self.buckets = [_PeakBucket(entries) for _, entries in sorted(grouped.items())]
+
+    def covers(self, theta: float) -> bool:
+        return True
+
+    def best_index(self, theta: float, seen: Optional[Sequence[int]] = None) -> Optional[int]:
+        """Most informative unseen item at ``theta`` found with a bounded search."""
+
+        return self.search(theta, seen)[0]
+
+    def search(self, theta: float, seen: Optional[Sequence[int]] = None) -> Tuple[Optional[int], int]:
+        """:meth:`best_index` and the number of items whose information was computed.
+
+        The count is returned rather than stored, since one index serves
+        concurrent requests.
+        """
+
+        matrix = self.matrix
+        best: Optional[int] = None
+        best_value = -math.inf
+        scored = 0
+
+        def consider(index: int) -> None:
+            nonlocal best, best_value, scored
+            if seen is not None and seen[index]:
+                return
+            scored += 1
+            value = matrix.item_information(index, theta)
+            if value > best_value or (value == best_value and best is not None and index < best):
+                best = index
+                best_value = value
+
+        for index in self.full_scan:
+            consider(index)
+        frontier: List[tuple[float, int, int, int]] = []
+        for bucket_id, bucket in enumerate(self.buckets):
+            start = bisect_left(bucket.peaks, theta)
+            for position, step in ((start - 1, -1), (start, 1)):
+                if 0 <= position < len(bucket.peaks):
+                    frontier.append((-bucket.bound(position, theta), bucket_id, position, step))
+        heapq.heapify(frontier)
+        while frontier:
+            negative_bound, bucket_id, position, step = heapq.heappop(frontier)
+            if -negative_bound < best_value:
+                break
+            bucket = self.buckets[bucket_id]
+            consider(bucket.indices[position])
+            position += step
+            if 0 <= position < len(bucket.peaks):
+                heapq.heappush(frontier, (-bucket.bound(position, theta), bucket_id, position, step))
+        return best, scored
+
+
+def build_domain_matrices(items: Iterable["Item"]) -> Dict[str, ItemMatrix]:
+    """Group ``items`` by domain and build one :class:`ItemMatrix` per domain."""
+
+    grouped: Dict[str, List["Item"]] = {}
+    for item in items:
+        grouped.setdefault(item.domain, []).append(item)
+    return {domain: ItemMatrix(members) for domain, members in grouped.items()}
+
+
+__all__ = [
+    "InformationTable",
+    "ItemMatrix",
+    "MODEL_2PL",
+    "MODEL_3PL",
+    "MODEL_CODES",
+    "MODEL_GPCM",
+    "PeakIndex",
+    "build_domain_matrices",
+    "information_envelope",
+    "item_steps",
+    "model_code",
+    "peak_location",
+]
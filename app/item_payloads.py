@@ -0,0 +1,124 @@
+"""Pre-encoded JSON for the item part of ``/api/test/{id}/next`` responses.
+
+The stem, options, model and metadata of an item never change within a
+bank version, yet every ``next`` call used to build an
+:class:`~app.schemas.ItemResponse`, deep-copy it with ``asdict`` and run
+``json.dumps`` over it. :class:`ItemPayloadCache` encodes each item once per
+:class:`~app.cat_engine.ItemBank` and keeps the bytes for as long as the bank
+is alive. Rendering a response is then a dict lookup and a join; the only
+per-session parts, the signed audio link of a listening item and the
+stateless session token, are encoded on their own and spliced in.
+
+The output is byte-for-byte what ``json.dumps`` produces for the equivalent
+dict, so clients cannot tell which path served them.
+"""
+from __future__ import annotations
+
+import json
+import threading
+import weakref
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from app.cat_engine import Item, ItemBank
+
+_AUDIO_PLACEHOLDER = "\x00audio_url\x00"
+
+
+@dataclass(frozen=True)
+class EncodedItem:
+    item: Item
+    # Everything before the metadata value, the metadata value and
+    # everything after it, without the closing brace.
+    head: bytes
+    metadata: bytes
+    tail: bytes
+    # The metadata value split around its ``audio_url``, for items whose
+    # link is replaced per session.
+    audio: Optional[Tuple[bytes, bytes]] = None
+
+
+def encode_item(item: Item) -> EncodedItem:
+    # Same keys, order and separators as ``json.dumps(ItemResponse(...).to_dict())``.
+    head = json.dumps(
+        {
+            "item_id": item.id,
+            "stem": item.stem,
+            "options": item.options,
+            "domain": item.domain,
+            "model": item.model,
+        }
+    )[:-1]
+    audio = None
+    if item.metadata and "audio_url" in item.metadata:
+        before, _, after = json.dumps({**item.metadata, "audio_url": _AUDIO_PLACEHOLDER}).partition(
+            json.dumps(_AUDIO_PLACEHOLDER)
+        )
+        audio = before.encode("utf-8"), after.encode("utf-8")
+    return EncodedItem(
+        item=item,
+        head=f'{head}, "metadata": '.encode("utf-8"),
+        metadata=json.dumps(item.metadata).encode("utf-8"),
+        tail=f', "max_plays": {json.dumps(item.max_plays)}'.encode("utf-8"),
+        audio=audio,
+    )
+
+
+class ItemPayloadCache:
+    """Encoded items per live bank version.
+
+    ``hits`` and ``misses`` are updated under the cache's lock, so they are
+    exact under concurrent requests.
+    """
+
+    def __init__(self) -> None:
+        self._banks: "weakref.WeakKeyDictionary[ItemBank, Dict[str, EncodedItem]]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encoded(self, bank: ItemBank, item: Item) -> EncodedItem:
+        items = self._banks.get(bank)
+        if items is None:
+            with self._lock:
+                items = self._banks.setdefault(bank, {})
+        entry = items.get(item.id)
+        if entry is not None and entry.item is item:
+            with self._lock:
+                self.hits += 1
+            return entry
+        entry = encode_item(item)
+        with self._lock:
+            self.misses += 1
+            if bank.lookup.get(item.id) is item:
+                entry = items.setdefault(item.id, entry)
+        return entry
+
+    def render(
+        self,
+        bank: ItemBank,
+        item: Item,
+        audio_url: Optional[str] = None,
+        session_token: Optional[str] = None,
+    ) -> bytes:
+        """JSON for ``item``, with its ``audio_url`` replaced and a ``session_token`` added if given."""
+
+        entry = self.encoded(bank, item)
+        parts = [entry.head]
+        if audio_url is not None and entry.audio is not None:
+            parts += (entry.audio[0], json.dumps(audio_url).encode("utf-8"), entry.audio[1])
+        else:
+            parts.append(entry.metadata)
+        parts.append(entry.tail)
+        if session_token is not None:
+            parts.append(f', "session_token": {json.dumps(session_token)}'.encode("utf-8"))
+        parts.append(b"}")
+        return b"".join(parts)
+
+    def versions(self) -> Dict[int, int]:
+        """Number of encoded items per cached bank version."""
+
+        return {bank.version: len(items) for bank, items in list(self._banks.items())}
+
+
+__all__ = ["EncodedItem", "ItemPayloadCache", "encode_item"]
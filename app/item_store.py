@@ -0,0 +1,115 @@
+"""SQLite-backed item bank repository built on :mod:`app.database`.
+
+Items are persisted in the ``items`` table from TZ §8 and loaded back with
+a single bulk query. The repository remembers the highest version stamp it
+has seen, so :meth:`ItemBankRepository.reload` only fetches rows that were
+added, recalibrated or retired since the previous load.
+"""
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Mapping, Optional
+
+from .cat_engine import Item, register_item_bank
+from .database import fetch_items, init_db, retire_items, upsert_items
+from .item_matrix import ItemMatrix
+
+
+def item_to_row(item: Item) -> Dict[str, object]:
+    correct = item.correct_key if isinstance(item.correct_key, int) else list(item.correct_key)
+    return {
+        "id": item.id,
+        "domain": item.domain,
+        "stem": item.stem,
+        "options": json.dumps(item.options, ensure_ascii=False),
+        "correct_key": json.dumps(correct),
+        "model": item.model,
+        "irt_a": float(item.irt_a),
+        "irt_b": float(item.irt_b),
+        "irt_c": float(item.irt_c),
+        "max_plays": int(item.max_plays),
+        "tags": json.dumps(sorted({item.domain, item.model.lower()})),
+        "metadata": None if item.metadata is None else json.dumps(item.metadata, ensure_ascii=False),
+        "step_difficulties": None if item.step_difficulties is None else json.dumps(item.step_difficulties),
+    }
+
+
+def row_to_item(row: Mapping[str, object]) -> Item:
+    return Item(
+        id=row["id"],
+        domain=row["domain"],
+        stem=row["stem"],
+        options=json.loads(row["options"]),
+        correct_key=json.loads(row["correct_key"]),
+        model=row["model"],
+        irt_a=row["irt_a"],
+        irt_b=row["irt_b"],
+        irt_c=row["irt_c"],
+        max_plays=row["max_plays"],
+        metadata=None if row["metadata"] is None else json.loads(row["metadata"]),
+        step_difficulties=None if row["step_difficulties"] is None else json.loads(row["step_difficulties"]),
+    )
+
+
+class ItemBankRepository:
+    """Keeps an in-memory copy of the ``items`` table in sync by version stamp."""
+
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.path = path
+        self.version = 0
+        self._items: Dict[str, Item] = {}
+        init_db(path)
+
+    def save(self, items: Iterable[Item]) -> int:
+        """Persist ``items``; unchanged rows keep their version stamp."""
+
+        return upsert_items((item_to_row(item) for item in items), self.path)
+
+    def retire(self, item_ids: Iterable[str]) -> int:
+        return retire_items(list(item_ids), self.path)
+
+    def load_domain(self, domain: str) -> List[Item]:
+        """All active items of ``domain`` ordered by difficulty, in one query."""
+
+        return [row_to_item(row) for row in fetch_items(domain=domain, path=self.path)]
+
+    def load_domain_matrix(self, domain: str) -> ItemMatrix:
+        return ItemMatrix(self.load_domain(domain))
+
+    def reload(self) -> int:
+        """Apply rows changed since the last load and return how many changed."""
+
+        rows = fetch_items(since_version=self.version, path=self.path)
+        for row in rows:
+            if row["active"]:
+                self._items[row["id"]] = row_to_item(row)
+            else:
+                self._items.pop(row["id"], None)
+            self.version = max(self.version, int(row["version"]))
+        return len(rows)
+
+    def items(self) -> List[Item]:
+        """Current bank contents in insertion order."""
+
+        return list(self._items.values())
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+def register_from_store(repository: ItemBankRepository, selection: str = "scan") -> List[Item]:
+    """Reload ``repository`` incrementally and register its items with the engine."""
+
+    repository.reload()
+    items = repository.items()
+    register_item_bank(items, selection=selection)
+    return items
+
+
+__all__ = [
+    "ItemBankRepository",
+    "item_to_row",
+    "register_from_store",
+    "row_to_item",
+]
@@ -1,4 +1,9 @@
-"""ASGI entrypoint exposing the adaptive English level test application."""
+"""ASGI entrypoint exposing the adaptive English level test application.
+
+Serve it with any ASGI host, e.g. ``uvicorn app.main:app``. A single worker
+handles many concurrent connections: blocking service calls run on a thread
+pool sized by :data:`app.api.ASGI_THREADS_ENV` instead of on the event loop.
+"""
 from __future__ import annotations
 
 from .api import create_app
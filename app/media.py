@@ -0,0 +1,245 @@
+"""Local audio for listening items: signed URLs, play limits and zero-copy delivery.
+
+An item whose ``metadata["audio_file"]`` (or the file name of its
+``audio_url``) exists in the audio directory is served by the application
+at ``/api/test/{id}/audio/{item_id}/{token}`` instead of the external URL.
+The token is ``play.bank.expiry.signature``, an HMAC over the test id, item
+id, play number, the fingerprint of the session's item bank and the expiry,
+so checking it is pure CPU work (TZ §16: temporary media links). The service
+then checks the play number against the plays of the session (or, in
+stateless mode, against the plays registered in SQLite): the link handed
+out with the item (play 0) only serves a short preview for the player to
+read the duration, and the link returned by ``/play`` for play *n* stops
+working once play *n + 1* is registered.
+
+Responses support single byte ranges and carry a :class:`FileRegion` body
+instead of bytes; the servers send it with ``sendfile`` so the audio never
+passes through Python buffers.
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import mimetypes
+import os
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Mapping, Optional, Tuple
+from urllib.parse import quote, urlsplit
+
+from app.cat_engine import Item
+from app.session_store import SESSION_SHARD_ENV
+from app.session_token import TOKEN_SECRET_ENV
+
+AUDIO_DIR_ENV = "ADAPTIVE_TEST_AUDIO_DIR"
+MEDIA_SECRET_ENV = "ADAPTIVE_TEST_MEDIA_SECRET"
+
+URL_TTL = 15 * 60.0
+PREVIEW_BYTES = 64 * 1024
+_SIGNATURE_BYTES = 16
+
+
+class MediaAccessDenied(PermissionError):
+    """Raised for expired or forged media links and for plays that are used up."""
+
+
+@dataclass(frozen=True)
+class FileRegion:
+    """Response body that is a byte range of a file, for ``sendfile``."""
+
+    path: Path
+    offset: int
+    length: int
+
+    def __len__(self) -> int:
+        return self.length
+
+    def chunks(self, size: int = 64 * 1024) -> Iterator[bytes]:
+        """The region in pieces, for transports that cannot use ``sendfile``."""
+
+        with self.path.open("rb") as handle:
+            handle.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = handle.read(min(size, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+
+class MediaSigner:
+    """Creates and checks time-limited media tokens."""
+
+    def __init__(self, secret: bytes, ttl: float = URL_TTL, clock: Callable[[], float] = time.time) -> None:
+        if len(secret) < 16:
+            raise ValueError("Media secret must be at least 16 bytes")
+        self._secret = secret
+        self.ttl = ttl
+        self.clock = clock
+
+    def sign(self, test_id: str, item_id: str, play: int, bank: bytes) -> str:
+        expires = int(self.clock() + self.ttl)
+        return f"{play}.{bank.hex()}.{expires}.{self._signature(test_id, item_id, play, bank.hex(), expires)}"
+
+    def verify(self, test_id: str, item_id: str, token: str) -> Tuple[int, bytes]:
+        """Return the play number and bank fingerprint of a valid token."""
+
+        try:
+            play_text, bank_text, expires_text, signature = token.split(".")
+            play, bank, expires = int(play_text), bytes.fromhex(bank_text), int(expires_text)
+        except ValueError:
+            raise MediaAccessDenied("Malformed media link") from None
+        if not hmac.compare_digest(signature, self._signature(test_id, item_id, play, bank_text, expires)):
+            raise MediaAccessDenied("Invalid media link")
+        if expires < self.clock():
+            raise MediaAccessDenied("Media link expired")
+        return play, bank
+
+    def _signature(self, test_id: str, item_id: str, play: int, bank: str, expires: int) -> str:
+        message = f"{test_id}\n{item_id}\n{play}\n{bank}\n{expires}".encode("utf-8")
+        digest = hmac.new(self._secret, message, hashlib.sha256).digest()[:_SIGNATURE_BYTES]
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+
+class AudioLibrary:
+    """Maps listening items to files in ``directory`` and signs links to them."""
+
+    def __init__(self, directory: Path, signer: MediaSigner) -> None:
+        self.directory = directory.resolve()
+        self.signer = signer
+        self._files: Dict[str, Optional[Path]] = {}
+        self._lock = threading.Lock()
+
+    def file_for(self, item: Item) -> Optional[Path]:
+        if item.id in self._files:
+            return self._files[item.id]
+        metadata = item.metadata or {}
+        name = metadata.get("audio_file") or Path(urlsplit(metadata.get("audio_url", "")).path).name
+        path: Optional[Path] = None
+        if name:
+            candidate = (self.directory / name).resolve()
+            if candidate.is_relative_to(self.directory) and candidate.is_file():
+                path = candidate
+        with self._lock:
+            self._files[item.id] = path
+        return path
+
+    def url_for(self, test_id: str, item: Item, play: int, bank: bytes) -> Optional[str]:
+        """Link to the audio of ``item`` for ``play`` of a session on the bank with fingerprint ``bank``."""
+
+        if self.file_for(item) is None:
+            return None
+        token = self.signer.sign(test_id, item.id, play, bank)
+        return f"/api/test/{test_id}/audio/{quote(item.id, safe='')}/{token}"
+
+
+def _parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive bounds of a single ``bytes=`` range; ``None`` if unsatisfiable.
+
+    Raises :class:`ValueError` for anything else (other units, several
+    ranges, bad syntax), which callers answer with the whole file.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        raise ValueError(value)
+    first, _, last = spec.strip().partition("-")
+    if not first:
+        suffix = int(last)
+        if suffix <= 0:
+            return None
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and start > end:
+        raise ValueError(value)
+    if start >= size:
+        return None
+    return start, min(end, size - 1)
+
+
+def file_response(
+    path: Path, headers: Optional[Mapping[str, str]] = None, limit: Optional[int] = None
+) -> Tuple[int, Dict[str, str], FileRegion]:
+    """Range-aware response for ``path``; only its first ``limit`` bytes are served if given."""
+
+    get = (lambda name: headers.get(name) or headers.get(name.lower())) if headers else (lambda name: None)
+    stat = path.stat()
+    size = stat.st_size
+    etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+    reply = {
+        "Content-Type": mimetypes.guess_type(str(path))[0] or "application/octet-stream",
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        # TZ §16: no downloadable copy, and every play goes through the server.
+        "Cache-Control": "private, no-store",
+        "Content-Disposition": "inline",
+    }
+    start, end, partial = 0, size - 1, False
+    range_header = get("Range")
+    if_range = get("If-Range")
+    if range_header and (if_range is None or if_range == etag):
+        try:
+            bounds = _parse_range(range_header, size)
+        except ValueError:
+            bounds = (0, size - 1)
+        else:
+            partial = True
+        if bounds is None:
+            reply["Content-Range"] = f"bytes */{size}"
+            reply["Content-Length"] = "0"
+            return 416, reply, FileRegion(path, 0, 0)
+        start, end = bounds
+    if limit is not None and end >= limit:
+        if start >= limit:
+            raise MediaAccessDenied("Register a play before streaming the audio")
+        end, partial = limit - 1, True
+    length = max(0, end - start + 1)
+    reply["Content-Length"] = str(length)
+    if partial:
+        reply["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return (206 if partial else 200), reply, FileRegion(path, start, length)
+
+
+def media_from_env(environ: Mapping[str, str] = os.environ) -> Optional[AudioLibrary]:
+    """Library over :data:`AUDIO_DIR_ENV` (default ``data/audio``), if that directory exists.
+
+    Links are signed with :data:`MEDIA_SECRET_ENV`, or else with a key
+    derived from the session token secret, so every process that accepts
+    the tokens also accepts the links. Without either, a random key per
+    process is only used outside sharded deployments: a restarted shard
+    worker would reject every link handed out before the restart.
+    """
+
+    directory = Path(environ.get(AUDIO_DIR_ENV) or Path(__file__).resolve().parent.parent / "data" / "audio")
+    if not directory.is_dir():
+        return None
+    secret = environ.get(MEDIA_SECRET_ENV)
+    token_secret = environ.get(TOKEN_SECRET_ENV)
+    if secret:
+        key = secret.encode("utf-8")
+    elif token_secret:
+        key = hmac.new(token_secret.encode("utf-8"), b"media links", hashlib.sha256).digest()
+    elif environ.get(SESSION_SHARD_ENV):
+        raise ValueError(f"Set {MEDIA_SECRET_ENV} to serve audio from sharded workers")
+    else:
+        key = secrets.token_bytes(32)
+    return AudioLibrary(directory, MediaSigner(key))
+
+
+__all__ = [
+    "AUDIO_DIR_ENV",
+    "MEDIA_SECRET_ENV",
+    "PREVIEW_BYTES",
+    "URL_TTL",
+    "AudioLibrary",
+    "FileRegion",
+    "MediaAccessDenied",
+    "MediaSigner",
+    "file_response",
+    "media_from_env",
+]
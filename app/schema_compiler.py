@@ -0,0 +1,145 @@
+"""Generated ``from_dict``/``to_dict`` functions for the dataclass schemas.
+
+:func:`schema` reads a dataclass's fields and resolved type hints once, at
+class creation, and ``exec``s a function per direction written out for that
+class: plain key lookups with the type checks inlined, and a dict literal
+whose values are converted by their declared type (``UUID`` to ``str``,
+nested schemas through their own ``to_dict``, lists and dicts copied one
+level deep, as ``asdict`` would for these flat payloads). Nothing is looked
+up, reflected on or recursed into per call.
+
+Generated ``from_dict`` keeps the behaviour of
+:func:`~app.schemas.dataclass_from_dict` for well-formed input (unknown keys
+are ignored) and turns malformed input into :class:`ValueError`, which the
+router answers with ``400``: a body that is not an object, a missing
+required field or a value of the wrong JSON type.
+"""
+from __future__ import annotations
+
+import typing
+from dataclasses import MISSING, fields, is_dataclass
+from typing import Any, Callable, Dict, List, Tuple
+from uuid import UUID
+
+# Field metadata that keeps a field (e.g. a derived sort key) out of ``to_dict``.
+INTERNAL = {"serialize": False}
+
+_JSON_TYPES: Dict[Any, Tuple[Tuple[type, ...], str]] = {
+    str: ((str,), "a string"),
+    bool: ((bool,), "a boolean"),
+    int: ((int,), "an integer"),
+    float: ((int, float), "a number"),
+    dict: ((dict,), "an object"),
+    list: ((list,), "an array"),
+}
+
+
+def _unwrap_optional(hint: Any) -> Tuple[Any, bool]:
+    if typing.get_origin(hint) is typing.Union:
+        args = [arg for arg in typing.get_args(hint) if arg is not type(None)]
+        if len(args) == 1 and len(typing.get_args(hint)) == 2:
+            return args[0], True
+    return hint, False
+
+
+def _check(name: str, hint: Any, variable: str, namespace: Dict[str, Any]) -> List[str]:
+    """Lines that raise :class:`ValueError` unless ``variable`` matches ``hint``."""
+
+    hint, optional = _unwrap_optional(hint)
+    spec = _JSON_TYPES.get(typing.get_origin(hint) or hint)
+    if spec is None:
+        return []
+    types, label = spec
+    namespace[f"_types_{name}"] = types
+    test = f"isinstance({variable}, _types_{name})"
+    if bool not in types:
+        test += f" and not isinstance({variable}, bool)"  # JSON true/false are not numbers
+    if optional:
+        test = f"{variable} is None or ({test})"
+    return [f"if not ({test}):", f"    raise ValueError({name + ' must be ' + label!r})"]
+
+
+def _encoder(hint: Any, expression: str) -> str:
+    """Expression producing the JSON-ready value of ``expression`` for ``hint``."""
+
+    hint, optional = _unwrap_optional(hint)
+    origin = typing.get_origin(hint)
+    if hint is UUID:
+        encoded = f"str({expression})"
+    elif is_dataclass(hint):
+        encoded = f"{expression}.to_dict()"
+    elif origin in (list, List):
+        (item,) = typing.get_args(hint) or (Any,)
+        encoded = f"[_item.to_dict() for _item in {expression}]" if is_dataclass(item) else f"list({expression})"
+    elif origin in (dict, Dict):
+        encoded = f"dict({expression})"
+    else:
+        return expression
+    if optional:
+        return f"(None if {expression} is None else {encoded})"
+    return encoded
+
+
+def _exec(source: str, name: str, namespace: Dict[str, Any]) -> Callable[..., Any]:
+    exec(compile(source, f"<schema {name}>", "exec"), namespace)
+    return namespace[name]
+
+
+def compile_from_dict(cls: type) -> Callable[[Any], Any]:
+    """Build ``from_dict(data) -> cls`` for a dataclass."""
+
+    hints = typing.get_type_hints(cls)
+    namespace: Dict[str, Any] = {"cls": cls}
+    lines = [
+        "def from_dict(data):",
+        "    if not isinstance(data, dict):",
+        "        raise ValueError('Expected a JSON object')",
+        "    kwargs = {}",
+    ]
+    for index, item in enumerate(field for field in fields(cls) if field.init):
+        variable = f"value_{index}"
+        required = item.default is MISSING and item.default_factory is MISSING
+        if required:
+            lines += [
+                f"    {variable} = data.get({item.name!r}, _missing)",
+                f"    if {variable} is _missing:",
+                f"        raise ValueError({item.name + ' is required'!r})",
+            ]
+            indent = "    "
+        else:
+            lines += [f"    {variable} = data.get({item.name!r}, _missing)", f"    if {variable} is not _missing:"]
+            indent = "        "
+        lines += [indent + line for line in _check(item.name, hints[item.name], variable, namespace)]
+        lines.append(f"{indent}kwargs[{item.name!r}] = {variable}")
+    lines.append("    return cls(**kwargs)")
+    namespace["_missing"] = object()
+    return _exec("\n".join(lines), "from_dict", namespace)
+
+
+def compile_to_dict(cls: type) -> Callable[[Any], Dict[str, object]]:
+    """Build ``to_dict(self) -> dict`` for a dataclass."""
+
+    hints = typing.get_type_hints(cls)
+    entries = [
+        f"        {item.name!r}: {_encoder(hints[item.name], 'self.' + item.name)},"
+        for item in fields(cls)
+        if item.metadata.get("serialize", True)
+    ]
+    source = "\n".join(["def to_dict(self):", "    return {", *entries, "    }"])
+    return _exec(source, "to_dict", {})
+
+
+def schema(cls: type) -> type:
+    """Class decorator installing generated ``from_dict`` and ``to_dict``.
+
+    Methods the class defines itself are kept, so a schema with special
+    output (such as a sorted nested list) can still write its own.
+    """
+    if "from_dict" not in cls.__dict__:
+        cls.from_dict = staticmethod(compile_from_dict(cls))  # type: ignore[attr-defined]
+    if "to_dict" not in cls.__dict__:
+        cls.to_dict = compile_to_dict(cls)  # type: ignore[attr-defined]
+    return cls
+
+
+__all__ = ["INTERNAL", "compile_from_dict", "compile_to_dict", "schema"]
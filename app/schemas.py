@@ -1,11 +1,21 @@
-"""Lightweight dataclass-based schemas used by the service layer."""
+"""Lightweight dataclass-based schemas used by the service layer.
+
+``from_dict`` and ``to_dict`` are generated per class by
+:func:`~app.schema_compiler.schema`; :func:`dataclass_from_dict` is the
+generic reflective path they replaced, kept for the benchmark.
+"""
 from __future__ import annotations
 
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field
+from operator import attrgetter
 from typing import Dict, List, Optional
 from uuid import UUID
 
 from app.cat_engine import CAT_PARTS, DOMAIN_TARGETS
+from app.schema_compiler import INTERNAL, schema
+
+_PART_ORDER = {name: index for index, name in enumerate(CAT_PARTS)}
+_SORT_KEY = attrgetter("sort_index", "domain")
 
 
 def dataclass_from_dict(cls, data):
@@ -17,6 +27,7 @@ def dataclass_from_dict(cls, data):
     return instance
 
 
+@schema
 @dataclass
 class StartTestRequest:
     start_level: str
@@ -33,11 +44,8 @@ class StartTestRequest:
         if not self.first_name or not self.last_name:
             raise ValueError("first_name and last_name are required")
 
-    @classmethod
-    def from_dict(cls, data: Dict[str, object]) -> "StartTestRequest":
-        return dataclass_from_dict(cls, data)
-
 
+@schema
 @dataclass
 class StartTestResponse:
     test_id: UUID
@@ -47,15 +55,11 @@ class StartTestResponse:
     paused: bool
     upcoming_part: Optional[str]
 
-    def to_dict(self) -> Dict[str, object]:
-        payload = asdict(self)
-        payload["test_id"] = str(self.test_id)
-        return payload
-
 
 DOMAIN_LENGTHS: Dict[str, int] = {part: DOMAIN_TARGETS.get(part, 0) for part in CAT_PARTS}
 
 
+@schema
 @dataclass
 class ItemResponse:
     item_id: str
@@ -66,20 +70,15 @@ class ItemResponse:
     metadata: Optional[Dict[str, str]] = None
     max_plays: int = 0
 
-    def to_dict(self) -> Dict[str, object]:
-        return asdict(self)
-
 
+@schema
 @dataclass
 class AnswerRequest:
     item_id: str
     response: Dict[str, object]
 
-    @classmethod
-    def from_dict(cls, data: Dict[str, object]) -> "AnswerRequest":
-        return dataclass_from_dict(cls, data)
-
 
+@schema
 @dataclass
 class AnswerResponse:
     theta: float
@@ -88,10 +87,8 @@ class AnswerResponse:
     score: float
     next_part: Optional[str]
 
-    def to_dict(self) -> Dict[str, object]:
-        return asdict(self)
-
 
+@schema
 @dataclass
 class PauseResponse:
     pause: bool = field(default=True, init=False)
@@ -99,36 +96,28 @@ class PauseResponse:
     message: str = ""
     questions: int = 0
 
-    def to_dict(self) -> Dict[str, object]:
-        return {"pause": True, "domain": self.domain, "message": self.message, "questions": self.questions}
-
 
+@schema
 @dataclass
 class ResumeResponse:
     domain: str
 
-    def to_dict(self) -> Dict[str, object]:
-        return {"domain": self.domain}
-
 
+@schema
 @dataclass
 class PlayRequest:
     item_id: str
 
-    @classmethod
-    def from_dict(cls, data: Dict[str, object]) -> "PlayRequest":
-        return dataclass_from_dict(cls, data)
-
 
+@schema
 @dataclass
 class PlayResponse:
     plays: int
     max_plays: int
-
-    def to_dict(self) -> Dict[str, object]:
-        return asdict(self)
+    audio_url: Optional[str] = None
 
 
+@schema
 @dataclass
 class FinishResponse:
     theta: float
@@ -137,25 +126,20 @@ class FinishResponse:
     cefr: str
     completed: bool
 
-    def to_dict(self) -> Dict[str, object]:
-        return asdict(self)
-
 
+@schema
 @dataclass(order=True)
 class DomainBreakdown:
-    sort_index: int = field(init=False, repr=False)
+    sort_index: int = field(init=False, repr=False, metadata=INTERNAL)
     domain: str
     average_score: float
     cefr: str
 
     def __post_init__(self) -> None:
-        order = {name: index for index, name in enumerate(CAT_PARTS)}
-        self.sort_index = order.get(self.domain, 99)
-
-    def to_dict(self) -> Dict[str, object]:
-        return {"domain": self.domain, "average_score": self.average_score, "cefr": self.cefr}
+        self.sort_index = _PART_ORDER.get(self.domain, 99)
 
 
+@schema
 @dataclass
 class ReportResponse:
     test_id: UUID
@@ -166,7 +150,7 @@ class ReportResponse:
     domains: List[DomainBreakdown]
 
     def to_dict(self) -> Dict[str, object]:
-        sorted_domains = sorted(self.domains)
+        sorted_domains = sorted(self.domains, key=_SORT_KEY)
         return {
             "test_id": str(self.test_id),
             "theta": self.theta,
@@ -1,12 +1,55 @@
-"""Standard library HTTP server for the adaptive English level test UI and API."""
+"""Standard library HTTP server for the adaptive English level test UI and API.
+
+By default every connection gets its own thread (:class:`ThreadingHTTPServer`).
+With ``--pool N`` the server runs :class:`PooledHTTPServer` instead: a reader
+thread waits on every open connection until its next request line has
+arrived, classifies that request (:func:`classify`) and puts it on a bounded
+queue, from which N worker threads serve one request at a time in priority
+order. Lower priorities are only admitted while the queue is short, and
+anything not admitted is answered with ``503 Retry-After`` by the reader
+thread, so a burst of arrivals is shed instead of piling up threads. Queue
+depth and rejection counters are served at :data:`STATS_PATH`.
+
+``--asyncio`` runs :class:`AsyncHTTPServer` instead, an HTTP/1.1 server on
+:mod:`asyncio` streams where each connection is a coroutine rather than a
+thread and only blocking requests go to a thread pool.
+
+Audio responses (:class:`~app.media.FileRegion` bodies) are written with
+``sendfile`` by both servers, so the file goes from the page cache to the
+socket without being copied through Python.
+"""
 from __future__ import annotations
 
 import argparse
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from typing import Tuple
+import asyncio
+import itertools
+import json
+import logging
+import queue
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from email.utils import formatdate
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional, Tuple
 from urllib.parse import urlsplit
 
-from .http_router import dispatch
+from .http_router import blocking, dispatch, dispatch_inline
+from .media import FileRegion
+from .service import start_background_tasks, stop_background_tasks
+
+logger = logging.getLogger(__name__)
+
+STATS_PATH = "/api/server/stats"
+
+# Highest priority first: candidates in the middle of an item, then the rest
+# of running tests, then new tests, then pages, assets and reports.
+PRIORITIES = ("answer", "session", "start", "background")
 
 
 class AdaptiveHTTPRequestHandler(BaseHTTPRequestHandler):
@@ -24,30 +67,628 @@ class AdaptiveHTTPRequestHandler(BaseHTTPRequestHandler):
     def _handle_request(self, send_body: bool = True) -> None:
         length = int(self.headers.get("Content-Length", "0"))
         body = self.rfile.read(length) if length > 0 else b""
-        status, headers, content = dispatch(self.command, urlsplit(self.path).path, body)
+        status, headers, content = dispatch(self.command, urlsplit(self.path).path, body, self.headers)
         self.send_response(status)
         for key, value in headers.items():
             self.send_header(key, value)
-        if "Content-Length" not in headers:
+        # RFC 9110 §8.6: a 304 must not claim an empty representation.
+        if "Content-Length" not in headers and status != 304:
             self.send_header("Content-Length", str(len(content)))
         self.end_headers()
         if send_body and content:
-            self.wfile.write(content)
+            if isinstance(content, FileRegion):
+                with content.path.open("rb") as handle:
+                    self.connection.sendfile(handle, content.offset, content.length)
+            else:
+                self.wfile.write(content)
 
     def log_message(self, format: str, *args) -> None:  # pragma: no cover - diagnostic output
         print(f"[HTTP] {self.log_date_time_string()} - {format % args}")
 
 
-def run(host: str = "127.0.0.1", port: int = 8000) -> Tuple[str, int]:
-    """Start the development server and return the host/port in use."""
-    server = ThreadingHTTPServer((host, port), AdaptiveHTTPRequestHandler)
+def classify(method: str, path: str) -> int:
+    """Index into :data:`PRIORITIES` for a request (0 is served first)."""
+
+    parts = [part for part in path.split("/") if part]
+    if len(parts) < 2 or parts[0] != "api" or parts[1] == "report":
+        return 3
+    if parts[1] == "test" and len(parts) == 3 and parts[2] == "start":
+        return 2
+    if method == "POST" and parts[1] == "test" and len(parts) == 4 and parts[3] in ("answer", "play", "finish"):
+        return 0
+    return 1
+
+
+@dataclass
+class PoolStats:
+    """Pool counters; ``accepted``, ``served`` and ``rejected`` count requests."""
+
+    workers: int = 0
+    busy_workers: int = 0
+    idle_connections: int = 0
+    queue_size: int = 0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    accepted: int = 0
+    served: int = 0
+    rejected: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(PRIORITIES, 0))
+
+    def to_dict(self) -> Dict[str, object]:
+        return asdict(self)
+
+
+def _busy_response(retry_after: int) -> bytes:
+    body = json.dumps({"detail": "Server busy, retry shortly"}).encode("utf-8")
+    head = (
+        "HTTP/1.1 503 Service Unavailable\r\n"
+        f"Retry-After: {retry_after}\r\n"
+        "Content-Type: application/json; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    return head.encode("ascii") + body
+
+
+class _Connection:
+    """A pooled connection and the bytes read from it but not yet parsed.
+
+    It doubles as the request handler's ``rfile``: the reader thread fills
+    ``buffer`` until a request line is complete, the handler consumes one
+    request from it, and whatever follows (a pipelined request) stays in the
+    buffer for the next round.
+    """
+
+    __slots__ = ("sock", "address", "buffer", "idle_since")
+
+    def __init__(self, sock: socket.socket, address: object) -> None:
+        self.sock = sock
+        self.address = address
+        self.buffer = bytearray()
+        self.idle_since = time.monotonic()
+
+    def request_line(self) -> Optional[bytes]:
+        end = self.buffer.find(b"\n")
+        return None if end < 0 else bytes(self.buffer[:end])
+
+    def fill(self) -> bool:
+        data = self.sock.recv(65536)
+        self.buffer += data
+        return bool(data)
+
+    def readline(self, limit: int = -1) -> bytes:
+        while True:
+            end = self.buffer.find(b"\n", 0, limit if limit >= 0 else len(self.buffer))
+            if end >= 0:
+                size = end + 1
+                break
+            if 0 <= limit <= len(self.buffer) or not self.fill():
+                size = len(self.buffer) if limit < 0 else min(limit, len(self.buffer))
+                break
+        line = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return line
+
+    def read(self, size: int) -> bytes:
+        while len(self.buffer) < size and self.fill():
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self) -> None:
+        """The handler closing its ``rfile`` leaves the connection open."""
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP server with a fixed worker pool and a bounded, prioritized request queue.
+
+    Connections wait in the reader stage, costing no worker, until a request
+    line arrives; each request is then classified on its own, so a keep-alive
+    connection that submits an answer after loading assets is queued as an
+    answer. A request of priority ``p`` is admitted while fewer than
+    ``queue_size * (len(PRIORITIES) - p) // len(PRIORITIES)`` requests are
+    waiting, so answers can use the whole queue and background requests only
+    its last quarter. Connections idle for ``idle_timeout`` seconds are closed.
+    """
+
+    # Let the kernel hold a burst of connections until the accept loop takes them.
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        server_address: Tuple[str, int],
+        handler_class: type,
+        workers: int = 16,
+        queue_size: int = 64,
+        retry_after: int = 1,
+        idle_timeout: float = 15.0,
+    ) -> None:
+        if workers < 1 or queue_size < len(PRIORITIES):
+            raise ValueError("Need at least one worker and a queue slot per priority")
+        super().__init__(server_address, handler_class)
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self.idle_timeout = idle_timeout
+        self._busy = _busy_response(retry_after)
+        self._queue: "queue.PriorityQueue[Tuple[int, int, Optional[_Connection]]]" = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = PoolStats(workers=workers, queue_size=queue_size)
+        self._local = threading.local()
+        # Connections handed to the reader thread by the accept loop and the workers.
+        self._incoming: Deque[_Connection] = deque()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._wakeup_writer = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._closing = False
+        self._reader = threading.Thread(target=self._read_requests, name="http-reader", daemon=True)
+        self._reader.start()
+        self._workers: List[threading.Thread] = []
+        for index in range(workers):
+            thread = threading.Thread(target=self._work, name=f"http-worker-{index}", daemon=True)
+            thread.start()
+            self._workers.append(thread)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._stats.queue_depth
+
+    def stats(self) -> PoolStats:
+        with self._lock:
+            snapshot = PoolStats(**asdict(self._stats))
+        return snapshot
+
+    def process_request(self, request: socket.socket, client_address: object) -> None:  # type: ignore[override]
+        self._hand_to_reader(_Connection(request, client_address))
+
+    def request_reader(self) -> _Connection:
+        """The connection the calling worker is serving, used as the handler's ``rfile``."""
+
+        return self._local.connection
+
+    def _hand_to_reader(self, connection: _Connection) -> None:
+        self._incoming.append(connection)
+        self._wake_reader()
+
+    def _wake_reader(self) -> None:
+        try:
+            self._wakeup_writer.send(b"\0")
+        except OSError:  # pragma: no cover - buffer full, so the reader is awake anyway
+            pass
+
+    def _read_requests(self) -> None:
+        while not self._closing:
+            for key, _ in self._selector.select(timeout=min(1.0, self.idle_timeout)):
+                if key.fileobj is self._wakeup:
+                    try:
+                        self._wakeup.recv(4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._receive(key.data)
+            while self._incoming:
+                self._watch(self._incoming.popleft())
+            self._expire_idle()
+        for key in list(self._selector.get_map().values()):
+            if key.data is not None:
+                self.shutdown_request(key.data.sock)
+        self._selector.close()
+
+    def _watch(self, connection: _Connection) -> None:
+        if self._closing:
+            self.shutdown_request(connection.sock)
+        elif connection.request_line() is not None:
+            self._admit(connection)  # pipelined request already buffered
+        else:
+            connection.idle_since = time.monotonic()
+            self._selector.register(connection.sock, selectors.EVENT_READ, connection)
+            with self._lock:
+                self._stats.idle_connections += 1
+
+    def _unwatch(self, connection: _Connection) -> None:
+        self._selector.unregister(connection.sock)
+        with self._lock:
+            self._stats.idle_connections -= 1
+
+    def _receive(self, connection: _Connection) -> None:
+        try:
+            received = connection.fill()
+        except OSError:
+            received = False
+        if not received:
+            self._unwatch(connection)
+            self.shutdown_request(connection.sock)
+        elif connection.request_line() is not None or len(connection.buffer) > 65536:
+            # An overlong line goes to a worker too, which answers 414.
+            self._unwatch(connection)
+            self._admit(connection)
+
+    def _expire_idle(self) -> None:
+        cutoff = time.monotonic() - self.idle_timeout
+        for key in list(self._selector.get_map().values()):
+            connection = key.data
+            if connection is not None and connection.idle_since < cutoff:
+                self._unwatch(connection)
+                self.shutdown_request(connection.sock)
+
+    def _admit(self, connection: _Connection) -> None:
+        priority = self._classify(connection.request_line() or b"")
+        limit = self.queue_size * (len(PRIORITIES) - priority) // len(PRIORITIES)
+        with self._lock:
+            stats = self._stats
+            admitted = stats.queue_depth < limit
+            if admitted:
+                stats.accepted += 1
+                stats.queue_depth += 1
+                stats.max_queue_depth = max(stats.max_queue_depth, stats.queue_depth)
+            else:
+                stats.rejected[PRIORITIES[priority]] += 1
+        if admitted:
+            self._queue.put((priority, next(self._order), connection))
+        else:
+            self._reject(connection.sock)
+
+    @staticmethod
+    def _classify(request_line: bytes) -> int:
+        parts = request_line.rstrip(b"\r").split(b" ")
+        if len(parts) < 2:
+            return 1
+        return classify(parts[0].decode("latin-1"), urlsplit(parts[1].decode("latin-1")).path)
+
+    def _reject(self, request: socket.socket) -> None:
+        try:
+            request.settimeout(0)
+            try:
+                # Drain what the client already sent so closing does not reset the
+                # connection before it reads the 503.
+                request.recv(65536)
+            except OSError:
+                pass
+            request.sendall(self._busy)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def _work(self) -> None:
+        while True:
+            _, _, connection = self._queue.get()
+            if connection is None:
+                return
+            with self._lock:
+                self._stats.queue_depth -= 1
+                self._stats.busy_workers += 1
+            keep_alive = False
+            self._local.connection = connection
+            try:
+                handler = self.RequestHandlerClass(connection.sock, connection.address, self)
+                keep_alive = not handler.close_connection
+            except Exception:  # pragma: no cover - mirrors socketserver's error handling
+                self.handle_error(connection.sock, connection.address)
+            finally:
+                self._local.connection = None
+                with self._lock:
+                    self._stats.busy_workers -= 1
+                    self._stats.served += 1
+                if keep_alive and not self._closing:
+                    self._hand_to_reader(connection)
+                else:
+                    self.shutdown_request(connection.sock)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self._closing = True
+        self._wake_reader()
+        self._reader.join()
+        for _ in self._workers:
+            self._queue.put((len(PRIORITIES), next(self._order), None))
+        for thread in self._workers:
+            thread.join()
+        self._workers = []
+        self._wakeup.close()
+        self._wakeup_writer.close()
+
+
+class PooledHTTPRequestHandler(AdaptiveHTTPRequestHandler):
+    """Request handler for :class:`PooledHTTPServer`.
+
+    Serves a single request per call and reads it from the connection
+    buffer of the server's reader stage; the server hands a kept-alive
+    connection back to the reader stage afterwards, so idle connections do
+    not pin a worker.
+    """
+
+    timeout = 5
+    # ``rfile`` is replaced by the server's connection buffer.
+    rbufsize = 0
+
+    def setup(self) -> None:
+        super().setup()
+        self.rfile = self.server.request_reader()  # type: ignore[attr-defined]
+
+    def handle(self) -> None:
+        self.handle_one_request()
+
+    def _handle_request(self, send_body: bool = True) -> None:
+        if self.command == "GET" and urlsplit(self.path).path == STATS_PATH:
+            body = json.dumps(self.server.stats().to_dict()).encode("utf-8")  # type: ignore[attr-defined]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        super()._handle_request(send_body)
+
+
+class _RequestError(Exception):
+    """A request that is answered with ``status`` and then the connection is closed."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncHTTPServer:
+    """HTTP/1.1 server on :mod:`asyncio` streams.
+
+    Every connection is a coroutine, so an idle keep-alive connection costs
+    a few kilobytes rather than a thread. Requests on one connection are
+    handled in order, so pipelined requests get their responses in the order
+    they were sent. Requests that :func:`~app.http_router.blocking` reports
+    as pure CPU work run inline on the loop; the others (static files,
+    finishing, sessions that are evicted or locked by another request) run
+    on a thread pool of ``workers`` threads.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        workers: int = 16,
+        max_header_bytes: int = 16 * 1024,
+        max_headers: int = 100,
+        max_body_bytes: int = 1024 * 1024,
+        keep_alive_timeout: float = 120.0,
+        header_timeout: float = 10.0,
+        body_timeout: float = 30.0,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.max_header_bytes = max_header_bytes
+        self.max_headers = max_headers
+        self.max_body_bytes = max_body_bytes
+        self.keep_alive_timeout = keep_alive_timeout
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http-blocking")
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[asyncio.StreamWriter, "asyncio.Task[None]"] = {}
+
+    @property
+    def connections(self) -> int:
+        return len(self._connections)
+
+    async def start(self) -> Tuple[str, int]:
+        self._server = await asyncio.start_server(
+            self._serve_connection, self.host, self.port, limit=self.max_header_bytes, backlog=1024
+        )
+        address = self._server.sockets[0].getsockname()
+        return address[0], address[1]
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()  # type: ignore[union-attr]
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        # Closing the transports ends every connection coroutine at its next read.
+        tasks = list(self._connections.values())
+        for writer in list(self._connections):
+            writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections[writer] = asyncio.current_task()  # type: ignore[assignment]
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+                except (asyncio.TimeoutError, ConnectionError):
+                    return
+                except ValueError:
+                    await self._write_error(writer, 414, "Request line too long")
+                    return
+                if not request_line:
+                    return  # client closed the connection
+                if request_line in (b"\r\n", b"\n"):
+                    continue  # RFC 9112 §2.2: ignore empty lines before a request
+                try:
+                    keep_alive = await self._serve_request(request_line, reader, writer)
+                except _RequestError as exc:
+                    await self._write_error(writer, exc.status, str(exc))
+                    return
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+        finally:
+            del self._connections[writer]
+            writer.close()
+
+    async def _serve_request(
+        self, request_line: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> bool:
+        try:
+            method, target, version = request_line.decode("latin-1").rstrip("\r\n").split(" ")
+        except ValueError:
+            raise _RequestError(400, "Malformed request line") from None
+        if version not in ("HTTP/1.1", "HTTP/1.0"):
+            raise _RequestError(505, "HTTP version not supported")
+        try:
+            headers = await asyncio.wait_for(self._read_headers(reader), self.header_timeout)
+        except asyncio.TimeoutError:
+            raise _RequestError(408, "Request header timeout") from None
+        connection = headers.get("connection", "").lower()
+        keep_alive = "close" not in connection if version == "HTTP/1.1" else "keep-alive" in connection
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        try:
+            body = await asyncio.wait_for(self._read_body(reader, headers), self.body_timeout)
+        except asyncio.TimeoutError:
+            raise _RequestError(408, "Request body timeout") from None
+
+        path = urlsplit(target).path
+        try:
+            response = None if blocking(method, path) else dispatch_inline(method, path, body, headers)
+            if response is None:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self._executor, dispatch, method, path, body, headers)
+            status, response_headers, content = response
+        except Exception:  # pragma: no cover - defensive, mirrors socketserver.handle_error
+            logger.exception("Unhandled error for %s %s", method, path)
+            status, response_headers, content = 500, {"Content-Type": "text/plain; charset=utf-8"}, b"Internal error"
+        if isinstance(content, FileRegion):
+            self._write_response(writer, status, response_headers, b"", keep_alive, len(content))
+            await writer.drain()
+            if method != "HEAD" and content.length:
+                await self._send_file(writer, content)
+            return keep_alive
+        self._write_response(writer, status, response_headers, b"" if method == "HEAD" else content, keep_alive, len(content))
+        await writer.drain()
+        return keep_alive
+
+    @staticmethod
+    async def _send_file(writer: asyncio.StreamWriter, region: FileRegion) -> None:
+        # loop.sendfile uses os.sendfile on plain sockets and falls back to
+        # reads and writes on transports that cannot (TLS, some loops).
+        with region.path.open("rb") as handle:
+            await asyncio.get_running_loop().sendfile(writer.transport, handle, region.offset, region.length)
+
+    async def _read_headers(self, reader: asyncio.StreamReader) -> Dict[str, str]:
+        headers: Dict[str, str] = {}
+        size = 0
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise _RequestError(431, "Request header fields too large") from None
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+            if line in (b"\r\n", b"\n"):
+                return headers
+            size += len(line)
+            if size > self.max_header_bytes or len(headers) >= self.max_headers:
+                raise _RequestError(431, "Request header fields too large")
+            name, sep, value = line.decode("latin-1").partition(":")
+            if not sep or not name or name != name.strip():
+                raise _RequestError(400, "Malformed header")
+            key = name.lower()
+            value = value.strip()
+            headers[key] = f"{headers[key]}, {value}" if key in headers else value
+
+    async def _read_body(self, reader: asyncio.StreamReader, headers: Dict[str, str]) -> bytes:
+        encoding = headers.get("transfer-encoding", "").lower()
+        if encoding:
+            if encoding != "chunked":
+                raise _RequestError(501, "Unsupported transfer encoding")
+            return await self._read_chunked(reader)
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise _RequestError(400, "Invalid Content-Length") from None
+        if length < 0:
+            raise _RequestError(400, "Invalid Content-Length")
+        if length > self.max_body_bytes:
+            raise _RequestError(413, "Request body too large")
+        return await reader.readexactly(length) if length else b""
+
+    async def _read_chunked(self, reader: asyncio.StreamReader) -> bytes:
+        chunks: List[bytes] = []
+        size = 0
+        while True:
+            try:
+                length = int((await reader.readline()).split(b";", 1)[0], 16)
+            except ValueError:
+                raise _RequestError(400, "Malformed chunk size") from None
+            if length == 0:
+                break
+            size += length
+            if size > self.max_body_bytes:
+                raise _RequestError(413, "Request body too large")
+            chunks.append(await reader.readexactly(length))
+            await reader.readexactly(2)
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # trailer fields are ignored
+        return b"".join(chunks)
+
+    def _write_response(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        headers: Dict[str, str],
+        content: bytes,
+        keep_alive: bool,
+        length: int,
+    ) -> None:
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ""
+        lines = [f"HTTP/1.1 {status} {reason}", f"Date: {formatdate(usegmt=True)}"]
+        lines.extend(f"{key}: {value}" for key, value in headers.items() if key.lower() != "content-length")
+        if status != 304:
+            lines.append(f"Content-Length: {length}")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + content)
+
+    async def _write_error(self, writer: asyncio.StreamWriter, status: int, message: str) -> None:
+        body = json.dumps({"detail": message}).encode("utf-8")
+        self._write_response(writer, status, {"Content-Type": "application/json; charset=utf-8"}, body, False, len(body))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+async def serve_async(host: str = "127.0.0.1", port: int = 8000, workers: int = 16) -> None:
+    server = AsyncHTTPServer(host, port, workers=workers)
+    address = await server.start()
+    print(f"Serving adaptive test UI on http://{address[0]}:{address[1]} (asyncio)")
+    start_background_tasks()
+    try:
+        await server.serve_forever()
+    finally:
+        stop_background_tasks()
+        await server.close()
+
+
+def run(host: str = "127.0.0.1", port: int = 8000, pool: int = 0, queue_size: int = 0) -> Tuple[str, int]:
+    """Start the development server and return the host/port in use.
+
+    ``pool`` > 0 selects :class:`PooledHTTPServer` with that many workers and
+    a queue of ``queue_size`` connections (default: four per worker).
+    """
+    if pool > 0:
+        server: HTTPServer = PooledHTTPServer(
+            (host, port), PooledHTTPRequestHandler, workers=pool, queue_size=queue_size or 4 * pool
+        )
+    else:
+        server = ThreadingHTTPServer((host, port), AdaptiveHTTPRequestHandler)
     address = server.server_address
     print(f"Serving adaptive test UI on http://{address[0]}:{address[1]}")
+    start_background_tasks()
     try:
         server.serve_forever()
     except KeyboardInterrupt:  # pragma: no cover - manual shutdown
         print("\nStopping server…")
     finally:
+        stop_background_tasks()
         server.server_close()
     return address
 
@@ -56,8 +697,17 @@ def main() -> None:
     parser = argparse.ArgumentParser(description="Run the adaptive English level test server")
     parser.add_argument("--host", default="127.0.0.1", help="Hostname to bind (default: 127.0.0.1)")
     parser.add_argument("--port", default=8000, type=int, help="Port to bind (default: 8000)")
+    parser.add_argument("--pool", default=0, type=int, help="Worker threads; 0 spawns a thread per connection (default: 0; 16 blocking-call threads with --asyncio)")
+    parser.add_argument("--queue", default=0, type=int, help="Accept queue size with --pool (default: 4 per worker)")
+    parser.add_argument("--asyncio", action="store_true", help="Serve connections from an asyncio event loop")
     args = parser.parse_args()
-    run(args.host, args.port)
+    if args.asyncio:
+        try:
+            asyncio.run(serve_async(args.host, args.port, workers=args.pool or 16))
+        except KeyboardInterrupt:  # pragma: no cover - manual shutdown
+            print("\nStopping server…")
+        return
+    run(args.host, args.port, args.pool, args.queue)
 
 
 if __name__ == "__main__":
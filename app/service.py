@@ -1,52 +1,176 @@
 """Service layer implementing the Adaptive English Level Test logic."""
 from __future__ import annotations
 
+import json
+import threading
 from datetime import datetime
-from typing import Dict, List, Optional
+from pathlib import Path
+from typing import ContextManager, Dict, List, Optional, Tuple
 from uuid import UUID
 
 from . import schemas
 from .cat_engine import (
     CAT_PARTS,
+    ESTIMATION_METHODS,
     Response as ResponseRecord,
     Session,
     Item,
+    bank_with_fingerprint,
     register_item_bank,
     select_next_item,
+    selection_from_env,
     score_response,
-    update_theta_map,
-    it_lookup,
+    update_theta,
 )
-from .database import (
-    init_db,
-    record_response,
-    record_test_finish,
-    record_test_start,
-    update_test_state,
+from .database import init_db, play_state, record_play_at, record_response_at
+from .item_payloads import ItemPayloadCache
+from .media import PREVIEW_BYTES, AudioLibrary, MediaAccessDenied, media_from_env
+from .bank_snapshot import load_item_bank
+from .session_journal import SessionJournal, journal_from_env
+from .session_locks import LockStats, StripedLocks
+from .session_store import (
+    SESSION_TIME_LIMIT,
+    SessionBankUnavailable,
+    SessionReaper,
+    all_sessions,
+    build_session,
+    configure_reaper,
+    create_session,
+    current_store,
+    finish_session,
+    get_session,
+    restore_sessions,
 )
-from .item_bank import ITEMS
-from .session_store import create_session, get_session
+from .session_token import InvalidToken, SessionTokenCodec, TokenLedger, token_codec_from_env
+from .write_behind import WriteBehindQueue, default_writer
 
-register_item_bank(ITEMS)
+ITEMS = load_item_bank()
+register_item_bank(ITEMS, selection=selection_from_env())
 init_db()
 
+# Shared by every service instance, since they all work on the same store.
+SESSION_LOCKS = StripedLocks()
+JOURNAL = journal_from_env(sessions=all_sessions, lock=SESSION_LOCKS.hold)
+TOKENS = token_codec_from_env()
+# Newest token per test, shared by every service instance like the locks above.
+TOKEN_LEDGER = TokenLedger(ttl=SESSION_TIME_LIMIT)
+MEDIA = media_from_env()
+ITEM_PAYLOADS = ItemPayloadCache()
+
 
 class AdaptiveTestService:
-    """Implements the business rules for the adaptive test."""
+    """Implements the business rules for the adaptive test.
+
+    With a ``tokens`` codec the service is stateless: sessions are never
+    stored, every response carries a signed ``session_token`` with the full
+    CAT state, and each call rebuilds the session from the token the client
+    sends back. SQLite then only receives the audit log. Tokens older than
+    the newest one this process issued for a test are refused (see
+    :class:`~app.session_token.TokenLedger`), and every answer and audio play
+    is recorded at its position in SQLite only if that position is still
+    free, so an item cannot be answered or played again from an earlier
+    state on any process that shares the database.
+
+    Every call that reads or changes a session holds that session's stripe
+    of ``locks``, so concurrent requests for one test id run one at a time.
+
+    Listening items whose audio is in the ``media`` library get signed
+    links to it instead of the external ``audio_url``; see :mod:`app.media`.
+    """
+
+    def __init__(
+        self,
+        estimation: str = "map",
+        writer: Optional[WriteBehindQueue] = None,
+        journal: Optional[SessionJournal] = None,
+        tokens: Optional[SessionTokenCodec] = None,
+        locks: Optional[StripedLocks] = None,
+        media: Optional[AudioLibrary] = None,
+        ledger: Optional[TokenLedger] = None,
+    ) -> None:
+        if estimation not in ESTIMATION_METHODS:
+            raise ValueError(f"Unsupported estimation method: {estimation}")
+        self._estimation = estimation
+        self._writer = writer or default_writer()
+        self._tokens = tokens or TOKENS
+        self._journal = None if self._tokens is not None else journal or JOURNAL
+        self._locks = locks or SESSION_LOCKS
+        self._ledger = ledger or TOKEN_LEDGER
+        self._media = media or MEDIA
+        self._payloads = ITEM_PAYLOADS
+
+    @property
+    def stateless(self) -> bool:
+        return self._tokens is not None
+
+    def may_block(self, test_id: UUID) -> bool:
+        """Whether serving the next item or the report of ``test_id`` may wait on disk or another thread.
+
+        Event servers use this to run the call inline or on an executor; it
+        is a hint and not a guarantee, so inline calls also run inside
+        :meth:`nonblocking`. Calls that record events always go to the
+        executor, since the write-behind queue blocks them while it is full.
+        """
+
+        if self._journal is not None and self._journal.fsync:
+            return True
+        if self._tokens is not None:
+            return False
+        return self._locks.busy(test_id) or current_store().blocks(test_id)
+
+    def nonblocking(self) -> ContextManager[None]:
+        """Within the block, calls raise :class:`~app.session_locks.LockBusy` instead of waiting for a session lock."""
 
-    def __init__(self) -> None:
-        self._items = ITEMS
+        return self._locks.nonblocking()
 
-    def _get_session(self, test_id: UUID) -> Session:
+    def lock_stats(self) -> LockStats:
+        """Acquisition and wait-time counters of the per-session locks."""
+
+        return self._locks.stats()
+
+    def _get_session(self, test_id: UUID, token: Optional[str] = None) -> Session:
+        if self._tokens is not None:
+            return self._session_from_token(test_id, token)
         try:
             return get_session(test_id)
+        except SessionBankUnavailable as exc:
+            raise ValueError("The item bank of this test is no longer available") from exc
         except KeyError as exc:  # pragma: no cover - safety net
             raise ValueError("Test session not found") from exc
 
+    def _session_from_token(self, test_id: UUID, token: Optional[str]) -> Session:
+        if not token:
+            raise ValueError("Session token required")
+        session = self._tokens.decode(token)  # type: ignore[union-attr]
+        if session.id != str(test_id):
+            raise ValueError("Session token does not belong to this test")
+        self._ledger.check(session)
+        # Without a server-side timer the time limit is checked on every request.
+        elapsed = (datetime.utcnow() - session.started_at).total_seconds()
+        if not session.finished and elapsed > SESSION_TIME_LIMIT:
+            self.expire_session(session)
+        return session
+
+    def _with_token(self, session: Session, payload: Dict[str, object]) -> Dict[str, object]:
+        if self._tokens is not None:
+            payload["session_token"] = self._token_for(session)
+        return payload
+
+    def _token_for(self, session: Session) -> str:
+        token = self._tokens.encode(session)  # type: ignore[union-attr]
+        self._ledger.issued(session)
+        return token
+
     def start_test(self, payload: Dict[str, object]) -> Dict[str, object]:
         request = schemas.StartTestRequest.from_dict(payload)
-        session = create_session(request.start_level, request.first_name, request.last_name)
-        record_test_start(
+        new_session = build_session if self._tokens is not None else create_session
+        session = new_session(
+            request.start_level,
+            request.first_name,
+            request.last_name,
+            estimation=self._estimation,
+        )
+        self._writer.record_test_start(
             session.id,
             session.first_name,
             session.last_name,
@@ -54,6 +178,8 @@ class AdaptiveTestService:
             session.started_at,
             session.upcoming_domain,
         )
+        if self._journal is not None:
+            self._journal.started(session)
         response = schemas.StartTestResponse(
             test_id=UUID(session.id),
             theta=session.theta,
@@ -62,14 +188,14 @@ class AdaptiveTestService:
             paused=session.paused,
             upcoming_part=session.upcoming_domain,
         )
-        return response.to_dict()
+        return self._with_token(session, response.to_dict())
 
     def _ensure_next_item(self, session: Session) -> Item:
         if session.finished:
             raise ValueError("Test already finished")
         if session.paused:
             raise ValueError("Test section is paused")
-        item = select_next_item(session, self._items)
+        item = select_next_item(session)
         if item is None:
             if session.pending_item_id is not None:
                 session.pending_item_id = None
@@ -78,134 +204,257 @@ class AdaptiveTestService:
             raise ValueError("No more items available")
         return item
 
-    def get_next_item(self, test_id: UUID) -> Dict[str, object]:
-        session = self._get_session(test_id)
-        if session.paused:
-            response = schemas.PauseResponse(
-                domain=session.upcoming_domain or session.current_domain(),
-                message="Take a short break before continuing to the next section.",
-                questions=schemas.DOMAIN_LENGTHS.get(session.upcoming_domain or session.current_domain(), 0),
+    def get_next_item(self, test_id: UUID, token: Optional[str] = None) -> Dict[str, object]:
+        with self._locks.hold(test_id):
+            session, item = self._serve_next_item(test_id, token)
+            if item is None:
+                return self._with_token(session, self._pause_response(session).to_dict())
+            response = schemas.ItemResponse(
+                item_id=item.id,
+                stem=item.stem,
+                options=item.options,
+                domain=item.domain,
+                model=item.model,
+                metadata=self._item_metadata(session, item),
+                max_plays=item.max_plays,
             )
-            return response.to_dict()
-        item = self._ensure_next_item(session)
-        response = schemas.ItemResponse(
-            item_id=item.id,
-            stem=item.stem,
-            options=item.options,
-            domain=item.domain,
-            model=item.model,
-            metadata=item.metadata,
-            max_plays=item.max_plays,
-        )
-        return response.to_dict()
+            return self._with_token(session, response.to_dict())
 
-    def submit_answer(self, test_id: UUID, payload: Dict[str, object]) -> Dict[str, object]:
-        session = self._get_session(test_id)
-        if session.finished:
-            raise ValueError("Test already finished")
+    def get_next_item_json(self, test_id: UUID, token: Optional[str] = None) -> bytes:
+        """:meth:`get_next_item` encoded as JSON, with the item taken from the payload cache."""
+
+        with self._locks.hold(test_id):
+            session, item = self._serve_next_item(test_id, token)
+            if item is None:
+                payload = self._with_token(session, self._pause_response(session).to_dict())
+                return json.dumps(payload).encode("utf-8")
+            return self._payloads.render(
+                session.bank,
+                item,
+                audio_url=self._audio_url(session, item, 0),
+                session_token=None if self._tokens is None else self._token_for(session),
+            )
+
+    def _serve_next_item(self, test_id: UUID, token: Optional[str]) -> Tuple[Session, Optional[Item]]:
+        """The session and its pending item (``None`` during a pause), selecting one if needed."""
+
+        session = self._get_session(test_id, token)
         if session.paused:
-            raise ValueError("Resume the section before submitting answers")
-        request = schemas.AnswerRequest.from_dict(payload)
-        item = session.item_history.get(request.item_id)
-        if item is None:
-            item = it_lookup.get(request.item_id)
-        if item is None:
-            raise ValueError("Item not found")
-        session.item_history[item.id] = item
-        score = score_response(item, request.response)
-        theta_before = session.theta
-        theta_after, se = update_theta_map(session, item, score)
-        session.theta = theta_after
-        session.se = se
-        session.responses.append(
-            ResponseRecord(
-                item_id=item.id,
+            return session, None
+        pending, finished = session.pending_item_id, session.finished
+        try:
+            item = self._ensure_next_item(session)
+        except ValueError:
+            if self._journal is not None and session.finished and not finished:
+                self._journal.finished(session)
+            raise
+        if self._journal is not None and item.id != pending:
+            self._journal.served(session, item.id)
+        return session, item
+
+    @staticmethod
+    def _pause_response(session: Session) -> schemas.PauseResponse:
+        domain = session.upcoming_domain or session.current_domain()
+        return schemas.PauseResponse(
+            domain=domain,
+            message="Take a short break before continuing to the next section.",
+            questions=schemas.DOMAIN_LENGTHS.get(domain, 0),
+        )
+
+    def submit_answer(
+        self, test_id: UUID, payload: Dict[str, object], token: Optional[str] = None
+    ) -> Dict[str, object]:
+        with self._locks.hold(test_id):
+            session = self._get_session(test_id, token)
+            if session.finished:
+                raise ValueError("Test already finished")
+            if session.paused:
+                raise ValueError("Resume the section before submitting answers")
+            request = schemas.AnswerRequest.from_dict(payload)
+            item = session.lookup_item(request.item_id)
+            if item is None:
+                raise ValueError("Item not found")
+            session.item_history[item.id] = item
+            score = score_response(item, request.response)
+            theta_before = session.theta
+            theta_after, se = update_theta(session, item, score)
+            session.theta = theta_after
+            session.se = se
+            session.responses.append(
+                ResponseRecord(
+                    item_id=item.id,
+                    score=score,
+                    theta_before=theta_before,
+                    theta_after=theta_after,
+                    se_after=se,
+                    raw_response=request.response,
+                )
+            )
+            if self._tokens is None:
+                self._writer.record_response(session.id, item.id, item.domain, score, datetime.utcnow())
+            elif not record_response_at(
+                len(session.responses) - 1, session.id, item.id, item.domain, score, datetime.utcnow(), self._writer.path
+            ):
+                # Another process already recorded an answer from this state.
+                raise InvalidToken("Session token has been superseded by a newer one")
+            session.record_domain_progress(item.domain)
+            session.pending_item_id = None
+            next_part: Optional[str] = None
+            if session.finished:
+                next_part = None
+            elif session.paused:
+                next_part = session.upcoming_domain
+                self._writer.update_test_state(session.id, session.upcoming_domain, True)
+            else:
+                next_part = session.current_domain()
+            if self._journal is not None:
+                self._journal.answered(session, item.domain)
+            response = schemas.AnswerResponse(
+                theta=session.theta,
+                se=session.se,
+                correct=score > 0.0,
                 score=score,
-                theta_before=theta_before,
-                theta_after=theta_after,
-                se_after=se,
-                raw_response=request.response,
+                next_part=next_part,
             )
-        )
-        record_response(session.id, item.id, item.domain, score, datetime.utcnow())
-        session.record_domain_progress(item.domain)
-        session.pending_item_id = None
-        next_part: Optional[str] = None
-        if session.finished:
-            next_part = None
-        elif session.paused:
-            next_part = session.upcoming_domain
-            update_test_state(session.id, session.upcoming_domain, True)
+            return self._with_token(session, response.to_dict())
+
+    def record_play(
+        self, test_id: UUID, payload: Dict[str, object], token: Optional[str] = None
+    ) -> Dict[str, object]:
+        with self._locks.hold(test_id):
+            session = self._get_session(test_id, token)
+            request = schemas.PlayRequest.from_dict(payload)
+            item = session.lookup_item(request.item_id)
+            if item is None:
+                raise ValueError("Item not found")
+            if item.domain != "listening":
+                raise ValueError("Play tracking applies to listening items only")
+            current = session.plays.get(item.id, 0)
+            if current >= item.max_plays:
+                raise ValueError("Max plays reached")
+            current += 1
+            if self._tokens is not None and not record_play_at(
+                current, session.id, item.id, datetime.utcnow(), self._writer.path
+            ):
+                # Another process already registered this play from the same state.
+                raise InvalidToken("Session token has been superseded by a newer one")
+            session.plays[item.id] = current
+            if self._journal is not None:
+                self._journal.played(session, item.id)
+            response = schemas.PlayResponse(
+                plays=current,
+                max_plays=item.max_plays,
+                audio_url=self._audio_url(session, item, current),
+            )
+            return self._with_token(session, response.to_dict())
+
+    def audio_file(self, test_id: UUID, item_id: str, link: str) -> Tuple[Path, Optional[int]]:
+        """The audio file behind a signed link and how many leading bytes of it may be served.
+
+        Play 0 (the link sent with the item) only covers a short preview; the
+        link for play *n* is valid while *n* is the latest registered play of
+        the pending item. Stateless sessions are checked against the plays
+        and answers recorded in SQLite, and the item is taken from the bank
+        the link was signed for.
+        """
+
+        if self._media is None:
+            raise ValueError("Audio not found")
+        play, fingerprint = self._media.signer.verify(str(test_id), item_id, link)
+        limit = PREVIEW_BYTES if play == 0 else None
+        if self._tokens is not None:
+            latest, answered = play_state(str(test_id), item_id, self._writer.path)
+            if answered:
+                raise MediaAccessDenied("Audio is only available for the current item")
+            if play and latest != play:
+                raise MediaAccessDenied("This play is over")
+            bank = bank_with_fingerprint(fingerprint)
+            item = None if bank is None else bank.lookup.get(item_id)
         else:
-            next_part = session.current_domain()
-        response = schemas.AnswerResponse(
-            theta=session.theta,
-            se=session.se,
-            correct=score > 0.0,
-            score=score,
-            next_part=next_part,
-        )
-        return response.to_dict()
+            with self._locks.hold(test_id):
+                session = self._get_session(test_id)
+                if session.finished or session.pending_item_id != item_id:
+                    raise MediaAccessDenied("Audio is only available for the current item")
+                if play and session.plays.get(item_id, 0) != play:
+                    raise MediaAccessDenied("This play is over")
+                item = session.lookup_item(item_id)
+        path = None if item is None else self._media.file_for(item)
+        if path is None:
+            raise ValueError("Audio not found")
+        if play > item.max_plays:  # type: ignore[union-attr]
+            raise MediaAccessDenied("Max plays reached")
+        return path, limit
 
-    def record_play(self, test_id: UUID, payload: Dict[str, object]) -> Dict[str, object]:
-        session = self._get_session(test_id)
-        request = schemas.PlayRequest.from_dict(payload)
-        item = session.item_history.get(request.item_id)
-        if item is None:
-            item = it_lookup.get(request.item_id)
-        if item is None:
-            raise ValueError("Item not found")
-        if item.domain != "listening":
-            raise ValueError("Play tracking applies to listening items only")
-        current = session.plays.get(item.id, 0)
-        if current >= item.max_plays:
-            raise ValueError("Max plays reached")
-        current += 1
-        session.plays[item.id] = current
-        response = schemas.PlayResponse(plays=current, max_plays=item.max_plays)
-        return response.to_dict()
-
-    def finish_test(self, test_id: UUID) -> Dict[str, object]:
-        session = self._get_session(test_id)
-        session.finished = True
-        session.pending_item_id = None
-        session.paused = False
-        session.upcoming_domain = None
-        record_test_finish(session.id, datetime.utcnow())
-        t_score = 50 + 10 * session.theta
-        response = schemas.FinishResponse(
-            theta=session.theta,
-            se=session.se,
-            t_score=t_score,
-            cefr=self._cefr_level(session.theta),
-            completed=True,
-        )
-        return response.to_dict()
-
-    def get_report(self, test_id: UUID) -> Dict[str, object]:
-        session = self._get_session(test_id)
-        if not session.finished:
-            raise ValueError("Test not finished")
-        breakdown = self._summarize_domains(session)
-        response = schemas.ReportResponse(
-            test_id=test_id,
-            theta=session.theta,
-            se=session.se,
-            t_score=50 + 10 * session.theta,
-            cefr=self._cefr_level(session.theta),
-            domains=breakdown,
-        )
-        return response.to_dict()
+    def _audio_url(self, session: Session, item: Item, play: int) -> Optional[str]:
+        if self._media is None:
+            return None
+        return self._media.url_for(session.id, item, play, session.bank.fingerprint)
 
-    def resume_section(self, test_id: UUID) -> Dict[str, object]:
-        session = self._get_session(test_id)
-        if session.finished:
-            raise ValueError("Test already finished")
-        if not session.paused:
-            return schemas.ResumeResponse(domain=session.current_domain()).to_dict()
-        session.resume_current_part()
-        update_test_state(session.id, session.current_domain(), False)
-        return schemas.ResumeResponse(domain=session.current_domain()).to_dict()
+    def _item_metadata(self, session: Session, item: Item) -> Optional[Dict[str, str]]:
+        if not item.metadata or "audio_url" not in item.metadata:
+            return item.metadata
+        url = self._audio_url(session, item, 0)
+        if url is None:
+            return item.metadata
+        return {**item.metadata, "audio_url": url}
+
+    def finish_test(self, test_id: UUID, token: Optional[str] = None) -> Dict[str, object]:
+        with self._locks.hold(test_id):
+            session = self._get_session(test_id, token)
+            self.expire_session(session)
+            t_score = 50 + 10 * session.theta
+            response = schemas.FinishResponse(
+                theta=session.theta,
+                se=session.se,
+                t_score=t_score,
+                cefr=self._cefr_level(session.theta),
+                completed=True,
+            )
+            return self._with_token(session, response.to_dict())
+
+    def expire_session(self, session: Session) -> None:
+        """Finish ``session`` on behalf of the candidate (also used at the time limit)."""
+
+        with self._locks.hold(UUID(session.id)):
+            session.finished = True
+            session.pending_item_id = None
+            session.paused = False
+            session.upcoming_domain = None
+            # Finishing is the point where results must be on disk.
+            self._writer.record_test_finish(session.id, datetime.utcnow(), wait=True)
+            if self._journal is not None:
+                self._journal.finished(session)
+            if self._tokens is None:
+                finish_session(UUID(session.id))
+
+    def get_report(self, test_id: UUID, token: Optional[str] = None) -> Dict[str, object]:
+        with self._locks.hold(test_id):
+            session = self._get_session(test_id, token)
+            if not session.finished:
+                raise ValueError("Test not finished")
+            breakdown = self._summarize_domains(session)
+            response = schemas.ReportResponse(
+                test_id=test_id,
+                theta=session.theta,
+                se=session.se,
+                t_score=50 + 10 * session.theta,
+                cefr=self._cefr_level(session.theta),
+                domains=breakdown,
+            )
+            return response.to_dict()
+
+    def resume_section(self, test_id: UUID, token: Optional[str] = None) -> Dict[str, object]:
+        with self._locks.hold(test_id):
+            session = self._get_session(test_id, token)
+            if session.finished:
+                raise ValueError("Test already finished")
+            if not session.paused:
+                return self._with_token(session, schemas.ResumeResponse(domain=session.current_domain()).to_dict())
+            session.resume_current_part()
+            self._writer.update_test_state(session.id, session.current_domain(), False)
+            if self._journal is not None:
+                self._journal.resumed(session)
+            return self._with_token(session, schemas.ResumeResponse(domain=session.current_domain()).to_dict())
 
     @staticmethod
     def _cefr_level(theta: float) -> str:
@@ -224,9 +473,7 @@ class AdaptiveTestService:
     def _summarize_domains(self, session: Session) -> List[schemas.DomainBreakdown]:
         summary: Dict[str, List[float]] = {domain: [] for domain in CAT_PARTS}
         for resp in session.responses:
-            item = session.item_history.get(resp.item_id)
-            if item is None:
-                item = it_lookup.get(resp.item_id)
+            item = session.lookup_item(resp.item_id)
             if item is None:
                 continue
             summary[item.domain].append(resp.score)
@@ -248,4 +495,35 @@ class AdaptiveTestService:
 
 service = AdaptiveTestService()
 
-__all__ = ["AdaptiveTestService", "service"]
+# Enforce the TZ §6.5 time limit server-side and keep memory bounded.
+REAPER = SessionReaper(on_timeout=service.expire_session)
+configure_reaper(REAPER)
+
+_restored = False
+_background_lock = threading.Lock()
+
+
+def start_background_tasks() -> None:
+    """Restore journaled sessions (once per process) and start the reaper.
+
+    The servers call this when they start serving, so importing the service
+    neither reads the journal nor starts a thread.
+    """
+
+    global _restored
+    with _background_lock:
+        if not _restored:
+            _restored = True
+            if JOURNAL is not None:
+                restore_sessions(JOURNAL.replay())
+        REAPER.start()
+
+
+def stop_background_tasks() -> None:
+    """Stop the reaper; :func:`start_background_tasks` starts it again."""
+
+    with _background_lock:
+        REAPER.stop()
+
+
+__all__ = ["AdaptiveTestService", "service", "start_background_tasks", "stop_background_tasks"]
@@ -0,0 +1,447 @@
+"""Append-only journal of session events for crash recovery.
+
+Every state change the service makes to a :class:`~app.cat_engine.Session`
+is appended to a single journal file as a small binary record::
+
+    frame    payload length, CRC-32 of the payload
+    payload  kind, session UUID, part index, flags, pending item id, body
+
+Each record carries the session's phase after the event (part index,
+paused/finished flags, pending item), and answers carry their position in
+the response log, so replaying a record twice leaves the session unchanged.
+That makes compaction simple: :meth:`SessionJournal.compact` starts
+collecting what is appended from then on, writes a snapshot of all live
+sessions as synthetic records into a new file, copies over the collected
+records and atomically replaces the journal with it. Automatic compaction
+runs on a background thread of the journal, and appends only wait for it
+while the two files are swapped. A torn record at the end of the file (a
+crash mid-write) fails its checksum and is cut off during replay.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import struct
+import threading
+import zlib
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import BinaryIO, Callable, ContextManager, Dict, Iterable, List, Optional
+from uuid import UUID
+
+from app.cat_engine import CAT_PARTS, ItemBank, Response, Session, current_bank
+from app.session_state import decode_raw_response
+
+JOURNAL_ENV = "ADAPTIVE_TEST_JOURNAL"
+
+logger = logging.getLogger(__name__)
+
+START = 1
+SERVED = 2
+ANSWER = 3
+PLAY = 4
+RESUME = 5
+FINISH = 6
+
+_PAUSED = 1
+_FINISHED = 2
+_UPCOMING = 4
+
+_FRAME = struct.Struct("<II")
+_PREFIX = struct.Struct("<B16sBB")
+_START = struct.Struct("<qdddd")
+_ANSWER = struct.Struct("<Idddd")
+_COUNT = struct.Struct("<H")
+_LENGTH = struct.Struct("<H")
+_NONE = 0xFFFF
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _pack_text(buffer: bytearray, value: Optional[str]) -> None:
+    if value is None:
+        buffer += _LENGTH.pack(_NONE)
+        return
+    _pack_bytes(buffer, value.encode("utf-8"))
+
+
+def _pack_bytes(buffer: bytearray, value: bytes) -> None:
+    buffer += _LENGTH.pack(len(value))
+    buffer += value
+
+
+def _unpack_bytes(data: memoryview, offset: int) -> tuple[Optional[bytes], int]:
+    (length,) = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    if length == _NONE:
+        return None, offset
+    return bytes(data[offset : offset + length]), offset + length
+
+
+def _unpack_text(data: memoryview, offset: int) -> tuple[Optional[str], int]:
+    raw, offset = _unpack_bytes(data, offset)
+    return (None if raw is None else raw.decode("utf-8")), offset
+
+
+def encode_event(kind: int, session: Session, body: bytes = b"") -> bytes:
+    """Frame one ``kind`` record for ``session`` with its current phase."""
+
+    flags = (
+        (_PAUSED if session.paused else 0)
+        | (_FINISHED if session.finished else 0)
+        | (_UPCOMING if session.upcoming_domain is not None else 0)
+    )
+    payload = bytearray(_PREFIX.pack(kind, UUID(session.id).bytes, session.part_index, flags))
+    _pack_text(payload, session.pending_item_id)
+    payload += body
+    return _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _start_body(session: Session) -> bytes:
+    started = session.started_at - _EPOCH
+    body = bytearray(
+        _START.pack(
+            (started.days * 86_400 + started.seconds) * 1_000_000 + started.microseconds,
+            session.theta,
+            session.prior_mu,
+            session.prior_sigma,
+            session.se,
+        )
+    )
+    for value in (session.start_level, session.first_name, session.last_name, session.estimation):
+        _pack_text(body, value)
+    return bytes(body)
+
+
+def _item_body(item_id: str) -> bytes:
+    body = bytearray()
+    _pack_text(body, item_id)
+    return bytes(body)
+
+
+def _answer_body(session: Session, index: int, domain: str) -> bytes:
+    log = session.responses
+    body = bytearray(
+        _ANSWER.pack(index, log.scores[index], log.theta_before[index], log.theta_after[index], log.se_after[index])
+    )
+    _pack_text(body, log.item_id(index))
+    _pack_text(body, domain)
+    _pack_bytes(body, log.raw_blob(index))
+    return bytes(body)
+
+
+def _play_body(item_id: str, plays: int) -> bytes:
+    return _item_body(item_id) + _COUNT.pack(plays)
+
+
+def encode_session(session: Session) -> bytes:
+    """Synthetic records that rebuild ``session`` from nothing."""
+
+    records = [encode_event(START, session, _start_body(session))]
+    for item_id in session.seen_items:
+        records.append(encode_event(SERVED, session, _item_body(item_id)))
+    for index in range(len(session.responses)):
+        item = session.lookup_item(session.responses.item_id(index))
+        domain = item.domain if item is not None else ""
+        records.append(encode_event(ANSWER, session, _answer_body(session, index, domain)))
+    for item_id, plays in session.plays.items():
+        records.append(encode_event(PLAY, session, _play_body(item_id, plays)))
+    return b"".join(records)
+
+
+class SessionJournal:
+    """Appends session events to ``path`` and rebuilds sessions from it.
+
+    ``sessions`` supplies the live sessions for automatic compaction, which
+    runs on a background thread whenever more than ``compact_bytes`` have
+    been appended since the last compaction. Each session is encoded while
+    holding ``lock(session_id)``, the lock its requests change it under.
+    With ``fsync`` every record is
+    forced to disk; otherwise records reach the OS on every append and
+    survive a process crash.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        fsync: bool = False,
+        compact_bytes: int = 64 << 20,
+        sessions: Optional[Callable[[], Iterable[Session]]] = None,
+        lock: Optional[Callable[[UUID], ContextManager[object]]] = None,
+    ) -> None:
+        self.path = Path(path)
+        self.fsync = fsync
+        self.compact_bytes = compact_bytes
+        self.sessions = sessions
+        self.lock = lock or (lambda session_id: nullcontext())
+        self.appended = 0
+        self._lock = threading.Lock()
+        self._handle: Optional[BinaryIO] = None
+        # Records appended while a compaction writes its snapshot.
+        self._tail: Optional[List[bytes]] = None
+        self._compact_lock = threading.Lock()
+        self._compact_due = threading.Event()
+        self._compactor: Optional[threading.Thread] = None
+        self._closed = False
+
+    # Appending -------------------------------------------------------------------
+
+    def started(self, session: Session) -> None:
+        self._append(encode_event(START, session, _start_body(session)))
+
+    def served(self, session: Session, item_id: str) -> None:
+        self._append(encode_event(SERVED, session, _item_body(item_id)))
+
+    def answered(self, session: Session, domain: str) -> None:
+        self._append(encode_event(ANSWER, session, _answer_body(session, len(session.responses) - 1, domain)))
+
+    def played(self, session: Session, item_id: str) -> None:
+        self._append(encode_event(PLAY, session, _play_body(item_id, session.plays[item_id])))
+
+    def resumed(self, session: Session) -> None:
+        self._append(encode_event(RESUME, session))
+
+    def finished(self, session: Session) -> None:
+        self._append(encode_event(FINISH, session))
+
+    def _append(self, record: bytes) -> None:
+        with self._lock:
+            handle = self._open()
+            handle.write(record)
+            if self.fsync:
+                os.fsync(handle.fileno())
+            if self._tail is not None:
+                self._tail.append(record)
+            self.appended += len(record)
+            compact = self.sessions is not None and self.appended > self.compact_bytes and self._tail is None
+            if compact and self._compactor is None and not self._closed:
+                self._compactor = threading.Thread(target=self._run_compactor, name="journal-compactor", daemon=True)
+                self._compactor.start()
+        if compact:
+            self._compact_due.set()
+
+    def _open(self) -> BinaryIO:
+        if self._handle is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._handle = open(self.path, "ab", buffering=0)
+        return self._handle
+
+    # Compaction ------------------------------------------------------------------
+
+    def compact(self, sessions: Optional[Iterable[Session]] = None) -> int:
+        """Replace the journal with a snapshot of ``sessions`` and return its size.
+
+        ``sessions`` defaults to a fresh iteration of :attr:`sessions`. The
+        snapshot is streamed to disk one session at a time; appends go on
+        meanwhile and are copied after it, replaying them over the snapshot
+        is harmless. Appends only wait while the files are swapped.
+        """
+
+        if sessions is not None:
+            given = sessions
+            source: Callable[[], Iterable[Session]] = lambda: given
+        elif self.sessions is not None:
+            source = self.sessions
+        else:
+            raise ValueError("No session source to compact from")
+        temporary = self.path.with_suffix(self.path.suffix + ".tmp")
+        with self._compact_lock:
+            with self._lock:
+                self._tail = []
+            try:
+                size = 0
+                with open(temporary, "wb") as handle:
+                    # Only read the sessions once the tail is collected, so
+                    # every event is in the snapshot, the tail or both.
+                    for session in source():
+                        with self.lock(UUID(session.id)):
+                            record = encode_session(session)
+                        handle.write(record)
+                        size += len(record)
+                    handle.flush()
+                    os.fsync(handle.fileno())
+                    with self._lock:
+                        tail = b"".join(self._tail)
+                        handle.write(tail)
+                        handle.flush()
+                        os.fsync(handle.fileno())
+                        if self._handle is not None:
+                            self._handle.close()
+                            self._handle = None
+                        os.replace(temporary, self.path)
+                        self.appended = len(tail)
+                        self._tail = None
+            except BaseException:
+                with self._lock:
+                    self._tail = None
+                raise
+        return size + len(tail)
+
+    def _run_compactor(self) -> None:
+        while True:
+            self._compact_due.wait()
+            self._compact_due.clear()
+            if self._closed:
+                return
+            try:
+                self.compact()
+            except Exception:  # pragma: no cover - the journal itself stays valid
+                logger.exception("Journal compaction failed")
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            compactor, self._compactor = self._compactor, None
+        self._compact_due.set()
+        if compactor is not None:
+            compactor.join()
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+    # Replay ----------------------------------------------------------------------
+
+    def replay(self, bank: Optional[ItemBank] = None) -> List[Session]:
+        """Rebuild sessions from the journal, dropping a torn trailing record."""
+
+        with self._lock:
+            try:
+                data = self.path.read_bytes()
+            except FileNotFoundError:
+                return []
+            sessions, offset = decode_records(data, bank)
+            if offset < len(data):
+                if self._handle is not None:
+                    self._handle.close()
+                    self._handle = None
+                with open(self.path, "r+b") as handle:
+                    handle.truncate(offset)
+        return sessions
+
+
+def decode_records(data: bytes, bank: Optional[ItemBank] = None) -> tuple[List[Session], int]:
+    """Apply every intact record in ``data`` and return the sessions and bytes used.
+
+    Decoding stops at the first truncated or corrupt record.
+    """
+
+    bank = bank or current_bank()
+    sessions: Dict[bytes, Session] = {}
+    view = memoryview(data)
+    offset = 0
+    while offset + _FRAME.size <= len(data):
+        length, checksum = _FRAME.unpack_from(view, offset)
+        end = offset + _FRAME.size + length
+        if end > len(data):
+            break
+        payload = view[offset + _FRAME.size : end]
+        if zlib.crc32(payload) != checksum:
+            break
+        _apply(sessions, bank, payload)
+        offset = end
+    return list(sessions.values()), offset
+
+
+def decode_session(blob: bytes, bank: Optional[ItemBank] = None) -> Session:
+    """Inverse of :func:`encode_session`."""
+
+    sessions, offset = decode_records(blob, bank)
+    if len(sessions) != 1 or offset != len(blob):
+        raise ValueError("Corrupt session blob")
+    return sessions[0]
+
+
+def _apply(sessions: Dict[bytes, Session], bank: ItemBank, payload: memoryview) -> None:
+    kind, key, part_index, flags = _PREFIX.unpack_from(payload, 0)
+    pending, offset = _unpack_text(payload, _PREFIX.size)
+    session = sessions.get(key)
+    if kind == START:
+        if session is not None:
+            return
+        started, theta, prior_mu, prior_sigma, se = _START.unpack_from(payload, offset)
+        offset += _START.size
+        start_level, offset = _unpack_text(payload, offset)
+        first_name, offset = _unpack_text(payload, offset)
+        last_name, offset = _unpack_text(payload, offset)
+        estimation, offset = _unpack_text(payload, offset)
+        session = Session(
+            id=str(UUID(bytes=key)),
+            start_level=start_level,
+            theta=theta,
+            prior_mu=prior_mu,
+            prior_sigma=prior_sigma,
+            se=se,
+            first_name=first_name,
+            last_name=last_name,
+            started_at=_EPOCH + timedelta(microseconds=started),
+            estimation=estimation,
+            bank=bank,
+        )
+        sessions[key] = session
+    elif session is None:
+        return
+    elif kind == SERVED:
+        item_id, offset = _unpack_text(payload, offset)
+        session.seen_items.add(item_id)
+        item = bank.lookup.get(item_id)
+        if item is not None:
+            session.item_history[item_id] = item
+    elif kind == ANSWER:
+        index, score, theta_before, theta_after, se_after = _ANSWER.unpack_from(payload, offset)
+        offset += _ANSWER.size
+        item_id, offset = _unpack_text(payload, offset)
+        domain, offset = _unpack_text(payload, offset)
+        raw, offset = _unpack_bytes(payload, offset)
+        if index == len(session.responses):
+            session.responses.append(
+                Response(
+                    item_id=item_id,
+                    score=score,
+                    theta_before=theta_before,
+                    theta_after=theta_after,
+                    se_after=se_after,
+                    raw_response=decode_raw_response(raw or b""),
+                )
+            )
+            session.theta = theta_after
+            session.se = se_after
+            if domain:
+                session.part_counts[domain] = session.part_counts.get(domain, 0) + 1
+            item = bank.lookup.get(item_id)
+            if item is not None:
+                session.item_history[item_id] = item
+    elif kind == PLAY:
+        item_id, offset = _unpack_text(payload, offset)
+        (session.plays[item_id],) = _COUNT.unpack_from(payload, offset)
+    session.part_index = part_index
+    session.paused = bool(flags & _PAUSED)
+    session.finished = bool(flags & _FINISHED)
+    session.pending_item_id = pending
+    # The service only ever announces the current part as the upcoming one.
+    session.upcoming_domain = CAT_PARTS[part_index] if flags & _UPCOMING else None
+
+
+def journal_from_env(
+    environ: Dict[str, str] = os.environ,  # type: ignore[assignment]
+    sessions: Optional[Callable[[], Iterable[Session]]] = None,
+    lock: Optional[Callable[[UUID], ContextManager[object]]] = None,
+) -> Optional[SessionJournal]:
+    """Journal at the path named by :data:`JOURNAL_ENV`, if it is set."""
+
+    path = environ.get(JOURNAL_ENV)
+    if not path:
+        return None
+    return SessionJournal(Path(path), sessions=sessions, lock=lock)
+
+
+__all__ = [
+    "JOURNAL_ENV",
+    "SessionJournal",
+    "decode_records",
+    "decode_session",
+    "encode_event",
+    "encode_session",
+    "journal_from_env",
+]
@@ -0,0 +1,113 @@
+"""Striped per-session locks for the service layer.
+
+Requests for the same test id must not interleave while they mutate the
+session (theta, part counts, the pending item), but requests for different
+candidates should run in parallel. :class:`StripedLocks` hashes a session id
+onto one of a fixed number of re-entrant locks: the memory cost is constant,
+no lock is ever created or removed per session, and two sessions only
+contend when they happen to share a stripe.
+
+An event-loop thread must never wait for a stripe: inside
+:meth:`StripedLocks.nonblocking`, :meth:`StripedLocks.hold` raises
+:class:`LockBusy` instead, and the caller retries on a thread pool.
+
+Every acquisition is timed. The counters live per stripe and are only
+updated by the thread holding that stripe, so instrumentation needs no
+extra lock; :meth:`StripedLocks.stats` adds them up.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, Hashable, Iterator, List
+
+
+@dataclass
+class LockStats:
+    acquisitions: int = 0
+    contended: int = 0
+    wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        return asdict(self)
+
+
+class LockBusy(RuntimeError):
+    """The stripe is held by another thread and the caller must not wait."""
+
+
+class StripedLocks:
+    """``stripes`` re-entrant locks shared by all sessions."""
+
+    def __init__(self, stripes: int = 256) -> None:
+        if stripes < 1:
+            raise ValueError("stripes must be positive")
+        self._locks = [threading.RLock() for _ in range(stripes)]
+        self._acquisitions: List[int] = [0] * stripes
+        self._contended: List[int] = [0] * stripes
+        self._waited: List[float] = [0.0] * stripes
+        self._max_wait: List[float] = [0.0] * stripes
+        self._local = threading.local()
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def stripe(self, key: Hashable) -> int:
+        return hash(key) % len(self._locks)
+
+    @contextmanager
+    def hold(self, key: Hashable) -> Iterator[None]:
+        """Hold the stripe of ``key`` for the duration of the block."""
+
+        index = self.stripe(key)
+        lock = self._locks[index]
+        waited = 0.0
+        if not lock.acquire(blocking=False):
+            if getattr(self._local, "nonblocking", False):
+                raise LockBusy("Session lock is held by another thread")
+            started = time.perf_counter()
+            lock.acquire()
+            waited = time.perf_counter() - started
+            self._contended[index] += 1
+            self._waited[index] += waited
+            if waited > self._max_wait[index]:
+                self._max_wait[index] = waited
+        self._acquisitions[index] += 1
+        try:
+            yield
+        finally:
+            lock.release()
+
+    @contextmanager
+    def nonblocking(self) -> Iterator[None]:
+        """Make :meth:`hold` on this thread raise :class:`LockBusy` instead of waiting."""
+
+        previous = getattr(self._local, "nonblocking", False)
+        self._local.nonblocking = True
+        try:
+            yield
+        finally:
+            self._local.nonblocking = previous
+
+    def busy(self, key: Hashable) -> bool:
+        """Whether another thread holds the stripe of ``key`` right now (advisory)."""
+
+        lock = self._locks[self.stripe(key)]
+        if not lock.acquire(blocking=False):
+            return True
+        lock.release()
+        return False
+
+    def stats(self) -> LockStats:
+        return LockStats(
+            acquisitions=sum(self._acquisitions),
+            contended=sum(self._contended),
+            wait_seconds=sum(self._waited),
+            max_wait_seconds=max(self._max_wait),
+        )
+
+
+__all__ = ["LockBusy", "LockStats", "StripedLocks"]
@@ -0,0 +1,351 @@
+"""Compact per-session state containers.
+
+Sessions reference items by their integer position in an :class:`ItemCatalog`
+rather than holding ``Item`` objects or id strings. Seen items and the item
+history are bitsets over those positions, and answered responses live in
+parallel :mod:`array` columns with the raw payload kept only in a small
+binary encoding. Ids that are not part of the catalog (e.g. items from an
+ad-hoc bank used in tests) are kept in small overflow containers so the
+containers still behave like the ``set``/``dict``/``list`` they replace.
+"""
+from __future__ import annotations
+
+from array import array
+from collections.abc import MutableMapping, MutableSet
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import json
+
+if TYPE_CHECKING:  # pragma: no cover - imported for type hints only
+    from app.cat_engine import Item
+
+
+@dataclass(slots=True)
+class Response:
+    item_id: str
+    score: float
+    theta_before: float
+    theta_after: float
+    se_after: float
+    raw_response: Dict[str, object] | None = None
+
+
+class ItemCatalog:
+    """Immutable mapping between item ids and integer bank positions."""
+
+    __slots__ = ("items", "index")
+
+    def __init__(self, items: Iterable["Item"] = ()) -> None:
+        self.items: Tuple["Item", ...] = tuple(items)
+        self.index: Dict[str, int] = {item.id: position for position, item in enumerate(self.items)}
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def position(self, item_id: str) -> int:
+        """Return the position of ``item_id`` or ``-1`` when it is not catalogued."""
+
+        return self.index.get(item_id, -1)
+
+
+_RAW_NONE = b""
+_RAW_SINGLE = 1
+_RAW_MULTI = 2
+_RAW_JSON = 3
+
+
+def encode_raw_response(raw: Optional[Dict[str, object]]) -> bytes:
+    """Encode a raw answer payload into a compact byte string.
+
+    ``{"answer": n}`` and ``{"answer": [n, ...]}`` with small non-negative
+    integers take one byte per index; anything else falls back to compact JSON.
+    """
+
+    if raw is None:
+        return _RAW_NONE
+    if len(raw) == 1 and "answer" in raw:
+        answer = raw["answer"]
+        if _is_small_index(answer):
+            return bytes((_RAW_SINGLE, answer))
+        if isinstance(answer, list) and all(_is_small_index(value) for value in answer):
+            return bytes((_RAW_MULTI, *answer))
+    return bytes((_RAW_JSON,)) + json.dumps(raw, separators=(",", ":")).encode("utf-8")
+
+
+def decode_raw_response(blob: bytes) -> Optional[Dict[str, object]]:
+    """Inverse of :func:`encode_raw_response`."""
+
+    if not blob:
+        return None
+    tag = blob[0]
+    if tag == _RAW_SINGLE:
+        return {"answer": blob[1]}
+    if tag == _RAW_MULTI:
+        return {"answer": list(blob[1:])}
+    if tag == _RAW_JSON:
+        return json.loads(blob[1:].decode("utf-8"))
+    raise ValueError(f"Unknown raw response encoding: {tag}")
+
+
+def _is_small_index(value: object) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 256
+
+
+class _Bitset:
+    __slots__ = ("bits",)
+
+    def __init__(self, size: int) -> None:
+        self.bits = bytearray((size + 7) // 8)
+
+    def test(self, position: int) -> bool:
+        return bool(self.bits[position >> 3] & (1 << (position & 7)))
+
+    def set(self, position: int) -> bool:
+        """Set ``position`` and return ``True`` when it was previously clear."""
+
+        byte = position >> 3
+        mask = 1 << (position & 7)
+        if self.bits[byte] & mask:
+            return False
+        self.bits[byte] |= mask
+        return True
+
+    def clear(self, position: int) -> bool:
+        byte = position >> 3
+        mask = 1 << (position & 7)
+        if not self.bits[byte] & mask:
+            return False
+        self.bits[byte] &= ~mask & 0xFF
+        return True
+
+    def positions(self) -> Iterator[int]:
+        for byte_index, byte in enumerate(self.bits):
+            while byte:
+                low = byte & -byte
+                yield (byte_index << 3) + low.bit_length() - 1
+                byte ^= low
+
+
+class SeenItems(MutableSet):
+    """Set of item ids stored as a bitset over catalog positions."""
+
+    __slots__ = ("catalog", "_bits", "_count", "_extra")
+
+    def __init__(self, catalog: ItemCatalog, ids: Iterable[str] = ()) -> None:
+        self.catalog = catalog
+        self._bits = _Bitset(len(catalog))
+        self._count = 0
+        self._extra: Optional[set[str]] = None
+        for item_id in ids:
+            self.add(item_id)
+
+    def __contains__(self, item_id: object) -> bool:
+        position = self.catalog.index.get(item_id, -1) if isinstance(item_id, str) else -1
+        if position >= 0:
+            return self._bits.test(position)
+        return self._extra is not None and item_id in self._extra
+
+    def __iter__(self) -> Iterator[str]:
+        items = self.catalog.items
+        for position in self._bits.positions():
+            yield items[position].id
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        return self._count + (len(self._extra) if self._extra else 0)
+
+    def add(self, item_id: str) -> None:
+        position = self.catalog.position(item_id)
+        if position >= 0:
+            self._count += self._bits.set(position)
+            return
+        if self._extra is None:
+            self._extra = set()
+        self._extra.add(item_id)
+
+    def discard(self, item_id: str) -> None:
+        position = self.catalog.position(item_id)
+        if position >= 0:
+            self._count -= self._bits.clear(position)
+        elif self._extra is not None:
+            self._extra.discard(item_id)
+
+    def positions(self) -> Iterator[int]:
+        """Catalog positions of the seen items."""
+
+        return self._bits.positions()
+
+    def to_bitmap(self) -> bytes:
+        """Seen catalog positions as a bitmap, without trailing zero bytes."""
+
+        return bytes(self._bits.bits).rstrip(b"\0")
+
+    def load_bitmap(self, bitmap: bytes) -> None:
+        """Mark every position set in ``bitmap`` (see :meth:`to_bitmap`) as seen."""
+
+        if len(bitmap) > len(self._bits.bits):
+            raise ValueError("Bitmap is larger than the catalog")
+        for byte_index, byte in enumerate(bitmap):
+            if byte:
+                merged = self._bits.bits[byte_index] | byte
+                self._count += bin(merged).count("1") - bin(self._bits.bits[byte_index]).count("1")
+                self._bits.bits[byte_index] = merged
+
+    def __repr__(self) -> str:
+        return f"SeenItems({sorted(self)!r})"
+
+
+class ItemHistory(MutableMapping):
+    """``item_id -> Item`` mapping that stores catalog positions only."""
+
+    __slots__ = ("catalog", "_bits", "_count", "_extra")
+
+    def __init__(self, catalog: ItemCatalog) -> None:
+        self.catalog = catalog
+        self._bits = _Bitset(len(catalog))
+        self._count = 0
+        self._extra: Optional[Dict[str, "Item"]] = None
+
+    def __getitem__(self, item_id: str) -> "Item":
+        position = self.catalog.position(item_id)
+        if position >= 0 and self._bits.test(position):
+            return self.catalog.items[position]
+        if self._extra is not None and item_id in self._extra:
+            return self._extra[item_id]
+        raise KeyError(item_id)
+
+    def __setitem__(self, item_id: str, item: "Item") -> None:
+        position = self.catalog.position(item_id)
+        if position >= 0 and self.catalog.items[position] is item:
+            self._count += self._bits.set(position)
+            if self._extra is not None:
+                self._extra.pop(item_id, None)
+            return
+        if position >= 0:
+            self._count -= self._bits.clear(position)
+        if self._extra is None:
+            self._extra = {}
+        self._extra[item_id] = item
+
+    def __delitem__(self, item_id: str) -> None:
+        position = self.catalog.position(item_id)
+        if position >= 0 and self._bits.clear(position):
+            self._count -= 1
+            return
+        if self._extra is None or item_id not in self._extra:
+            raise KeyError(item_id)
+        del self._extra[item_id]
+
+    def __iter__(self) -> Iterator[str]:
+        items = self.catalog.items
+        for position in self._bits.positions():
+            yield items[position].id
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        return self._count + (len(self._extra) if self._extra else 0)
+
+    def __repr__(self) -> str:
+        return f"ItemHistory({list(self)!r})"
+
+
+class ResponseLog:
+    """Answered responses stored as parallel columns.
+
+    Iteration and indexing materialise :class:`Response` records on demand,
+    so callers written against a ``list`` of responses keep working.
+    """
+
+    __slots__ = (
+        "catalog",
+        "item_positions",
+        "scores",
+        "theta_before",
+        "theta_after",
+        "se_after",
+        "_raw",
+        "_raw_offsets",
+        "_extra_ids",
+    )
+
+    def __init__(self, catalog: ItemCatalog) -> None:
+        self.catalog = catalog
+        self.item_positions = array("i")
+        self.scores = array("d")
+        self.theta_before = array("d")
+        self.theta_after = array("d")
+        self.se_after = array("d")
+        self._raw = bytearray()
+        self._raw_offsets = array("I", [0])
+        self._extra_ids: Optional[Dict[int, str]] = None
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def append(self, record: Response) -> None:
+        position = self.catalog.position(record.item_id)
+        if position < 0:
+            if self._extra_ids is None:
+                self._extra_ids = {}
+            self._extra_ids[len(self.scores)] = record.item_id
+        self.item_positions.append(position)
+        self.scores.append(record.score)
+        self.theta_before.append(record.theta_before)
+        self.theta_after.append(record.theta_after)
+        self.se_after.append(record.se_after)
+        self._raw.extend(encode_raw_response(record.raw_response))
+        self._raw_offsets.append(len(self._raw))
+
+    def item_id(self, index: int) -> str:
+        position = self.item_positions[index]
+        if position >= 0:
+            return self.catalog.items[position].id
+        return self._extra_ids[index]  # type: ignore[index]
+
+    def raw_blob(self, index: int) -> bytes:
+        """Encoded raw payload of response ``index`` (see :func:`encode_raw_response`)."""
+
+        start, end = self._raw_offsets[index], self._raw_offsets[index + 1]
+        return bytes(self._raw[start:end])
+
+    def raw_response(self, index: int) -> Optional[Dict[str, object]]:
+        return decode_raw_response(self.raw_blob(index))
+
+    def _record(self, index: int) -> Response:
+        return Response(
+            item_id=self.item_id(index),
+            score=self.scores[index],
+            theta_before=self.theta_before[index],
+            theta_after=self.theta_after[index],
+            se_after=self.se_after[index],
+            raw_response=self.raw_response(index),
+        )
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Response, List[Response]]:
+        if isinstance(index, slice):
+            return [self._record(position) for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("response index out of range")
+        return self._record(index)
+
+    def __iter__(self) -> Iterator[Response]:
+        for index in range(len(self)):
+            yield self._record(index)
+
+    def __repr__(self) -> str:
+        return f"ResponseLog({len(self)} responses)"
+
+
+__all__ = [
+    "ItemCatalog",
+    "ItemHistory",
+    "Response",
+    "ResponseLog",
+    "SeenItems",
+    "decode_raw_response",
+    "encode_raw_response",
+]
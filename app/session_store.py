@@ -1,10 +1,64 @@
-"""In-memory storage for test sessions."""
+"""Storage backends for test sessions.
+
+:class:`MemorySessionStore` keeps every session in a dict.
+:class:`SqliteSessionStore` keeps a bounded LRU of hot sessions in memory
+and evicts the least recently used ones to the ``session_blobs`` table as
+compact blobs (the record encoding of :mod:`app.session_journal`, behind the
+fingerprint of the session's item bank). Evicted sessions are decoded again
+transparently on the next access, against the bank they were pinned to: the
+store keeps that bank alive while the session is cold, and a blob whose bank
+is no longer loaded (e.g. written by an earlier process before a bank swap)
+is refused with :class:`SessionBankUnavailable` rather than decoded against
+a different bank. Faulting a session in and writing evicted ones back touch
+disk on the calling thread, which :meth:`SessionStore.blocks` reports.
+
+The module-level functions used by the service operate on the store chosen
+with :func:`configure_store`; by default that is the in-memory store, or the
+SQLite store when :data:`SESSION_DB_ENV` names a database file. When a
+:class:`SessionReaper` is configured, those functions also keep its timers
+up to date: it finishes sessions at the server-side time limit and evicts
+idle and finished sessions, driven by a :class:`~app.timer_wheel.TimerWheel`
+rather than by scanning the store.
+
+In a sharded deployment (:mod:`app.shard_server`) each worker process owns
+the sessions whose ids :func:`shard_of` maps to it, and only mints such ids.
+"""
 from __future__ import annotations
 
-from typing import Dict
+import os
+import struct
+import threading
+from abc import ABC, abstractmethod
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Iterable, List, Optional, Tuple
 from uuid import UUID, uuid4
 
-from app.cat_engine import Session
+from app.cat_engine import ItemBank, Session, bank_with_fingerprint
+from app.database import (
+    clear_session_blobs,
+    count_session_blobs,
+    delete_session_blob,
+    init_db,
+    iter_session_blobs,
+    load_session_blob,
+    record_test_finish,
+    save_session_blob,
+)
+from app.session_journal import decode_session, encode_session
+from app.timer_wheel import TimerWheel
+
+SESSION_DB_ENV = "ADAPTIVE_TEST_SESSION_DB"
+# "index/count" when this process owns one shard of a sharded deployment.
+SESSION_SHARD_ENV = "ADAPTIVE_TEST_SHARD"
+
+# TZ §6.5: a test stops after 45 minutes at the latest.
+SESSION_TIME_LIMIT = 45 * 60.0
+# Longer than the time limit, so an unfinished test reaches its deadline first.
+SESSION_IDLE_TTL = 60 * 60.0
+FINISHED_SESSION_TTL = 30 * 60.0
 
 LEVEL_PRIORS = {
     "easy": (-1.5, 1.0),
@@ -12,11 +66,422 @@ LEVEL_PRIORS = {
     "hard": (1.5, 1.0),
 }
 
+# Stored blobs start with the fingerprint of the session's item bank.
+_BLOB_HEADER = struct.Struct("<8s")
+
+
+class SessionBankUnavailable(KeyError):
+    """A stored session's item bank is no longer loaded."""
+
+
+class SessionStore(ABC):
+    """Interface shared by the session backends."""
+
+    @abstractmethod
+    def add(self, session: Session) -> None:
+        ...
+
+    @abstractmethod
+    def get(self, session_id: UUID) -> Session:
+        """Return the session or raise :class:`KeyError`."""
+
+    @abstractmethod
+    def discard(self, session_id: UUID) -> None:
+        ...
+
+    def evict(self, session_id: UUID) -> None:
+        """Release an idle session from memory (dropping it if there is no other tier)."""
+
+        self.discard(session_id)
+
+    @abstractmethod
+    def sessions(self) -> Iterator[Session]:
+        """Every stored session, hot or not."""
+
+    def blocks(self, session_id: Optional[UUID] = None) -> bool:
+        """Whether getting ``session_id`` (or adding a session, for ``None``) may touch disk."""
+
+        return False
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self) -> None:
+        self._sessions: Dict[UUID, Session] = {}
+
+    def add(self, session: Session) -> None:
+        self._sessions[UUID(session.id)] = session
+
+    def get(self, session_id: UUID) -> Session:
+        if session_id not in self._sessions:
+            raise KeyError("Session not found")
+        return self._sessions[session_id]
+
+    def discard(self, session_id: UUID) -> None:
+        self._sessions.pop(session_id, None)
+
+    def sessions(self) -> Iterator[Session]:
+        return iter(list(self._sessions.values()))
+
+    def clear(self) -> None:
+        self._sessions.clear()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SqliteSessionStore(SessionStore):
+    """Hot sessions in an LRU of ``capacity`` entries, the rest in SQLite."""
+
+    def __init__(self, path: Optional[Path] = None, capacity: int = 10_000) -> None:
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.path = path
+        self.capacity = capacity
+        self.evictions = 0
+        self.faults = 0
+        self._hot: "OrderedDict[UUID, Session]" = OrderedDict()
+        # Sessions popped from the LRU whose blob is still being written.
+        self._evicting: Dict[UUID, Session] = {}
+        # Banks of the sessions evicted by this store, kept alive until they
+        # are faulted back in or discarded.
+        self._cold_banks: Dict[UUID, ItemBank] = {}
+        self._lock = threading.Lock()
+        init_db(path)
+
+    def add(self, session: Session) -> None:
+        with self._lock:
+            self._hot[UUID(session.id)] = session
+            self._hot.move_to_end(UUID(session.id))
+        self._evict()
+
+    def get(self, session_id: UUID) -> Session:
+        with self._lock:
+            session = self._hot.get(session_id)
+            if session is not None:
+                self._hot.move_to_end(session_id)
+                return session
+            session = self._evicting.get(session_id)
+            if session is not None:
+                self._hot[session_id] = session
+                return session
+        blob = load_session_blob(str(session_id), self.path)
+        if blob is None:
+            raise KeyError("Session not found")
+        with self._lock:
+            # Another thread may have faulted the same session in meanwhile.
+            session = self._hot.get(session_id)
+            if session is None:
+                session = self._decode(session_id, blob)
+                self._hot[session_id] = session
+                self._cold_banks.pop(session_id, None)
+                self.faults += 1
+        self._evict()
+        return session
+
+    def discard(self, session_id: UUID) -> None:
+        with self._lock:
+            self._hot.pop(session_id, None)
+            self._evicting.pop(session_id, None)
+            self._cold_banks.pop(session_id, None)
+        delete_session_blob(str(session_id), self.path)
+
+    def evict(self, session_id: UUID) -> None:
+        with self._lock:
+            session = self._hot.pop(session_id, None)
+            if session is None:
+                return
+            self._evicting[session_id] = session
+        self._write_back(session_id, session)
+
+    def sessions(self) -> Iterator[Session]:
+        """Every stored session, hot or not, except cold ones whose bank is gone.
+
+        Cold sessions are decoded one at a time as the iterator advances, so
+        walking the store never holds more than the hot tier in memory.
+        """
+
+        with self._lock:
+            hot = list(self._hot.values()) + list(self._evicting.values())
+        hot_ids = {session.id for session in hot}
+        yield from hot
+        for row in iter_session_blobs(self.path):
+            if row["id"] not in hot_ids:
+                try:
+                    yield self._decode(UUID(row["id"]), bytes(row["state"]))
+                except SessionBankUnavailable:
+                    continue
+
+    def clear(self) -> None:
+        with self._lock:
+            self._hot.clear()
+            self._evicting.clear()
+            self._cold_banks.clear()
+        clear_session_blobs(self.path)
+
+    def flush(self) -> None:
+        """Write every hot session to SQLite without evicting it."""
+
+        with self._lock:
+            hot = list(self._hot.values())
+        for session in hot:
+            save_session_blob(session.id, _encode_blob(session), session.finished, self.path)
+
+    def hot_count(self) -> int:
+        return len(self._hot)
+
+    def blocks(self, session_id: Optional[UUID] = None) -> bool:
+        # Faulting a cold session in reads its blob, and going over capacity
+        # writes the least recently used session back, on the calling thread.
+        if session_id is None:
+            return len(self._hot) >= self.capacity
+        return session_id not in self._hot and session_id not in self._evicting
+
+    def __len__(self) -> int:
+        with self._lock:
+            hot_ids = {str(session_id) for session_id in self._hot} | {str(session_id) for session_id in self._evicting}
+        return len(hot_ids) + count_session_blobs(hot_ids, self.path)
+
+    def _evict(self) -> None:
+        while True:
+            with self._lock:
+                if len(self._hot) <= self.capacity:
+                    return
+                session_id, session = self._hot.popitem(last=False)
+                self._evicting[session_id] = session
+            self._write_back(session_id, session)
+
+    def _write_back(self, session_id: UUID, session: Session) -> None:
+        save_session_blob(session.id, _encode_blob(session), session.finished, self.path)
+        with self._lock:
+            if self._evicting.pop(session_id, None) is not None and session_id not in self._hot:
+                self._cold_banks[session_id] = session.bank
+            self.evictions += 1
+
+    def _decode(self, session_id: UUID, blob: bytes) -> Session:
+        (fingerprint,) = _BLOB_HEADER.unpack_from(blob)
+        bank = self._cold_banks.get(session_id)
+        if bank is None or bank.fingerprint != fingerprint:
+            bank = bank_with_fingerprint(fingerprint)
+        if bank is None:
+            raise SessionBankUnavailable("The item bank of this session is no longer loaded")
+        return decode_session(blob[_BLOB_HEADER.size :], bank)
+
+
+def _encode_blob(session: Session) -> bytes:
+    return _BLOB_HEADER.pack(session.bank.fingerprint) + encode_session(session)
+
+
+_DEADLINE = "deadline"
+_IDLE = "idle"
+
+
+class SessionReaper:
+    """Finishes sessions at their time limit and evicts idle or finished ones.
+
+    Each tracked session has at most two timers: its deadline
+    (``started_at + time_limit``) and an idle timer that every access pushes
+    back by ``idle_ttl`` (``finished_ttl`` once the test is finished). When a
+    deadline passes, ``on_timeout`` finishes the session; by default it marks
+    the session finished and calls :func:`app.database.record_test_finish`.
+    Expired idle timers evict the session from the current store.
+    """
+
+    def __init__(
+        self,
+        time_limit: float = SESSION_TIME_LIMIT,
+        idle_ttl: float = SESSION_IDLE_TTL,
+        finished_ttl: float = FINISHED_SESSION_TTL,
+        on_timeout: Optional[Callable[[Session], None]] = None,
+        tick: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.time_limit = time_limit
+        self.idle_ttl = idle_ttl
+        self.finished_ttl = finished_ttl
+        self.on_timeout = on_timeout or _record_timeout
+        self.clock = clock
+        self.timed_out = 0
+        self.evicted = 0
+        self._wheel = TimerWheel(tick=tick, clock=clock)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._wheel)
+
+    def track(self, session: Session) -> None:
+        """Start the deadline and idle timers of ``session``."""
+
+        key = UUID(session.id)
+        now = self.clock()
+        with self._lock:
+            if session.finished:
+                self._wheel.cancel(key, _DEADLINE)
+                self._wheel.schedule(key, _IDLE, now + self.finished_ttl)
+                return
+            elapsed = (datetime.utcnow() - session.started_at).total_seconds()
+            self._wheel.schedule(key, _DEADLINE, now + self.time_limit - elapsed)
+            self._wheel.schedule(key, _IDLE, now + self.idle_ttl)
+
+    def touch(self, session: Session) -> None:
+        ttl = self.finished_ttl if session.finished else self.idle_ttl
+        with self._lock:
+            self._wheel.schedule(UUID(session.id), _IDLE, self.clock() + ttl)
+
+    def finished(self, session: Session) -> None:
+        key = UUID(session.id)
+        with self._lock:
+            self._wheel.cancel(key, _DEADLINE)
+            self._wheel.schedule(key, _IDLE, self.clock() + self.finished_ttl)
+
+    def forget(self, session_id: UUID) -> None:
+        with self._lock:
+            self._wheel.cancel(session_id, _DEADLINE)
+            self._wheel.cancel(session_id, _IDLE)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._wheel = TimerWheel(tick=self._wheel.tick, clock=self.clock)
+
+    def run_pending(self, now: Optional[float] = None) -> Tuple[List[UUID], List[UUID]]:
+        """Fire due timers; return the ids that timed out and that were evicted."""
+
+        with self._lock:
+            expired = self._wheel.advance(now)
+        timed_out: List[UUID] = []
+        evicted: List[UUID] = []
+        for session_id, kind in expired:
+            store = current_store()
+            if kind == _DEADLINE:
+                try:
+                    session = store.get(session_id)
+                except KeyError:
+                    continue
+                if not session.finished:
+                    self.on_timeout(session)
+                    timed_out.append(session_id)
+                self.finished(session)
+            else:
+                store.evict(session_id)
+                evicted.append(session_id)
+        self.timed_out += len(timed_out)
+        self.evicted += len(evicted)
+        return timed_out, evicted
+
+    def start(self) -> None:
+        """Run :meth:`run_pending` once per tick on a daemon thread."""
+
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="session-reaper", daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._wheel.tick):
+            self.run_pending()
+
+
+def _record_timeout(session: Session) -> None:
+    session.finished = True
+    session.pending_item_id = None
+    session.paused = False
+    session.upcoming_domain = None
+    record_test_finish(session.id, datetime.utcnow())
+
+
+def store_from_env(environ: Dict[str, str] = os.environ) -> SessionStore:  # type: ignore[assignment]
+    path = environ.get(SESSION_DB_ENV)
+    if path:
+        return SqliteSessionStore(Path(path))
+    return MemorySessionStore()
+
+
+def shard_of(session_id: UUID | str, shards: int) -> int:
+    """Index of the shard that owns ``session_id`` out of ``shards``."""
+
+    key = session_id if isinstance(session_id, UUID) else UUID(session_id)
+    return key.int % shards
+
+
+def shard_from_env(environ: Dict[str, str] = os.environ) -> Tuple[int, int]:  # type: ignore[assignment]
+    value = environ.get(SESSION_SHARD_ENV)
+    if not value:
+        return 0, 1
+    index, count = (int(part) for part in value.split("/", 1))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid {SESSION_SHARD_ENV}: {value}")
+    return index, count
+
+
+_STORE: SessionStore = store_from_env()
+_REAPER: Optional[SessionReaper] = None
+_SHARD: Tuple[int, int] = shard_from_env()
+
+
+def configure_store(store: SessionStore) -> SessionStore:
+    """Route the module-level functions to ``store`` and return the previous one."""
+
+    global _STORE
+    previous, _STORE = _STORE, store
+    return previous
+
+
+def current_store() -> SessionStore:
+    return _STORE
+
+
+def configure_reaper(reaper: Optional[SessionReaper]) -> Optional[SessionReaper]:
+    """Use ``reaper`` for session timers and return the previous one."""
+
+    global _REAPER
+    previous, _REAPER = _REAPER, reaper
+    return previous
+
+
+def configure_shard(index: int, count: int) -> Tuple[int, int]:
+    """Only mint session ids that :func:`shard_of` maps to ``index``; returns the previous shard."""
+
+    global _SHARD
+    if not 0 <= index < count:
+        raise ValueError("Shard index out of range")
+    previous, _SHARD = _SHARD, (index, count)
+    return previous
+
+
+def _new_session_id() -> str:
+    index, count = _SHARD
+    while True:
+        key = uuid4()
+        if key.int % count == index:
+            return str(key)
+
+
+def build_session(start_level: str, first_name: str, last_name: str, estimation: str = "map") -> Session:
+    """A new session with the prior for ``start_level``, not added to any store."""
 
-def create_session(start_level: str, first_name: str, last_name: str) -> Session:
     mu, sigma2 = LEVEL_PRIORS[start_level]
-    session = Session(
-        id=str(uuid4()),
+    return Session(
+        id=_new_session_id(),
         start_level=start_level,
         theta=mu,
         prior_mu=mu,
@@ -24,24 +489,80 @@ def create_session(start_level: str, first_name: str, last_name: str) -> Session
         se=float("inf"),
         first_name=first_name,
         last_name=last_name,
+        estimation=estimation,
     )
-    _SESSIONS[UUID(session.id)] = session
+
+
+def create_session(start_level: str, first_name: str, last_name: str, estimation: str = "map") -> Session:
+    session = build_session(start_level, first_name, last_name, estimation)
+    _STORE.add(session)
+    if _REAPER is not None:
+        _REAPER.track(session)
     return session
 
 
 def get_session(session_id: UUID) -> Session:
-    if session_id not in _SESSIONS:
-        raise KeyError("Session not found")
-    return _SESSIONS[session_id]
+    session = _STORE.get(session_id)
+    if _REAPER is not None:
+        _REAPER.touch(session)
+    return session
 
 
 def finish_session(session_id: UUID) -> None:
     session = get_session(session_id)
     session.finished = True
+    if _REAPER is not None:
+        _REAPER.finished(session)
+
+
+def all_sessions() -> Iterator[Session]:
+    """Iterate over every session of the current store, loading cold ones lazily."""
+
+    return _STORE.sessions()
+
+
+def restore_sessions(sessions: Iterable[Session]) -> int:
+    """Put sessions rebuilt elsewhere (e.g. from the journal) back into the store."""
+
+    restored = 0
+    for session in sessions:
+        _STORE.add(session)
+        if _REAPER is not None:
+            _REAPER.track(session)
+        restored += 1
+    return restored
 
 
 def reset_store() -> None:
-    _SESSIONS.clear()
+    _STORE.clear()
+    if _REAPER is not None:
+        _REAPER.clear()
 
 
-_SESSIONS: Dict[UUID, Session] = {}
+__all__ = [
+    "FINISHED_SESSION_TTL",
+    "LEVEL_PRIORS",
+    "SESSION_DB_ENV",
+    "SESSION_IDLE_TTL",
+    "SESSION_SHARD_ENV",
+    "SESSION_TIME_LIMIT",
+    "MemorySessionStore",
+    "SessionBankUnavailable",
+    "SessionReaper",
+    "SessionStore",
+    "SqliteSessionStore",
+    "all_sessions",
+    "build_session",
+    "configure_reaper",
+    "configure_shard",
+    "configure_store",
+    "create_session",
+    "current_store",
+    "finish_session",
+    "get_session",
+    "reset_store",
+    "restore_sessions",
+    "shard_from_env",
+    "shard_of",
+    "store_from_env",
+]
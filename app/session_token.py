@@ -0,0 +1,374 @@
+"""Signed, compressed session tokens for the stateless service mode.
+
+In stateless mode the whole CAT state travels with the client. A token is
+the session packed into a compact binary layout, compressed with
+:mod:`zlib`, authenticated with a truncated HMAC-SHA256 and base64url
+encoded::
+
+    header     format, bank fingerprint, session UUID, start time, theta, SE,
+               prior, part index, flags, estimation method
+    text       start level, first and last name
+    state      pending item, part counts, seen-item bitmap, plays
+    responses  item positions, scores and theta/SE history as array columns
+
+Items are referenced by their position in the bank, so a token can only be
+decoded against the bank with the same :attr:`~app.cat_engine.ItemBank.fingerprint`
+(the current one, or an older one still in memory). Any process that loaded
+the same bank and shares the secret can serve any request. The theta/SE
+history kept per response is stored as 32-bit floats; the current theta and
+SE, and everything that drives selection and estimation, are exact.
+
+Tokens are not single-use by themselves, so a client could replay an older
+token to answer an item again once it has seen whether its answer was
+correct. Two checks stop that:
+
+* the service records each answer and audio play at its position in
+  SQLite (:func:`app.database.record_response_at`,
+  :func:`app.database.record_play_at`), and refuses it when that position
+  is already taken; this holds across every process that writes the same
+  database file;
+* :class:`TokenLedger` keeps the progress (answers, finish, audio plays) of
+  the newest token this process issued per test and refuses tokens behind
+  it. It lives in process memory, so on its own it only protects a test
+  whose requests all reach one process, as the shard front end
+  (:mod:`app.shard_server`) arranges.
+
+A replayed finish is only caught by the ledger: a process that did not
+issue the newer token accepts it.
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from app.cat_engine import (
+    CAT_PARTS,
+    ESTIMATION_METHODS,
+    Item,
+    ItemBank,
+    Response,
+    Session,
+    bank_with_fingerprint,
+)
+from app.session_state import decode_raw_response
+
+TOKEN_SECRET_ENV = "ADAPTIVE_TEST_TOKEN_SECRET"
+TOKEN_HEADER = "X-Session-Token"
+
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<B8s16sqddddBBB")
+_TEXT = struct.Struct("<H")
+_POSITION = struct.Struct("<i")
+_COUNT = struct.Struct("<H")
+_PLAY = struct.Struct("<iB")
+_MAC_SIZE = 16
+
+_PAUSED = 1
+_FINISHED = 2
+_UPCOMING = 4
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class InvalidToken(ValueError):
+    """Raised for tokens that are malformed, forged or bound to an unknown bank."""
+
+
+class SessionTokenCodec:
+    """Turns sessions into signed tokens and back."""
+
+    def __init__(self, secret: bytes) -> None:
+        if len(secret) < 16:
+            raise ValueError("Token secret must be at least 16 bytes")
+        self._secret = secret
+
+    def encode(self, session: Session) -> str:
+        payload = zlib.compress(_pack_session(session), 9)
+        return base64.urlsafe_b64encode(payload + self._sign(payload)).rstrip(b"=").decode("ascii")
+
+    def decode(self, token: str) -> Session:
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except (ValueError, TypeError) as exc:
+            raise InvalidToken("Malformed session token") from exc
+        payload, mac = raw[:-_MAC_SIZE], raw[-_MAC_SIZE:]
+        if len(raw) <= _MAC_SIZE or not hmac.compare_digest(mac, self._sign(payload)):
+            raise InvalidToken("Session token signature mismatch")
+        try:
+            data = zlib.decompress(payload)
+        except zlib.error as exc:  # pragma: no cover - only reachable with a leaked secret
+            raise InvalidToken("Malformed session token") from exc
+        return _unpack_session(data)
+
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(self._secret, payload, hashlib.sha256).digest()[:_MAC_SIZE]
+
+
+class TokenLedger:
+    """Progress of the newest token issued per test, to refuse replayed older ones.
+
+    The ledger is per process: another process behind the same load
+    balancer has no entry for the test and accepts an older token. Answers
+    and plays are also checked against SQLite; finishes are not.
+    Entries not updated for ``ttl`` seconds are dropped; by then the token's
+    own time limit refuses the session anyway.
+    """
+
+    def __init__(self, ttl: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.ttl = ttl
+        self.clock = clock
+        self._issued: "OrderedDict[str, Tuple[Tuple[int, bool, int], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._issued)
+
+    def check(self, session: Session) -> None:
+        """Raise :class:`InvalidToken` if a newer token was issued for ``session``."""
+
+        with self._lock:
+            entry = self._issued.get(session.id)
+        if entry is not None and _progress(session) < entry[0]:
+            raise InvalidToken("Session token has been superseded by a newer one")
+
+    def issued(self, session: Session) -> None:
+        """Record that a token for ``session`` in its current state was handed out."""
+
+        now = self.clock()
+        progress = _progress(session)
+        with self._lock:
+            entry = self._issued.get(session.id)
+            if entry is None or entry[0] <= progress:
+                self._issued[session.id] = (progress, now)
+                self._issued.move_to_end(session.id)
+            while self._issued:
+                oldest = next(iter(self._issued.values()))
+                if now - oldest[1] <= self.ttl:
+                    break
+                self._issued.popitem(last=False)
+
+
+def _progress(session: Session) -> Tuple[int, bool, int]:
+    return len(session.responses), session.finished, sum(session.plays.values())
+
+
+def _pack_text(buffer: bytearray, value: str) -> None:
+    encoded = value.encode("utf-8")
+    buffer += _TEXT.pack(len(encoded))
+    buffer += encoded
+
+
+def _unpack_text(data: bytes, offset: int) -> Tuple[str, int]:
+    (length,) = _TEXT.unpack_from(data, offset)
+    offset += _TEXT.size
+    return data[offset : offset + length].decode("utf-8"), offset + length
+
+
+def _pack_session(session: Session) -> bytes:
+    bank = session.bank
+    catalog = bank.catalog
+    log = session.responses
+    if any(position < 0 for position in log.item_positions):
+        raise ValueError("Only sessions over bank items can be turned into tokens")
+    flags = (
+        (_PAUSED if session.paused else 0)
+        | (_FINISHED if session.finished else 0)
+        | (_UPCOMING if session.upcoming_domain is not None else 0)
+    )
+    started = session.started_at - _EPOCH
+    buffer = bytearray(
+        _HEADER.pack(
+            FORMAT_VERSION,
+            bank.fingerprint,
+            UUID(session.id).bytes,
+            (started.days * 86_400 + started.seconds) * 1_000_000 + started.microseconds,
+            session.theta,
+            session.se,
+            session.prior_mu,
+            session.prior_sigma,
+            session.part_index,
+            flags,
+            ESTIMATION_METHODS.index(session.estimation),
+        )
+    )
+    for value in (session.start_level, session.first_name, session.last_name):
+        _pack_text(buffer, value)
+
+    pending = -1 if session.pending_item_id is None else catalog.position(session.pending_item_id)
+    buffer += _POSITION.pack(pending)
+    buffer += _COUNT.pack(len(session.part_counts))
+    for domain, value in session.part_counts.items():
+        _pack_text(buffer, domain)
+        buffer += _COUNT.pack(value)
+    bitmap = session.seen_items.to_bitmap()
+    buffer += _COUNT.pack(len(bitmap))
+    buffer += bitmap
+    plays = [(catalog.position(item_id), count) for item_id, count in session.plays.items()]
+    buffer += _COUNT.pack(len(plays))
+    for position, count in plays:
+        buffer += _PLAY.pack(position, count)
+
+    buffer += _COUNT.pack(len(log))
+    buffer += array("i", log.item_positions).tobytes()
+    for column in (log.scores, log.theta_before, log.theta_after, log.se_after):
+        buffer += array("f", column).tobytes()
+    for index in range(len(log)):
+        blob = log.raw_blob(index)
+        buffer += _TEXT.pack(len(blob))
+        buffer += blob
+    return bytes(buffer)
+
+
+def _unpack_session(data: bytes) -> Session:
+    try:
+        return _read_session(data)
+    except InvalidToken:
+        raise
+    except (struct.error, IndexError, UnicodeDecodeError, ValueError) as exc:
+        raise InvalidToken("Malformed session token") from exc
+
+
+def _read_session(data: bytes) -> Session:
+    (
+        version,
+        fingerprint,
+        key,
+        started,
+        theta,
+        se,
+        prior_mu,
+        prior_sigma,
+        part_index,
+        flags,
+        estimation,
+    ) = _HEADER.unpack_from(data, 0)
+    if version != FORMAT_VERSION:
+        raise InvalidToken(f"Unsupported session token format: {version}")
+    bank: Optional[ItemBank] = bank_with_fingerprint(fingerprint)
+    if bank is None:
+        raise InvalidToken("Session token refers to an item bank that is no longer loaded")
+    items = bank.catalog.items
+    offset = _HEADER.size
+    start_level, offset = _unpack_text(data, offset)
+    first_name, offset = _unpack_text(data, offset)
+    last_name, offset = _unpack_text(data, offset)
+    session = Session(
+        id=str(UUID(bytes=key)),
+        start_level=start_level,
+        theta=theta,
+        prior_mu=prior_mu,
+        prior_sigma=prior_sigma,
+        se=se,
+        first_name=first_name,
+        last_name=last_name,
+        started_at=_EPOCH + timedelta(microseconds=started),
+        estimation=ESTIMATION_METHODS[estimation],
+        bank=bank,
+    )
+
+    (pending,) = _POSITION.unpack_from(data, offset)
+    offset += _POSITION.size
+    (domains,) = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    part_counts: Dict[str, int] = {}
+    for _ in range(domains):
+        domain, offset = _unpack_text(data, offset)
+        (part_counts[domain],) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+    (bitmap_size,) = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    session.seen_items.load_bitmap(data[offset : offset + bitmap_size])
+    offset += bitmap_size
+    (play_count,) = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    for _ in range(play_count):
+        position, count = _PLAY.unpack_from(data, offset)
+        offset += _PLAY.size
+        session.plays[_item_at(items, position).id] = count
+
+    (answered,) = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    positions = array("i")
+    positions.frombytes(data[offset : offset + 4 * answered])
+    offset += 4 * answered
+    columns: List[array] = []
+    for _ in range(4):
+        column = array("f")
+        column.frombytes(data[offset : offset + 4 * answered])
+        offset += 4 * answered
+        columns.append(column)
+    scores, theta_before, theta_after, se_after = columns
+    for index, position in enumerate(positions):
+        (length,) = _TEXT.unpack_from(data, offset)
+        offset += _TEXT.size
+        raw = data[offset : offset + length]
+        offset += length
+        item = _item_at(items, position)
+        session.responses.append(
+            Response(
+                item_id=item.id,
+                score=scores[index],
+                theta_before=theta_before[index],
+                theta_after=theta_after[index],
+                se_after=se_after[index],
+                raw_response=decode_raw_response(raw),
+            )
+        )
+        session.item_history[item.id] = item
+    for position in session.seen_items.positions():
+        item = _item_at(items, position)
+        session.item_history[item.id] = item
+
+    session.part_counts = part_counts
+    session.part_index = part_index
+    session.paused = bool(flags & _PAUSED)
+    session.finished = bool(flags & _FINISHED)
+    session.upcoming_domain = CAT_PARTS[part_index] if flags & _UPCOMING else None
+    session.pending_item_id = None if pending == -1 else _item_at(items, pending).id
+    return session
+
+
+def _item_at(items: Sequence[Item], position: int) -> Item:
+    # Negative positions would silently index from the end of the bank.
+    if not 0 <= position < len(items):
+        raise InvalidToken("Session token refers to an item outside its bank")
+    return items[position]
+
+
+def token_codec_from_env(environ: Dict[str, str] = os.environ) -> Optional[SessionTokenCodec]:  # type: ignore[assignment]
+    """Codec keyed by :data:`TOKEN_SECRET_ENV`; ``None`` keeps the stateful mode."""
+
+    secret = environ.get(TOKEN_SECRET_ENV)
+    if not secret:
+        return None
+    return SessionTokenCodec(secret.encode("utf-8"))
+
+
+def generate_secret() -> str:
+    """A random secret suitable for :data:`TOKEN_SECRET_ENV`."""
+
+    return secrets.token_urlsafe(32)
+
+
+__all__ = [
+    "InvalidToken",
+    "SessionTokenCodec",
+    "TOKEN_HEADER",
+    "TOKEN_SECRET_ENV",
+    "TokenLedger",
+    "generate_secret",
+    "token_codec_from_env",
+]
@@ -0,0 +1,492 @@
+"""Sharded multi-process server with test-id affinity routing.
+
+``python -m app.shard_server --workers N`` starts N worker processes and a
+front process that accepts client connections. Every worker runs the regular
+:class:`~app.server.AdaptiveHTTPRequestHandler` on a loopback port and owns
+one shard of the sessions: those whose ids :func:`~app.session_store.shard_of`
+maps to it. The front proxies each request to one worker:
+
+* ``/api/test/{id}/...`` and ``/api/report/{id}`` go to the shard owning the
+  test id, so a session is only ever touched by one process;
+* ``/api/test/start`` goes to the next live worker in turn, which mints an id
+  belonging to its own shard;
+* everything else (UI, static files, health) goes to any live worker.
+
+A supervisor thread restarts workers that exit and kills and restarts
+workers that fail :data:`HEALTH_PATH` probes repeatedly. While a worker is
+down its shard answers ``503`` with ``Retry-After``. The sessions of a
+crashed worker are lost unless :data:`~app.session_journal.JOURNAL_ENV` is
+set: each worker then journals to ``<path>.shard<index>`` and replays that
+file when it is restarted. :data:`~app.session_store.SESSION_DB_ENV` is split
+per shard the same way.
+
+The supervisor loads the item bank once and publishes it as a
+:class:`~app.shared_bank.SharedBank`; workers attach to that segment through
+:data:`~app.shared_bank.SHARED_BANK_ENV` instead of each building its own
+copy, and the segment is unlinked when the supervisor stops.
+
+Workers are separate interpreters started with :mod:`subprocess`, so the
+front never imports :mod:`app.service` and the workers do not inherit its
+threads.
+"""
+from __future__ import annotations
+
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import secrets
+import select
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Tuple
+from urllib.parse import urlsplit
+
+from .bank_snapshot import load_item_bank
+from .media import MEDIA_SECRET_ENV
+from .session_journal import JOURNAL_ENV
+from .session_store import SESSION_DB_ENV, SESSION_SHARD_ENV, shard_of
+from .shared_bank import SHARED_BANK_ENV, SharedBank
+
+logger = logging.getLogger(__name__)
+
+HEALTH_PATH = "/api/health"
+
+# RFC 9110 §7.6.1: connection-specific headers are not forwarded.
+_HOP_BY_HOP = frozenset(
+    {
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "proxy-connection",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    }
+)
+
+_ROOT = Path(__file__).resolve().parent.parent
+
+
+class ShardUnavailable(RuntimeError):
+    """Raised when the worker owning a shard is down or not answering."""
+
+
+@dataclass
+class _Worker:
+    index: int
+    process: Optional[subprocess.Popen] = None
+    port: Optional[int] = None
+    started_at: float = 0.0
+    failures: int = 0
+    restarts: int = 0
+    quick_exits: int = 0
+    # Read end of the pipe a starting worker writes its port to.
+    ready_fd: Optional[int] = None
+    # When a worker waiting out its restart back-off is spawned again.
+    respawn_at: Optional[float] = None
+
+
+def _shard_environ(environ: Mapping[str, str], index: int, count: int) -> Dict[str, str]:
+    env = dict(environ)
+    env[SESSION_SHARD_ENV] = f"{index}/{count}"
+    for name in (JOURNAL_ENV, SESSION_DB_ENV):
+        if env.get(name):
+            env[name] = f"{env[name]}.shard{index}"
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (str(_ROOT), env.get("PYTHONPATH"))))
+    return env
+
+
+class ShardSupervisor:
+    """Starts, health-checks and restarts the shard workers and forwards requests to them."""
+
+    def __init__(
+        self,
+        workers: int,
+        host: str = "127.0.0.1",
+        probe_interval: float = 1.0,
+        probe_timeout: float = 2.0,
+        max_failures: int = 3,
+        start_timeout: float = 60.0,
+        environ: Mapping[str, str] = os.environ,
+    ) -> None:
+        if workers < 1:
+            raise ValueError("At least one worker is required")
+        self.host = host
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.max_failures = max_failures
+        self.start_timeout = start_timeout
+        self._environ = dict(environ)
+        # Audio links must stay valid across worker restarts.
+        self._environ.setdefault(MEDIA_SECRET_ENV, secrets.token_urlsafe(32))
+        self._workers = [_Worker(index) for index in range(workers)]
+        self._turn = itertools.count()
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._bank: Optional[SharedBank] = None
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    def start(self) -> None:
+        """Spawn the workers, wait up to ``start_timeout`` for them and start supervising."""
+
+        if not self._environ.get(SHARED_BANK_ENV):
+            self._bank = SharedBank(load_item_bank())
+            self._bank.export(self._environ)
+        for worker in self._workers:
+            self._spawn(worker)
+        deadline = time.monotonic() + self.start_timeout
+        while any(worker.ready_fd is not None for worker in self._workers) and time.monotonic() < deadline:
+            self._collect_ready(deadline - time.monotonic())
+        self._expire_starts()
+        self._thread = threading.Thread(target=self._run, name="shard-supervisor", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        for worker in self._workers:
+            self._terminate(worker, timeout)
+        if self._bank is not None:
+            self._bank.close()
+            self._bank = None
+            del self._environ[SHARED_BANK_ENV]
+
+    def address(self, index: int) -> Optional[Tuple[str, int]]:
+        port = self._workers[index].port
+        return None if port is None else (self.host, port)
+
+    def restarts(self) -> List[int]:
+        return [worker.restarts for worker in self._workers]
+
+    def pid(self, index: int) -> Optional[int]:
+        process = self._workers[index].process
+        return None if process is None else process.pid
+
+    def shard_for(self, path: str) -> int:
+        """Worker index for a request path (test-id affinity, otherwise round robin)."""
+
+        parts = [part for part in path.split("/") if part]
+        if len(parts) >= 3 and parts[0] == "api" and parts[1] in ("test", "report") and parts[2] != "start":
+            try:
+                return shard_of(parts[2], len(self._workers))
+            except ValueError:
+                pass  # let a worker reject the malformed id
+        for _ in range(len(self._workers)):
+            index = next(self._turn) % len(self._workers)
+            if self._workers[index].port is not None:
+                return index
+        return 0
+
+    def forward(
+        self, index: int, method: str, target: str, body: bytes, headers: Mapping[str, str]
+    ) -> Tuple[int, List[Tuple[str, str]], bytes]:
+        """Send one request to worker ``index`` over this thread's keep-alive connection."""
+
+        address = self.address(index)
+        if address is None:
+            raise ShardUnavailable(f"Shard {index} is restarting")
+        forwarded = {key: value for key, value in headers.items() if key.lower() not in _HOP_BY_HOP}
+        forwarded["Content-Length"] = str(len(body))
+        for attempt in range(2):
+            connection, reused = self._connection(index, address)
+            try:
+                connection.request(method, target, body=body, headers=forwarded)
+                response = connection.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, OSError) as exc:
+                self._drop_connection(index)
+                # A kept-alive connection the worker already closed fails before
+                # the request is processed; retry those once on a fresh one.
+                if reused and attempt == 0 and isinstance(
+                    exc, (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+                ):
+                    continue
+                raise ShardUnavailable(f"Shard {index} did not answer: {exc}") from exc
+            if response.will_close:
+                self._drop_connection(index)
+            reply_headers = [
+                (key, value) for key, value in response.getheaders() if key.lower() not in _HOP_BY_HOP
+            ]
+            return response.status, reply_headers, content
+        raise ShardUnavailable(f"Shard {index} did not answer")  # pragma: no cover - loop always returns
+
+    def _connection(self, index: int, address: Tuple[str, int]) -> Tuple[http.client.HTTPConnection, bool]:
+        connections: Dict[int, http.client.HTTPConnection] = self._local.__dict__.setdefault("connections", {})
+        connection = connections.get(index)
+        if connection is not None and (connection.host, connection.port) == address:
+            return connection, True
+        if connection is not None:
+            connection.close()
+        connection = http.client.HTTPConnection(*address, timeout=30)
+        connections[index] = connection
+        return connection, False
+
+    def _drop_connection(self, index: int) -> None:
+        connection = self._local.__dict__.get("connections", {}).pop(index, None)
+        if connection is not None:
+            connection.close()
+
+    def _command(self, worker: _Worker) -> List[str]:
+        return [sys.executable, "-m", "app.shard_server", "--worker", "--host", self.host]
+
+    def _spawn(self, worker: _Worker) -> None:
+        """Start ``worker`` without waiting; :meth:`_collect_ready` picks up its port."""
+
+        read_fd, write_fd = os.pipe()
+        try:
+            worker.process = subprocess.Popen(
+                [*self._command(worker), "--ready-fd", str(write_fd)],
+                stdin=subprocess.PIPE,
+                pass_fds=(write_fd,),
+                env=_shard_environ(self._environ, worker.index, len(self._workers)),
+                cwd=str(_ROOT),
+            )
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        worker.port = None
+        worker.ready_fd = read_fd
+        worker.started_at = time.monotonic()
+        worker.failures = 0
+
+    def _collect_ready(self, timeout: float) -> None:
+        """Wait up to ``timeout`` for starting workers to report their port."""
+
+        starting = {worker.ready_fd: worker for worker in self._workers if worker.ready_fd is not None}
+        if not starting:
+            self._stop.wait(max(timeout, 0.0))
+            return
+        ready, _, _ = select.select(list(starting), [], [], max(timeout, 0.0))
+        for fd in ready:
+            worker = starting[fd]
+            line = os.read(fd, 64).decode("ascii").strip()
+            self._close_ready(worker)
+            if line:
+                worker.port = int(line)
+            else:
+                logger.error("Shard %d exited during startup", worker.index)
+                self._terminate(worker, 1.0)
+
+    def _expire_starts(self) -> None:
+        now = time.monotonic()
+        for worker in self._workers:
+            if worker.ready_fd is not None and now - worker.started_at > self.start_timeout:
+                logger.error("Shard %d did not start within %.0fs", worker.index, self.start_timeout)
+                self._terminate(worker, 1.0)
+
+    @staticmethod
+    def _close_ready(worker: _Worker) -> None:
+        fd, worker.ready_fd = worker.ready_fd, None
+        if fd is not None:
+            os.close(fd)
+
+    def _terminate(self, worker: _Worker, timeout: float) -> None:
+        worker.port = None
+        self._close_ready(worker)
+        process, worker.process = worker.process, None
+        if process is None:
+            return
+        if process.poll() is None:
+            # Closing stdin asks the worker to shut down and flush its writes.
+            try:
+                process.stdin.close()  # type: ignore[union-attr]
+            except OSError:
+                pass
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        elif process.stdin is not None:
+            process.stdin.close()
+
+    def _restart(self, worker: _Worker) -> None:
+        uptime = time.monotonic() - worker.started_at
+        worker.quick_exits = worker.quick_exits + 1 if uptime < 10 * self.probe_interval else 0
+        self._terminate(worker, self.probe_timeout)
+        # Back off from a worker that keeps dying during startup.
+        delay = min(30.0, 0.1 * 2 ** worker.quick_exits) if worker.quick_exits else 0.0
+        worker.respawn_at = time.monotonic() + delay
+        if not delay:
+            self._respawn(worker)
+
+    def _respawn(self, worker: _Worker) -> None:
+        worker.respawn_at = None
+        worker.restarts += 1
+        self._spawn(worker)
+
+    def _probe(self, worker: _Worker) -> bool:
+        if worker.port is None:
+            return False
+        connection = http.client.HTTPConnection(self.host, worker.port, timeout=self.probe_timeout)
+        try:
+            connection.request("GET", HEALTH_PATH)
+            return connection.getresponse().status == 200
+        except (http.client.HTTPException, OSError):
+            return False
+        finally:
+            connection.close()
+
+    def _run(self) -> None:
+        # Starting workers are collected between probes, so one slow start
+        # never holds up the supervision of the others.
+        next_probe = time.monotonic() + self.probe_interval
+        while not self._stop.is_set():
+            self._collect_ready(next_probe - time.monotonic())
+            if time.monotonic() < next_probe:
+                continue
+            next_probe = time.monotonic() + self.probe_interval
+            self._expire_starts()
+            for worker in self._workers:
+                if self._stop.is_set():
+                    return
+                self._check(worker)
+
+    def _check(self, worker: _Worker) -> None:
+        if worker.respawn_at is not None:
+            if time.monotonic() >= worker.respawn_at:
+                self._respawn(worker)
+            return
+        if worker.ready_fd is not None:
+            return  # still starting
+        code = None if worker.process is None else worker.process.poll()
+        if worker.process is None or code is not None:
+            logger.warning("Shard %d exited with %s; restarting", worker.index, code)
+            self._restart(worker)
+        elif self._probe(worker):
+            worker.failures = 0
+        else:
+            worker.failures += 1
+            if worker.failures >= self.max_failures:
+                logger.warning("Shard %d failed %d health probes; restarting", worker.index, worker.failures)
+                self._restart(worker)
+
+
+class ShardProxyHandler(BaseHTTPRequestHandler):
+    """Front handler forwarding each request to the worker chosen by the supervisor."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:  # noqa: N802 - HTTP verb method name
+        self._proxy()
+
+    def do_POST(self) -> None:  # noqa: N802 - HTTP verb method name
+        self._proxy()
+
+    def do_HEAD(self) -> None:  # noqa: N802 - HTTP verb method name
+        self._proxy(send_body=False)
+
+    def _proxy(self, send_body: bool = True) -> None:
+        supervisor: ShardSupervisor = self.server.supervisor  # type: ignore[attr-defined]
+        length = int(self.headers.get("Content-Length", "0"))
+        body = self.rfile.read(length) if length > 0 else b""
+        index = supervisor.shard_for(urlsplit(self.path).path)
+        try:
+            status, headers, content = supervisor.forward(index, self.command, self.path, body, self.headers)
+        except ShardUnavailable as exc:
+            logger.warning("%s", exc)
+            content = json.dumps({"detail": "Service temporarily unavailable"}).encode("utf-8")
+            status = 503
+            headers = [("Content-Type", "application/json; charset=utf-8"), ("Retry-After", "1")]
+        self.send_response(status)
+        for key, value in headers:
+            if key.lower() != "content-length":
+                self.send_header(key, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if send_body and content:
+            self.wfile.write(content)
+
+    def log_message(self, format: str, *args) -> None:  # pragma: no cover - diagnostic output
+        print(f"[HTTP] {self.log_date_time_string()} - {format % args}")
+
+
+def create_front(host: str, port: int, supervisor: ShardSupervisor) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), ShardProxyHandler)
+    server.supervisor = supervisor  # type: ignore[attr-defined]
+    return server
+
+
+def run_sharded(host: str = "127.0.0.1", port: int = 8000, workers: int = 0) -> Tuple[str, int]:
+    """Serve on ``host:port`` with ``workers`` shard processes (default: one per core)."""
+
+    supervisor = ShardSupervisor(workers or os.cpu_count() or 1)
+    supervisor.start()
+    server = create_front(host, port, supervisor)
+    address = server.server_address
+    print(f"Serving adaptive test UI on http://{address[0]}:{address[1]} with {len(supervisor)} shard workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:  # pragma: no cover - manual shutdown
+        print("\nStopping server…")
+    finally:
+        server.server_close()
+        supervisor.stop()
+    return address
+
+
+def _shutdown_on_eof(server: ThreadingHTTPServer) -> None:
+    # The supervisor holds the other end of stdin: EOF means stop (or that it died).
+    sys.stdin.buffer.read()
+    server.shutdown()
+
+
+def _serve_worker(host: str, ready_fd: int) -> None:
+    from .server import AdaptiveHTTPRequestHandler
+    from .service import start_background_tasks, stop_background_tasks
+
+    server = ThreadingHTTPServer((host, 0), AdaptiveHTTPRequestHandler)
+    start_background_tasks()
+    with os.fdopen(ready_fd, "w") as ready:
+        ready.write(f"{server.server_address[1]}\n")
+    threading.Thread(target=_shutdown_on_eof, args=(server,), daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        stop_background_tasks()
+        server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the adaptive English level test server as sharded worker processes")
+    parser.add_argument("--host", default="127.0.0.1", help="Hostname to bind (default: 127.0.0.1)")
+    parser.add_argument("--port", default=8000, type=int, help="Port to bind (default: 8000)")
+    parser.add_argument("--workers", default=0, type=int, help="Shard worker processes (default: one per core)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--ready-fd", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        _serve_worker(args.host, args.ready_fd)
+    else:
+        run_sharded(args.host, args.port, args.workers)
+
+
+if __name__ == "__main__":
+    main()
+
+
+__all__ = [
+    "HEALTH_PATH",
+    "ShardProxyHandler",
+    "ShardSupervisor",
+    "ShardUnavailable",
+    "create_front",
+    "run_sharded",
+]
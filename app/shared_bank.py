@@ -0,0 +1,89 @@
+"""Item bank published once in shared memory for multi-process deployments.
+
+The parent process encodes the bank with the snapshot format from
+:mod:`app.bank_snapshot` (parameter block plus interned string table) into a
+:class:`multiprocessing.shared_memory.SharedMemory` segment and exports the
+segment name through :data:`SHARED_BANK_ENV`. Workers started with that
+variable attach read-only in :func:`app.bank_snapshot.load_item_bank` and get
+:class:`~app.bank_snapshot.SnapshotItem` views over the shared pages, so the
+bank costs each extra worker only the views it actually touches.
+"""
+from __future__ import annotations
+
+import os
+from multiprocessing import resource_tracker, shared_memory
+from typing import Iterable, MutableMapping, Optional
+
+from app.bank_snapshot import BankSnapshot, encode_snapshot
+from app.cat_engine import Item
+
+SHARED_BANK_ENV = "ADAPTIVE_TEST_SHARED_BANK"
+
+
+class SharedBank:
+    """Owner of a shared-memory segment holding an encoded item bank."""
+
+    def __init__(self, items: Iterable[Item], name: Optional[str] = None) -> None:
+        payload = encode_snapshot(items)
+        self._memory = shared_memory.SharedMemory(name=name, create=True, size=len(payload))
+        self._memory.buf[: len(payload)] = payload
+        self.name = self._memory.name
+        self.size = len(payload)
+        self.version = BankSnapshot(payload).version
+
+    def export(self, environ: MutableMapping[str, str] = os.environ) -> None:
+        """Advertise the segment to child processes through ``environ``."""
+
+        environ[SHARED_BANK_ENV] = self.name
+
+    def close(self) -> None:
+        """Detach and destroy the segment; attached workers keep their mapping."""
+
+        if self._memory is None:
+            return
+        self._memory.close()
+        self._memory.unlink()
+        self._memory = None
+
+    def __enter__(self) -> "SharedBank":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+class _AttachedSegment:
+    """Keeps a worker's mapping alive for as long as snapshot views use it."""
+
+    def __init__(self, name: str) -> None:
+        self.memory = shared_memory.SharedMemory(name=name, create=False)
+        # Attaching registers the segment with this process' resource tracker,
+        # which would unlink it when the worker exits; only the publisher owns it.
+        resource_tracker.unregister(self.memory._name, "shared_memory")  # type: ignore[attr-defined]
+        self.view = self.memory.buf.toreadonly()
+
+    def __del__(self) -> None:
+        self.view.release()
+        try:
+            self.memory.close()
+        except BufferError:  # pragma: no cover - views still alive at interpreter exit
+            pass
+
+
+def attach_bank(name: str) -> BankSnapshot:
+    """Attach read-only to the bank published under ``name``."""
+
+    segment = _AttachedSegment(name)
+    return BankSnapshot(segment.view, owner=segment)
+
+
+def attached_bank_from_env(environ: MutableMapping[str, str] = os.environ) -> Optional[BankSnapshot]:
+    """Attach to the segment named in :data:`SHARED_BANK_ENV`, if any."""
+
+    name = environ.get(SHARED_BANK_ENV)
+    if not name:
+        return None
+    return attach_bank(name)
+
+
+__all__ = ["SHARED_BANK_ENV", "SharedBank", "attach_bank", "attached_bank_from_env"]
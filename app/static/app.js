@@ -8,6 +8,7 @@ const state = {
   pauseDomain: null,
   timerStartedAt: null,
   timerInterval: null,
+  sessionToken: null,
 };
 
 const startForm = document.getElementById('start-form');
@@ -37,11 +38,28 @@ const listeningContainer = document.getElementById('listening-container');
 let listeningAudio = document.getElementById('listening-audio');
 const playCounter = document.getElementById('play-counter');
 
+// In stateless mode every API response carries the signed session state,
+// which has to be sent back with the next request.
+async function apiFetch(url, options = {}) {
+  const headers = { ...(options.headers || {}) };
+  if (state.sessionToken) {
+    headers['X-Session-Token'] = state.sessionToken;
+  }
+  const response = await fetch(url, { ...options, headers });
+  if (response.ok) {
+    const data = await response.clone().json().catch(() => null);
+    if (data && data.session_token) {
+      state.sessionToken = data.session_token;
+    }
+  }
+  return response;
+}
+
 resumeButton.addEventListener('click', async () => {
   if (!state.testId) return;
   resumeButton.disabled = true;
   try {
-    const response = await fetch(`/api/test/${state.testId}/resume`, {
+    const response = await apiFetch(`/api/test/${state.testId}/resume`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
     });
@@ -67,7 +85,7 @@ startForm.addEventListener('submit', async (event) => {
   const lastName = formData.get('last-name');
   startStatus.textContent = 'Starting adaptive session…';
   try {
-    const response = await fetch('/api/test/start', {
+    const response = await apiFetch('/api/test/start', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({
@@ -100,7 +118,7 @@ startForm.addEventListener('submit', async (event) => {
 async function fetchNextItem() {
   if (!state.testId) return;
   try {
-    const response = await fetch(`/api/test/${state.testId}/next`);
+    const response = await apiFetch(`/api/test/${state.testId}/next`);
     if (!response.ok) {
       throw new Error((await response.json()).detail || 'No more items available');
     }
@@ -196,8 +214,12 @@ function setupListening(item) {
     max: item.max_plays || 2,
     pending: false,
     blocked: false,
+    switching: false,
   };
 
+  // Locally served audio starts on a preview link; each registered play
+  // returns the link for that play, which the player switches to.
+  listeningAudio.preload = 'metadata';
   listeningAudio.src = item.metadata.audio_url;
   listeningAudio.load();
   playCounter.textContent = `Plays: 0 / ${state.listening.max}`;
@@ -208,6 +230,10 @@ function setupListening(item) {
       listeningAudio.pause();
       return;
     }
+    if (state.listening.switching) {
+      state.listening.switching = false;
+      return;
+    }
     if (state.listening.pending) return;
     if (state.listening.plays >= state.listening.max) {
       listeningAudio.pause();
@@ -216,7 +242,7 @@ function setupListening(item) {
     }
     state.listening.pending = true;
     try {
-      const response = await fetch(`/api/test/${state.testId}/play`, {
+      const response = await apiFetch(`/api/test/${state.testId}/play`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ item_id: state.currentItem.item_id }),
@@ -230,6 +256,14 @@ function setupListening(item) {
       if (data.plays >= data.max_plays) {
         playCounter.textContent += ' • Limit reached';
       }
+      if (data.audio_url) {
+        listeningAudio.pause();
+        state.listening.switching = true;
+        listeningAudio.src = data.audio_url;
+        listeningAudio.play().catch(() => {
+          state.listening.switching = false;
+        });
+      }
     } catch (error) {
       state.listening.blocked = true;
       answerStatus.textContent = error.message;
@@ -250,7 +284,7 @@ submitAnswerBtn.addEventListener('click', async () => {
   answerStatus.textContent = 'Scoring response…';
 
   try {
-    const response = await fetch(`/api/test/${state.testId}/answer`, {
+    const response = await apiFetch(`/api/test/${state.testId}/answer`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(payload),
@@ -292,7 +326,7 @@ finishBtn.addEventListener('click', async () => {
 async function finishTest() {
   if (!state.testId || state.finished) return;
   try {
-    const response = await fetch(`/api/test/${state.testId}/finish`, {
+    const response = await apiFetch(`/api/test/${state.testId}/finish`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ confirm: true }),
@@ -316,7 +350,7 @@ async function finishTest() {
 async function loadReport() {
   if (!state.testId) return;
   try {
-    const response = await fetch(`/api/report/${state.testId}`);
+    const response = await apiFetch(`/api/report/${state.testId}`);
     if (!response.ok) {
       throw new Error((await response.json()).detail || 'Unable to load report');
     }
@@ -354,6 +388,7 @@ restartBtn.addEventListener('click', async () => {
 
 async function resetUI() {
   state.testId = null;
+  state.sessionToken = null;
   state.currentItem = null;
   state.theta = null;
   state.se = null;
@@ -0,0 +1,277 @@
+"""In-memory static asset cache with validators and precompressed variants.
+
+Every file is read, hashed and (for text types) gzip-compressed once, the
+first time it is requested or when :meth:`StaticAssets.preload` runs at
+start-up, and is then served from memory without touching the disk. With
+``reload`` (:data:`STATIC_RELOAD_ENV` during development) each request stats
+the file and reloads it when its size or mtime changed.
+
+Responses carry a strong ``ETag`` and ``Last-Modified``, and conditional
+requests (``If-None-Match``, ``If-Modified-Since``) are answered with
+``304``. The page template is rewritten to reference fingerprinted URLs
+(``/static/app.<hash>.js``); those are served with a one-year ``immutable``
+``Cache-Control``, so a returning browser does not even revalidate them, while
+the page itself and plain URLs use ``no-cache`` and are revalidated. Clients
+that accept gzip get the precompressed variant, which has its own ETag.
+"""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Dict, Mapping, Optional, Tuple
+
+STATIC_RELOAD_ENV = "ADAPTIVE_TEST_STATIC_RELOAD"
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+_FINGERPRINT = re.compile(r"^(?P<stem>.+)\.(?P<hash>[0-9a-f]{12})(?P<suffix>\.[^./]+)$")
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+_MIN_COMPRESS_BYTES = 256
+
+Reply = Tuple[int, Dict[str, str], bytes]
+
+
+@dataclass(frozen=True)
+class StaticAsset:
+    url: str
+    content: bytes
+    gzipped: Optional[bytes]
+    content_type: str
+    digest: str
+    mtime: float
+    stamp: Tuple[int, int]
+    # Plain URL and digest of every asset a template references.
+    depends: Tuple[Tuple[str, str], ...] = ()
+
+    @property
+    def fingerprint(self) -> str:
+        return self.digest[:12]
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.digest[:32]}"'
+
+    @property
+    def gzip_etag(self) -> str:
+        return f'"{self.digest[:32]}-gz"'
+
+
+def _stamp(path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    for token in accept_encoding.split(","):
+        coding, _, params = token.strip().partition(";")
+        if coding.strip().lower() not in ("gzip", "x-gzip", "*"):
+            continue
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+class StaticAssets:
+    """Serves the page template at ``/`` and files below ``/static/`` from memory."""
+
+    def __init__(self, static_dir: Path, template_dir: Path, reload: bool = False) -> None:
+        self.static_dir = static_dir.resolve()
+        self.template_dir = template_dir.resolve()
+        self.reload = reload
+        self._assets: Dict[str, StaticAsset] = {}
+        # Re-entrant: loading the template loads the assets it references.
+        self._lock = threading.RLock()
+
+    def preload(self) -> int:
+        """Load every static file and the page template; returns the number loaded."""
+
+        for path in sorted(self.static_dir.rglob("*")):
+            if path.is_file():
+                self.asset(f"/static/{path.relative_to(self.static_dir).as_posix()}")
+        self.asset("/")
+        return len(self._assets)
+
+    def url_for(self, url: str) -> str:
+        """Fingerprinted URL for the plain ``/static/...`` URL of an asset."""
+
+        asset = self.asset(url)
+        if asset is None:
+            return url
+        stem, dot, suffix = url.rpartition(".")
+        if not dot or "/" in suffix:
+            return f"{url}.{asset.fingerprint}"
+        return f"{stem}.{asset.fingerprint}.{suffix}"
+
+    def cached(self, url: str) -> bool:
+        """Whether ``url`` would be answered without touching the disk."""
+
+        return not self.reload and self._split(url)[0] in self._assets
+
+    def asset(self, url: str) -> Optional[StaticAsset]:
+        """The current asset for a plain URL, loading or reloading it as needed."""
+
+        asset = self._assets.get(url)
+        if asset is not None and (not self.reload or self._fresh(asset)):
+            return asset
+        path = self._file(url)
+        if path is None:
+            return None
+        with self._lock:
+            asset = self._assets.get(url)
+            if asset is None or not self._fresh(asset):
+                asset = self._load(url, path)
+                if asset is not None:
+                    self._assets[url] = asset
+        return asset
+
+    def respond(self, url: str, headers: Optional[Mapping[str, str]] = None) -> Optional[Reply]:
+        """Status, headers and body for a GET of ``url``; ``None`` if there is no such asset."""
+
+        plain, fingerprint = self._split(url)
+        asset = self.asset(plain)
+        if asset is None:
+            return None
+        get = (lambda name: headers.get(name) or headers.get(name.lower())) if headers else (lambda name: None)
+        use_gzip = asset.gzipped is not None and _accepts_gzip(get("Accept-Encoding") or "")
+        etag = asset.gzip_etag if use_gzip else asset.etag
+        reply_headers = {
+            "Content-Type": asset.content_type,
+            "ETag": etag,
+            "Last-Modified": formatdate(asset.mtime, usegmt=True),
+            # A stale fingerprint gets the current bytes, which must not be cached forever.
+            "Cache-Control": IMMUTABLE if fingerprint == asset.fingerprint else REVALIDATE,
+        }
+        if asset.gzipped is not None:
+            reply_headers["Vary"] = "Accept-Encoding"
+        if self._not_modified(asset, get("If-None-Match"), get("If-Modified-Since")):
+            return 304, reply_headers, b""
+        body = asset.content
+        if use_gzip and asset.gzipped is not None:
+            body = asset.gzipped
+            reply_headers["Content-Encoding"] = "gzip"
+        reply_headers["Content-Length"] = str(len(body))
+        return 200, reply_headers, body
+
+    def _split(self, url: str) -> Tuple[str, Optional[str]]:
+        """Plain URL and fingerprint (if any) of a requested URL."""
+
+        if url in ("", "/"):
+            return "/", None
+        directory, _, name = url.rpartition("/")
+        match = _FINGERPRINT.match(name)
+        if match is None:
+            return url, None
+        plain = f"{directory}/{match['stem']}{match['suffix']}"
+        if plain not in self._assets and self._file(url) is not None:
+            return url, None  # a real file whose name merely looks fingerprinted
+        return plain, match["hash"]
+
+    def _file(self, url: str) -> Optional[Path]:
+        if url == "/":
+            candidate = self.template_dir / "index.html"
+        elif url.startswith("/static/"):
+            candidate = (self.static_dir / url[len("/static/") :]).resolve()
+            if not candidate.is_relative_to(self.static_dir):
+                return None
+        else:
+            return None
+        return candidate if candidate.is_file() else None
+
+    def _fresh(self, asset: StaticAsset) -> bool:
+        path = self._file(asset.url)
+        if path is None or _stamp(path) != asset.stamp:
+            return False
+        for url, digest in asset.depends:
+            dependency = self.asset(url)
+            if dependency is None or dependency.digest != digest:
+                return False
+        return True
+
+    def _load(self, url: str, path: Path) -> Optional[StaticAsset]:
+        stamp = _stamp(path)
+        if stamp is None:
+            return None
+        content = path.read_bytes()
+        mtime = stamp[0] / 1e9
+        depends: Tuple[Tuple[str, str], ...] = ()
+        if url == "/":
+            content, depends, mtime = self._link_assets(content, mtime)
+        content_type = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+        gzipped = None
+        if content_type.startswith(_COMPRESSIBLE) and len(content) >= _MIN_COMPRESS_BYTES:
+            compressed = gzip.compress(content, 9, mtime=0)
+            if len(compressed) < len(content):
+                gzipped = compressed
+        return StaticAsset(
+            url=url,
+            content=content,
+            gzipped=gzipped,
+            content_type=content_type,
+            digest=hashlib.sha256(content).hexdigest(),
+            mtime=mtime,
+            stamp=stamp,
+            depends=depends,
+        )
+
+    def _link_assets(self, page: bytes, mtime: float) -> Tuple[bytes, Tuple[Tuple[str, str], ...], float]:
+        """Point the template's ``/static/...`` references at fingerprinted URLs."""
+
+        depends = []
+        for path in sorted(self.static_dir.rglob("*")):
+            if not path.is_file():
+                continue
+            url = f"/static/{path.relative_to(self.static_dir).as_posix()}"
+            quoted = f'"{url}"'.encode("utf-8")
+            if quoted not in page:
+                continue
+            asset = self.asset(url)
+            if asset is None:
+                continue
+            page = page.replace(quoted, f'"{self.url_for(url)}"'.encode("utf-8"))
+            depends.append((url, asset.digest))
+            mtime = max(mtime, asset.mtime)
+        return page, tuple(depends), mtime
+
+    @staticmethod
+    def _not_modified(asset: StaticAsset, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+        if if_none_match is not None:
+            # Weak comparison (RFC 9110 §13.1.2), against either variant.
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            return "*" in tags or asset.etag in tags or asset.gzip_etag in tags
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(asset.mtime) <= since
+        return False
+
+
+def assets_from_env(static_dir: Path, template_dir: Path, environ: Mapping[str, str] = os.environ) -> StaticAssets:
+    return StaticAssets(static_dir, template_dir, reload=environ.get(STATIC_RELOAD_ENV, "") not in ("", "0"))
+
+
+__all__ = [
+    "IMMUTABLE",
+    "REVALIDATE",
+    "STATIC_RELOAD_ENV",
+    "StaticAsset",
+    "StaticAssets",
+    "assets_from_env",
+]
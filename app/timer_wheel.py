@@ -0,0 +1,81 @@
+"""Hashed timer wheel for per-session deadlines.
+
+Timers are hashed into ``slots`` buckets by the tick on which they expire.
+Scheduling, rescheduling and cancelling are O(1) dictionary operations, and
+:meth:`TimerWheel.advance` only inspects the buckets of the ticks that have
+elapsed. A timer further away than one revolution stays in its bucket and is
+skipped until the revolution in which it is due, so each timer is looked at
+at most once per revolution.
+"""
+from __future__ import annotations
+
+import math
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+TimerKey = Tuple[Hashable, str]
+
+
+class TimerWheel:
+    """Single-level hashed wheel of ``slots`` buckets, ``tick`` seconds each."""
+
+    def __init__(self, tick: float = 1.0, slots: int = 4096, clock: Callable[[], float] = time.monotonic) -> None:
+        if tick <= 0 or slots < 1:
+            raise ValueError("tick and slots must be positive")
+        self.tick = tick
+        self.clock = clock
+        self._buckets: List[Dict[TimerKey, float]] = [{} for _ in range(slots)]
+        self._slot_of: Dict[TimerKey, int] = {}
+        self._current = math.floor(clock() / tick)
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def __contains__(self, key: TimerKey) -> bool:
+        return key in self._slot_of
+
+    def schedule(self, owner: Hashable, kind: str, deadline: float) -> None:
+        """Fire ``(owner, kind)`` at ``deadline``, replacing any earlier timer for it."""
+
+        key = (owner, kind)
+        self.cancel(owner, kind)
+        # Never hash into a tick that has already been processed.
+        tick = max(math.ceil(deadline / self.tick), self._current + 1)
+        slot = tick % len(self._buckets)
+        self._buckets[slot][key] = deadline
+        self._slot_of[key] = slot
+
+    def schedule_in(self, owner: Hashable, kind: str, delay: float) -> None:
+        self.schedule(owner, kind, self.clock() + delay)
+
+    def cancel(self, owner: Hashable, kind: str) -> None:
+        key = (owner, kind)
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            del self._buckets[slot][key]
+
+    def advance(self, now: Optional[float] = None) -> List[TimerKey]:
+        """Pop and return every timer whose deadline is at or before ``now``."""
+
+        if now is None:
+            now = self.clock()
+        target = math.floor(now / self.tick)
+        expired: List[TimerKey] = []
+        if target <= self._current:
+            return expired
+        # After a long stall one pass over all buckets covers every elapsed tick.
+        first = max(self._current + 1, target - len(self._buckets) + 1)
+        for tick in range(first, target + 1):
+            bucket = self._buckets[tick % len(self._buckets)]
+            if not bucket:
+                continue
+            due = [key for key, deadline in bucket.items() if deadline <= now]
+            for key in due:
+                del bucket[key]
+                del self._slot_of[key]
+            expired.extend(due)
+        self._current = target
+        return expired
+
+
+__all__ = ["TimerWheel"]
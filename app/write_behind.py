@@ -0,0 +1,342 @@
+"""Write-behind queue that group-commits test events to SQLite.
+
+Request threads hand start, state, response and finish events to a bounded
+in-process queue and return immediately. A single background thread drains
+the queue and writes whatever has accumulated (up to ``max_batch`` events,
+waiting at most ``max_delay`` seconds for more) in one transaction, so the
+number of commits grows with the number of batches rather than the number of
+answers. The durability mode controls what a caller waits for:
+
+``async``  return as soon as the event is queued (the default)
+``group``  wait until the batch holding the event has been committed
+``sync``   skip the queue and write on the calling thread
+
+A full queue blocks producers until the writer catches up, and
+:meth:`WriteBehindQueue.close` (registered with :mod:`atexit` for the shared
+queue) flushes everything that is still pending.
+
+A batch that hits a transient error (``database is locked``) is retried
+with backoff. If it still fails, its statements are written one by one, so
+only a statement that fails on its own is lost; its waiter gets the error
+and :attr:`WriterStats.lost_statements` counts it.
+"""
+from __future__ import annotations
+
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .database import (
+    RESPONSE_SQL,
+    TEST_FINISH_SQL,
+    TEST_START_SQL,
+    TEST_STATE_SQL,
+    execute_batch,
+    finish_params,
+    response_params,
+    start_params,
+    state_params,
+)
+
+DURABILITY_ENV = "ADAPTIVE_TEST_DB_DURABILITY"
+DURABILITY_MODES = ("async", "group", "sync")
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _Ticket:
+    """Completion signal for callers that wait for their batch to commit."""
+
+    __slots__ = ("done", "error")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        if not self.done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+# ``sql`` is ``None`` for a flush barrier, which only carries a ticket.
+_Event = Tuple[Optional[str], Sequence[object], Optional[_Ticket]]
+
+
+@dataclass
+class WriterStats:
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    enqueued: int = 0
+    written: int = 0
+    batches: int = 0
+    failed_batches: int = 0
+    retries: int = 0
+    lost_statements: int = 0
+    backpressure_waits: int = 0
+    last_batch_size: int = 0
+    last_flush_ms: float = 0.0
+    max_flush_ms: float = 0.0
+    total_flush_ms: float = 0.0
+
+    def to_dict(self) -> Dict[str, object]:
+        return asdict(self)
+
+
+class WriteBehindQueue:
+    """Bounded queue of database writes drained by one group-commit thread."""
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        durability: str = "async",
+        capacity: int = 10_000,
+        max_batch: int = 512,
+        max_delay: float = 0.002,
+        retries: int = 3,
+        retry_delay: float = 0.05,
+    ) -> None:
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unsupported durability mode: {durability}")
+        self.path = path
+        self.durability = durability
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue: "queue.Queue[object]" = queue.Queue(maxsize=capacity)
+        self._stats = WriterStats()
+        self._stats_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    # Event helpers mirroring :mod:`app.database` ---------------------------------
+
+    def record_test_start(
+        self,
+        test_id: str,
+        first_name: str,
+        last_name: str,
+        start_level: str,
+        started_at: datetime,
+        upcoming_part: Optional[str],
+        wait: bool = False,
+    ) -> None:
+        self.submit(
+            TEST_START_SQL,
+            start_params(test_id, first_name, last_name, start_level, started_at, upcoming_part),
+            wait,
+        )
+
+    def update_test_state(self, test_id: str, current_part: Optional[str], paused: bool, wait: bool = False) -> None:
+        self.submit(TEST_STATE_SQL, state_params(test_id, current_part, paused), wait)
+
+    def record_response(
+        self,
+        test_id: str,
+        item_id: str,
+        domain: str,
+        score: float,
+        answered_at: datetime,
+        wait: bool = False,
+    ) -> None:
+        self.submit(RESPONSE_SQL, response_params(test_id, item_id, domain, score, answered_at), wait)
+
+    def record_test_finish(self, test_id: str, finished_at: datetime, wait: bool = False) -> None:
+        self.submit(TEST_FINISH_SQL, finish_params(test_id, finished_at), wait)
+
+    # Queue management ------------------------------------------------------------
+
+    def submit(self, sql: str, params: Sequence[object], wait: bool = False) -> None:
+        """Queue one statement; ``wait`` forces this call to be durable."""
+
+        if self.durability == "sync" or self._closed:
+            error = self._write([(sql, params, None)])
+            if error is not None:
+                raise error
+            return
+        ticket = _Ticket() if wait or self.durability == "group" else None
+        self._put((sql, params, ticket))
+        if ticket is not None:
+            ticket.wait()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until every event queued before this call is committed."""
+
+        if self._thread is None or self._closed:
+            return True
+        ticket = _Ticket()
+        self._put((None, (), ticket))
+        return ticket.wait(timeout)
+
+    def close(self) -> None:
+        """Flush pending events and stop the writer thread."""
+
+        with self._start_lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+        # Events queued by threads that raced with ``close`` after the stop marker.
+        leftovers: List[_Event] = []
+        while True:
+            try:
+                leftovers.append(self._queue.get_nowait())  # type: ignore[arg-type]
+            except queue.Empty:
+                break
+        if leftovers:
+            self._write(leftovers)
+
+    def stats(self) -> WriterStats:
+        with self._stats_lock:
+            snapshot = WriterStats(**asdict(self._stats))
+        snapshot.queue_depth = self._queue.qsize()
+        return snapshot
+
+    def _put(self, event: _Event) -> None:
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats.backpressure_waits += 1
+            self._queue.put(event)
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self._stats.enqueued += event[0] is not None
+            self._stats.max_queue_depth = max(self._stats.max_queue_depth, depth)
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                thread.start()
+                self._thread = thread
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            batch: List[_Event] = [first]  # type: ignore[list-item]
+            stop = False
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    event = self._queue.get_nowait()
+                except queue.Empty:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        event = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if event is _STOP:
+                    stop = True
+                    break
+                batch.append(event)  # type: ignore[arg-type]
+            self._write(batch)
+            if stop:
+                return
+
+    def _write(self, batch: List[_Event]) -> Optional[BaseException]:
+        statements = [(index, sql, params) for index, (sql, params, _ticket) in enumerate(batch) if sql is not None]
+        started = time.perf_counter()
+        # Errors of the statements that could not be written, by batch position.
+        errors: Dict[int, BaseException] = {}
+        error = self._execute([(sql, params) for _index, sql, params in statements]) if statements else None
+        if error is not None and len(statements) > 1:
+            logger.warning("Write-behind batch of %d statements failed (%s); writing them one by one", len(statements), error)
+            for index, sql, params in statements:
+                failed = self._execute([(sql, params)])
+                if failed is not None:
+                    errors[index] = failed
+        elif error is not None:
+            errors[statements[0][0]] = error
+        for index, failed in errors.items():
+            logger.error("Dropped write-behind statement %r: %s", batch[index][0], failed)
+        elapsed = (time.perf_counter() - started) * 1000.0
+        with self._stats_lock:
+            stats = self._stats
+            stats.written += len(statements) - len(errors)
+            stats.failed_batches += error is not None
+            stats.lost_statements += len(errors)
+            stats.batches += 1
+            stats.last_batch_size = len(statements)
+            stats.last_flush_ms = elapsed
+            stats.max_flush_ms = max(stats.max_flush_ms, elapsed)
+            stats.total_flush_ms += elapsed
+        lost = next(iter(errors.values()), None)
+        for index, (sql, _params, ticket) in enumerate(batch):
+            if ticket is not None:
+                # A flush barrier reports any statement of its batch that was lost.
+                ticket.error = errors.get(index) if sql is not None else lost
+                ticket.done.set()
+        return lost
+
+    def _execute(self, statements: List[Tuple[str, Sequence[object]]]) -> Optional[BaseException]:
+        """Run ``statements`` in one transaction, retrying transient errors; return the final error."""
+
+        attempt = 0
+        while True:
+            try:
+                execute_batch(statements, self.path)
+                return None
+            except Exception as exc:  # keep the writer alive; waiters see the error
+                if attempt >= self.retries or not _transient(exc):
+                    return exc
+            with self._stats_lock:
+                self._stats.retries += 1
+            time.sleep(self.retry_delay * 2 ** attempt)
+            attempt += 1
+
+
+def _transient(error: BaseException) -> bool:
+    """Whether ``error`` may go away on its own (another connection holds a lock)."""
+
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+
+_default_writer: Optional[WriteBehindQueue] = None
+_default_lock = threading.Lock()
+
+
+def default_writer() -> WriteBehindQueue:
+    """Process-wide queue for the default database, configured from the environment."""
+
+    global _default_writer
+    if _default_writer is None:
+        with _default_lock:
+            if _default_writer is None:
+                writer = WriteBehindQueue(durability=os.environ.get(DURABILITY_ENV, "async"))
+                atexit.register(writer.close)
+                _default_writer = writer
+    return _default_writer
+
+
+__all__ = [
+    "DURABILITY_ENV",
+    "DURABILITY_MODES",
+    "WriteBehindQueue",
+    "WriterStats",
+    "default_writer",
+]
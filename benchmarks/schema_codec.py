@@ -0,0 +1,107 @@
+"""Time the generated schema (de)serializers against the reflective path.
+
+For each request schema, compares ``dataclass_from_dict`` (field-name set
+rebuilt per call, ``__post_init__`` run twice) with the generated
+``from_dict``. For each response schema, compares ``dataclasses.asdict``
+(recursive deep copy) with the generated ``to_dict``. The report is also
+measured against a replica of the previous ``DomainBreakdown``, which
+rebuilt its order dict per instance and was sorted through its dataclass
+ordering.
+
+Run with ``python benchmarks/schema_codec.py [--number N]``.
+"""
+from __future__ import annotations
+
+import argparse
+import pathlib
+import sys
+import timeit
+from dataclasses import asdict, dataclass, field
+from typing import Callable, List, Tuple
+from uuid import uuid4
+
+for candidate in pathlib.Path(__file__).resolve().parents:
+    if (candidate / "app").exists():
+        sys.path.insert(0, str(candidate))
+        break
+
+from app import schemas  # noqa: E402
+from app.cat_engine import CAT_PARTS  # noqa: E402
+from app.item_bank import ITEMS  # noqa: E402
+
+
+@dataclass(order=True)
+class LegacyDomainBreakdown:
+    sort_index: int = field(init=False, repr=False)
+    domain: str
+    average_score: float
+    cefr: str
+
+    def __post_init__(self) -> None:
+        order = {name: index for index, name in enumerate(CAT_PARTS)}
+        self.sort_index = order.get(self.domain, 99)
+
+    def to_dict(self) -> dict:
+        return {"domain": self.domain, "average_score": self.average_score, "cefr": self.cefr}
+
+
+def _legacy_report(test_id, rows) -> dict:
+    domains = [LegacyDomainBreakdown(*row) for row in rows]
+    return {
+        "test_id": str(test_id),
+        "theta": 0.4,
+        "se": 0.3,
+        "t_score": 54.0,
+        "cefr": "B1",
+        "domains": [domain.to_dict() for domain in sorted(domains)],
+    }
+
+
+def _report(test_id, rows) -> dict:
+    domains = [schemas.DomainBreakdown(*row) for row in rows]
+    return schemas.ReportResponse(test_id, 0.4, 0.3, 54.0, "B1", domains).to_dict()
+
+
+def cases() -> List[Tuple[str, Callable[[], object], Callable[[], object]]]:
+    item = next(item for item in ITEMS if item.domain == "listening")
+    start = {"start_level": "Middle", "first_name": "Ada", "last_name": "Lovelace", "extra": 1}
+    answer = {"item_id": item.id, "response": {"answer": 1}}
+    response = schemas.ItemResponse(
+        item.id, item.stem, item.options, item.domain, item.model, item.metadata, item.max_plays
+    )
+    started = schemas.StartTestResponse(uuid4(), 0.0, 1.0, "grammar", True, "grammar")
+    scored = schemas.AnswerResponse(0.4, 0.3, True, 1.0, "reading")
+    test_id = uuid4()
+    rows = [(domain, 0.5, "B1") for domain in reversed(CAT_PARTS)]
+    return [
+        (
+            "StartTestRequest.from_dict",
+            lambda: schemas.dataclass_from_dict(schemas.StartTestRequest, start),
+            lambda: schemas.StartTestRequest.from_dict(start),
+        ),
+        (
+            "AnswerRequest.from_dict",
+            lambda: schemas.dataclass_from_dict(schemas.AnswerRequest, answer),
+            lambda: schemas.AnswerRequest.from_dict(answer),
+        ),
+        ("ItemResponse.to_dict", lambda: asdict(response), response.to_dict),
+        ("StartTestResponse.to_dict", lambda: asdict(started), started.to_dict),
+        ("AnswerResponse.to_dict", lambda: asdict(scored), scored.to_dict),
+        ("ReportResponse (build+dict)", lambda: _legacy_report(test_id, rows), lambda: _report(test_id, rows)),
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=50_000, help="Calls per measurement")
+    args = parser.parse_args()
+
+    print(f"{'':<28}{'reflective':>12}{'generated':>12}{'speedup':>9}")
+    for label, legacy, generated in cases():
+        before = min(timeit.repeat(legacy, number=args.number, repeat=3)) / args.number
+        after = min(timeit.repeat(generated, number=args.number, repeat=3)) / args.number
+        print(f"{label:<28}{before * 1e6:>10.2f}us{after * 1e6:>10.2f}us{before / after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Measure the resident size of completed test sessions with tracemalloc.
+
+Compares the compact session layout (bank positions, bitsets, array columns)
+with a replica of the previous layout (``Item`` references in a dict, a set
+of id strings and a list of ``Response`` dataclasses holding raw dicts) and
+reports how many finished sessions fit in one gigabyte.
+
+Run with ``python benchmarks/session_memory.py [--sessions N]``.
+"""
+from __future__ import annotations
+
+import argparse
+import pathlib
+import sys
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+for candidate in pathlib.Path(__file__).resolve().parents:
+    if (candidate / "app").exists():
+        sys.path.insert(0, str(candidate))
+        break
+
+from app.cat_engine import (  # noqa: E402
+    CAT_PARTS,
+    Item,
+    Response,
+    Session,
+    register_item_bank,
+    score_response,
+    select_next_item,
+    update_theta,
+)
+from app.item_bank import ITEMS  # noqa: E402
+
+GIGABYTE = 1024 ** 3
+
+
+@dataclass
+class LegacyResponse:
+    item_id: str
+    score: float
+    theta_before: float
+    theta_after: float
+    se_after: float
+    raw_response: Dict[str, object] | None = None
+
+
+@dataclass
+class LegacySession:
+    id: str
+    start_level: str
+    theta: float
+    prior_mu: float
+    prior_sigma: float
+    se: float
+    part_index: int = 0
+    finished: bool = False
+    responses: List[LegacyResponse] = field(default_factory=list)
+    plays: Dict[str, int] = field(default_factory=dict)
+    seen_items: set[str] = field(default_factory=set)
+    pending_item_id: Optional[str] = None
+    part_counts: Dict[str, int] = field(default_factory=lambda: {part: 0 for part in CAT_PARTS})
+    item_history: Dict[str, Item] = field(default_factory=dict)
+    first_name: str = ""
+    last_name: str = ""
+    paused: bool = True
+    upcoming_domain: Optional[str] = None
+
+
+def _answer_for(item: Item) -> object:
+    if item.model.lower() == "gpcm":
+        return list(item.correct_response())
+    return item.correct_response()[0]
+
+
+def run_session() -> Session:
+    """Play a complete test and return the finished compact session."""
+
+    session = Session(
+        id=str(uuid4()),
+        start_level="middle",
+        theta=0.0,
+        prior_mu=0.0,
+        prior_sigma=1.0,
+        se=float("inf"),
+        first_name="Bench",
+        last_name="Candidate",
+    )
+    while not session.finished:
+        session.resume_current_part()
+        item = select_next_item(session, ITEMS)
+        if item is None:
+            break
+        raw = {"answer": _answer_for(item)}
+        score = score_response(item, raw)
+        theta_before = session.theta
+        session.theta, session.se = update_theta(session, item, score)
+        session.responses.append(Response(item.id, score, theta_before, session.theta, session.se, raw))
+        session.record_domain_progress(item.domain)
+        session.pending_item_id = None
+    return session
+
+
+def to_legacy(session: Session) -> LegacySession:
+    legacy = LegacySession(
+        id=str(uuid4()),
+        start_level=session.start_level,
+        theta=session.theta,
+        prior_mu=session.prior_mu,
+        prior_sigma=session.prior_sigma,
+        se=session.se,
+        part_index=session.part_index,
+        finished=session.finished,
+        first_name="Bench",
+        last_name="Candidate",
+    )
+    for record in session.responses:
+        item = session.item_history[record.item_id]
+        legacy.responses.append(
+            LegacyResponse(
+                item_id=item.id,
+                score=record.score,
+                theta_before=record.theta_before,
+                theta_after=record.theta_after,
+                se_after=record.se_after,
+                raw_response=dict(record.raw_response or {}),
+            )
+        )
+        legacy.seen_items.add(item.id)
+        legacy.item_history[item.id] = item
+    legacy.part_counts = dict(session.part_counts)
+    return legacy
+
+
+def measure(factory, count: int) -> float:
+    """Average traced bytes retained per object produced by ``factory``."""
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    kept = [factory() for _ in range(count)]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return (after - before) / count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=200, help="Sessions to allocate per layout")
+    args = parser.parse_args()
+
+    register_item_bank(ITEMS)
+    template = run_session()
+    compact = measure(run_session, args.sessions)
+    legacy = measure(lambda: to_legacy(template), args.sessions)
+    print(f"answers per session: {len(template.responses)}")
+    for label, size in (("legacy", legacy), ("compact", compact)):
+        print(f"{label:>8}: {size / 1024:8.1f} KiB/session  {GIGABYTE / size:12,.0f} sessions/GB")
+    print(f"   ratio: {legacy / compact:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,53 @@
 from __future__ import annotations
 
+import base64
+import hashlib
+import hmac
 import pathlib
 import sqlite3
+import struct
 import sys
+import threading
+import time
+import zlib
 from uuid import UUID
 
+import pytest
+
 # Ensure the repository root (which contains the ``app`` package) is on sys.path
 for candidate in pathlib.Path(__file__).resolve().parents:
     if (candidate / "app").exists():
         sys.path.insert(0, str(candidate))
         break
 
-from app.database import DB_PATH, reset_db
+from app.cat_engine import current_bank, register_item_bank
+from app.database import (
+    DB_PATH,
+    count_session_blobs,
+    iter_session_blobs,
+    load_session_blob,
+    reset_db,
+    save_session_blob,
+)
 from app.item_bank import ITEMS
 from app.service import AdaptiveTestService
-from app.session_store import reset_store
+from app.timer_wheel import TimerWheel
+from app.session_journal import SessionJournal
+from app.session_store import (
+    FINISHED_SESSION_TTL,
+    SESSION_TIME_LIMIT,
+    SessionBankUnavailable,
+    SessionReaper,
+    SqliteSessionStore,
+    all_sessions,
+    configure_reaper,
+    configure_store,
+    get_session,
+    reset_store,
+    restore_sessions,
+)
+from app.session_locks import StripedLocks
+from app.session_token import InvalidToken, SessionTokenCodec, TokenLedger
 
 
 def get_correct_answer(item_id: str) -> int | list[int]:
@@ -109,3 +142,405 @@ def test_listening_play_limit() -> None:
         raise AssertionError("Expected play limit error")
     except ValueError as exc:
         assert str(exc) == "Max plays reached"
+
+
+def _session_state(session) -> tuple:
+    return (
+        session.id,
+        session.start_level,
+        session.first_name,
+        session.started_at,
+        session.theta,
+        session.se,
+        session.part_index,
+        session.paused,
+        session.finished,
+        session.pending_item_id,
+        session.upcoming_domain,
+        dict(session.part_counts),
+        dict(session.plays),
+        sorted(session.seen_items),
+        sorted(session.item_history),
+        list(session.responses),
+    )
+
+
+def test_session_journal_replays_sessions_after_restart(tmp_path: pathlib.Path) -> None:
+    reset_store()
+    path = tmp_path / "sessions.journal"
+    journal = SessionJournal(path)
+    test_service = AdaptiveTestService(journal=journal)
+    test_ids = [
+        UUID(test_service.start_test({"start_level": level, "first_name": "J", "last_name": level})["test_id"])
+        for level in ("easy", "hard")
+    ]
+    listening_id = test_ids[0]
+    while True:
+        item = test_service.get_next_item(listening_id)
+        if item.get("pause"):
+            test_service.resume_section(listening_id)
+            continue
+        if item["domain"] == "listening":
+            test_service.record_play(listening_id, {"item_id": item["item_id"]})
+            break
+        test_service.submit_answer(
+            listening_id,
+            {"item_id": item["item_id"], "response": {"answer": get_correct_answer(item["item_id"])}},
+        )
+    test_service.resume_section(test_ids[1])
+    test_service.get_next_item(test_ids[1])
+    test_service.finish_test(test_ids[1])
+    journal.close()
+
+    expected = [_session_state(get_session(test_id)) for test_id in test_ids]
+    replayed = {session.id: session for session in SessionJournal(path).replay()}
+    assert [_session_state(replayed[str(test_id)]) for test_id in test_ids] == expected
+
+    # A torn trailing record is dropped, and compaction keeps the same state.
+    with open(path, "ab") as handle:
+        handle.write(b"\x40\x00\x00\x00\x01\x02")
+    journal = SessionJournal(path)
+    sessions = journal.replay()
+    size = journal.compact(sessions)
+    assert path.stat().st_size == size
+    replayed = {session.id: session for session in SessionJournal(path).replay()}
+    assert [_session_state(replayed[str(test_id)]) for test_id in test_ids] == expected
+
+    # Restored sessions carry on where they stopped.
+    reset_store()
+    restore_sessions(replayed.values())
+    next_item = test_service.get_next_item(listening_id)
+    assert next_item["item_id"] == expected[0][9]
+    assert test_service.record_play(listening_id, {"item_id": next_item["item_id"]})["plays"] == 2
+
+
+def test_session_journal_compacts_on_a_background_thread(tmp_path: pathlib.Path) -> None:
+    reset_store()
+    path = tmp_path / "sessions.journal"
+    compacted_on = []
+
+    def live_sessions():
+        compacted_on.append(threading.current_thread().name)
+        return all_sessions()
+
+    journal = SessionJournal(path, compact_bytes=256, sessions=live_sessions)
+    test_service = AdaptiveTestService(journal=journal)
+    test_ids = [
+        UUID(test_service.start_test({"start_level": "easy", "first_name": "J", "last_name": str(n)})["test_id"])
+        for n in range(3)
+    ]
+    for test_id in test_ids:
+        test_service.resume_section(test_id)
+        test_service.get_next_item(test_id)
+    deadline = time.monotonic() + 5
+    while not compacted_on and time.monotonic() < deadline:
+        time.sleep(0.01)
+    journal.close()
+
+    assert compacted_on and set(compacted_on) == {"journal-compactor"}
+    replayed = {session.id: session for session in SessionJournal(path).replay()}
+    assert [_session_state(replayed[str(test_id)]) for test_id in test_ids] == [
+        _session_state(get_session(test_id)) for test_id in test_ids
+    ]
+
+
+def test_session_journal_appends_while_compaction_waits_for_a_session(tmp_path: pathlib.Path) -> None:
+    reset_store()
+    path = tmp_path / "sessions.journal"
+    locks = StripedLocks()
+    journal = SessionJournal(path, sessions=all_sessions, lock=locks.hold)
+    test_service = AdaptiveTestService(journal=journal, locks=locks)
+    start = {"start_level": "easy", "first_name": "L", "last_name": "K"}
+    first = second = UUID(test_service.start_test(start)["test_id"])
+    while locks.stripe(second) == locks.stripe(first):
+        second = UUID(test_service.start_test(start)["test_id"])
+    with locks.hold(first):
+        compactor = threading.Thread(target=journal.compact)
+        compactor.start()
+        time.sleep(0.05)
+        appender = threading.Thread(target=test_service.resume_section, args=(second,))
+        appender.start()
+        appender.join(5)
+        assert not appender.is_alive() and compactor.is_alive()
+    compactor.join(5)
+    journal.close()
+
+    replayed = {session.id: session for session in SessionJournal(path).replay()}
+    assert [_session_state(replayed[str(test_id)]) for test_id in (first, second)] == [
+        _session_state(get_session(test_id)) for test_id in (first, second)
+    ]
+
+
+def test_sqlite_session_store_evicts_and_faults_sessions_back_in(tmp_path: pathlib.Path) -> None:
+    store = SqliteSessionStore(tmp_path / "sessions.db", capacity=2)
+    previous = configure_store(store)
+    try:
+        test_service = AdaptiveTestService()
+        test_ids = [
+            UUID(test_service.start_test({"start_level": "middle", "first_name": "S", "last_name": str(n)})["test_id"])
+            for n in range(5)
+        ]
+        for test_id in test_ids:
+            test_service.resume_section(test_id)
+            item = test_service.get_next_item(test_id)
+            test_service.submit_answer(
+                test_id, {"item_id": item["item_id"], "response": {"answer": get_correct_answer(item["item_id"])}}
+            )
+        assert store.hot_count() == 2
+        assert store.evictions > 0
+        assert len(store) == 5
+
+        expected = _session_state(get_session(test_ids[0]))
+        faults = store.faults
+        store.capacity = 1
+        for test_id in test_ids[1:]:
+            get_session(test_id)
+        assert _session_state(get_session(test_ids[0])) == expected
+        assert store.faults > faults
+
+        item = test_service.get_next_item(test_ids[0])
+        answer = test_service.submit_answer(
+            test_ids[0], {"item_id": item["item_id"], "response": {"answer": get_correct_answer(item["item_id"])}}
+        )
+        assert len(get_session(test_ids[0]).responses) == 2
+        assert answer["theta"] == get_session(test_ids[0]).theta
+        assert {session.id for session in store.sessions()} == {str(test_id) for test_id in test_ids}
+        assert len(store) == 5
+
+        path = tmp_path / "sessions.db"
+        assert sorted(row["id"] for row in iter_session_blobs(path, batch=2)) == sorted(
+            str(test_id) for test_id in test_ids
+        )
+        assert count_session_blobs([str(test_ids[0]), "missing"], path) == 4
+    finally:
+        configure_store(previous)
+
+
+def test_sqlite_session_store_faults_sessions_in_against_their_own_bank(tmp_path: pathlib.Path) -> None:
+    store = SqliteSessionStore(tmp_path / "sessions.db", capacity=1)
+    previous = configure_store(store)
+    original = current_bank()
+    try:
+        test_service = AdaptiveTestService()
+        first, second = (
+            UUID(test_service.start_test({"start_level": "easy", "first_name": "S", "last_name": str(n)})["test_id"])
+            for n in range(2)
+        )
+        assert store.blocks(first) and not store.blocks(second)
+        register_item_bank(ITEMS[:-1])
+        assert get_session(first).bank is original
+
+        store.evict(first)
+        stale = SqliteSessionStore(tmp_path / "sessions.db")
+        assert stale.get(second).bank is original
+        blob = load_session_blob(str(first), store.path)
+        save_session_blob(str(first), bytes(8) + blob[8:], False, store.path)  # a bank nobody has loaded
+        with pytest.raises(SessionBankUnavailable):
+            stale.get(first)
+        assert [session.id for session in stale.sessions()] == [str(second)]
+    finally:
+        register_item_bank(ITEMS)
+        configure_store(previous)
+
+def test_timer_wheel_fires_due_timers_across_revolutions() -> None:
+    now = [1000.0]
+    wheel = TimerWheel(tick=1.0, slots=8, clock=lambda: now[0])
+    wheel.schedule("a", "idle", 1003.5)
+    wheel.schedule("b", "idle", 1020.0)  # more than one revolution away
+    wheel.schedule("c", "idle", 1002.0)
+    wheel.cancel("c", "idle")
+    wheel.schedule_in("d", "idle", 2.0)
+    wheel.schedule("d", "idle", 1005.0)  # rescheduling replaces the earlier timer
+
+    assert wheel.advance(1003.0) == []
+    assert wheel.advance(1004.0) == [("a", "idle")]
+    assert wheel.advance(1012.0) == [("d", "idle")]
+    assert ("b", "idle") in wheel
+    assert wheel.advance(1019.9) == []
+    assert wheel.advance(1500.0) == [("b", "idle")]
+    assert len(wheel) == 0
+
+
+def test_session_reaper_finishes_at_time_limit_and_evicts() -> None:
+    reset_store()
+    reset_db()
+    now = [0.0]
+    test_service = AdaptiveTestService()
+    reaper = SessionReaper(on_timeout=test_service.expire_session, clock=lambda: now[0])
+    previous = configure_reaper(reaper)
+    try:
+        timed = UUID(test_service.start_test({"start_level": "easy", "first_name": "T", "last_name": "O"})["test_id"])
+        idle = UUID(test_service.start_test({"start_level": "easy", "first_name": "I", "last_name": "D"})["test_id"])
+        assert len(reaper) == 4
+
+        now[0] = SESSION_TIME_LIMIT / 2
+        test_service.resume_section(timed)
+        now[0] = SESSION_TIME_LIMIT + 1
+        timed_out, evicted = reaper.run_pending()
+        assert sorted(timed_out) == sorted([timed, idle])
+        assert evicted == []
+        assert get_session(timed).finished
+        assert test_service.finish_test(idle)["completed"] is True
+        with sqlite3.connect(DB_PATH) as connection:
+            row = connection.execute("SELECT finished_at, paused FROM tests WHERE id = ?", (str(timed),)).fetchone()
+        assert row[0] is not None and row[1] == 0
+
+        now[0] += FINISHED_SESSION_TTL / 2
+        test_service.get_report(idle)
+        now[0] += FINISHED_SESSION_TTL / 2 + 1
+        assert reaper.run_pending() == ([], [timed])
+        try:
+            test_service.get_report(timed)
+            raise AssertionError("Expected the finished session to be evicted")
+        except ValueError:
+            pass
+        now[0] += FINISHED_SESSION_TTL
+        assert reaper.run_pending() == ([], [idle])
+        assert len(reaper) == 0
+    finally:
+        configure_reaper(previous)
+
+
+def test_stateless_tokens_carry_the_session() -> None:
+    reset_store()
+    reset_db()
+    codec = SessionTokenCodec(b"k" * 32)
+    test_service = AdaptiveTestService(tokens=codec)
+    start = test_service.start_test({"start_level": "middle", "first_name": "Ada", "last_name": "Lovelace"})
+    test_id = UUID(start["test_id"])
+    token = start["session_token"]
+    assert all(stored.id != str(test_id) for stored in all_sessions())
+
+    played = False
+    answered = 0
+    while answered < 12:
+        item = test_service.get_next_item(test_id, token=token)
+        token = item["session_token"]
+        if item.get("pause"):
+            token = test_service.resume_section(test_id, token=token)["session_token"]
+            continue
+        if item["domain"] == "listening" and not played:
+            token = test_service.record_play(test_id, {"item_id": item["item_id"]}, token=token)["session_token"]
+            played = True
+        payload = {"item_id": item["item_id"], "response": {"answer": get_correct_answer(item["item_id"])}}
+        answer = test_service.submit_answer(test_id, payload, token=token)
+        if answered == 0:
+            # The token from before the answer cannot be used to answer again,
+            # not even on a process that never issued a newer one.
+            with pytest.raises(ValueError, match="superseded"):
+                test_service.submit_answer(test_id, payload, token=token)
+            other_process = AdaptiveTestService(tokens=codec, ledger=TokenLedger(ttl=60.0))
+            with pytest.raises(InvalidToken, match="superseded"):
+                other_process.submit_answer(test_id, payload, token=token)
+        token = answer["session_token"]
+        answered += 1
+    item = test_service.get_next_item(test_id, token=token)
+    token = item["session_token"]
+
+    session = codec.decode(token)
+    again = codec.decode(codec.encode(session))
+    assert _session_state(again)[:13] == _session_state(session)[:13]
+    assert sorted(again.seen_items) == sorted(session.seen_items)
+    assert [r.item_id for r in again.responses] == [r.item_id for r in session.responses]
+    assert len(session.responses) == 12
+    assert session.pending_item_id == item["item_id"]
+    assert all(stored.id != str(test_id) for stored in all_sessions())
+
+    tampered = token[:-2] + ("A" if token[-2] != "A" else "B") + token[-1]
+    for bad in (tampered, "not-a-token", ""):
+        try:
+            test_service.get_next_item(test_id, token=bad)
+            raise AssertionError("Expected the token to be rejected")
+        except ValueError:
+            pass
+    try:
+        test_service.get_next_item(UUID(int=1), token=token)
+        raise AssertionError("Expected a token for another test to be rejected")
+    except ValueError:
+        pass
+    try:
+        SessionTokenCodec(b"x" * 32).decode(token)
+        raise AssertionError("Expected a token signed with another secret to be rejected")
+    except InvalidToken:
+        pass
+
+    # Positions outside the bank are refused rather than wrapped around.
+    played_item = session.bank.items[0]
+    session.plays = {played_item.id: 7}
+    data = zlib.decompress(base64.urlsafe_b64decode(codec.encode(session) + "==")[:-16])
+    position = session.bank.catalog.position(played_item.id)
+    data = data.replace(struct.pack("<iB", position, 7), struct.pack("<iB", -1, 7), 1)
+    payload = zlib.compress(data)
+    forged = base64.urlsafe_b64encode(payload + hmac.new(b"k" * 32, payload, hashlib.sha256).digest()[:16])
+    with pytest.raises(InvalidToken, match="outside its bank"):
+        codec.decode(forged.decode("ascii"))
+
+    finish = test_service.finish_test(test_id, token=token)
+    assert finish["completed"] is True
+    assert "cefr" in test_service.get_report(test_id, token=finish["session_token"])
+    with pytest.raises(ValueError, match="superseded"):
+        test_service.get_report(test_id, token=token)
+
+
+def test_concurrent_requests_for_one_session_are_serialized() -> None:
+    reset_store()
+    reset_db()
+    test_service = AdaptiveTestService(locks=StripedLocks())
+    test_id = UUID(test_service.start_test({"start_level": "middle", "first_name": "C", "last_name": "C"})["test_id"])
+    accepted = []
+    errors = []
+
+    def hammer() -> None:
+        for _ in range(15):
+            try:
+                item = test_service.get_next_item(test_id)
+                if item.get("pause"):
+                    test_service.resume_section(test_id)
+                    continue
+                payload = {"item_id": item["item_id"], "response": {"answer": get_correct_answer(item["item_id"])}}
+                accepted.append(test_service.submit_answer(test_id, payload)["theta"])
+            except ValueError:
+                pass  # finished, or paused by another thread in between
+            except Exception as exc:  # pragma: no cover - reported below
+                errors.append(exc)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    try:
+        threads = [threading.Thread(target=hammer) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert errors == []
+    session = get_session(test_id)
+    responses = list(session.responses)
+    assert len(responses) == len(accepted) > 0
+    assert sum(session.part_counts.values()) == len(responses)
+    # Every update started from the theta the previous one produced.
+    for previous, current in zip(responses, responses[1:]):
+        assert current.theta_before == previous.theta_after
+    assert session.theta == responses[-1].theta_after
+    stats = test_service.lock_stats()
+    assert stats.acquisitions >= len(accepted)
+    assert stats.max_wait_seconds >= 0.0
+
+
+def test_striped_locks_only_serialize_the_same_stripe() -> None:
+    locks = StripedLocks(4)
+    first, other = 0, next(key for key in range(1, 16) if locks.stripe(key) != locks.stripe(0))
+    entered = threading.Event()
+
+    def take_other() -> None:
+        with locks.hold(other):
+            entered.set()
+
+    with locks.hold(first):
+        thread = threading.Thread(target=take_other)
+        thread.start()
+        assert entered.wait(5)
+        thread.join()
+    assert locks.stats().contended == 0
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
-from uuid import uuid4
+from uuid import UUID, uuid4
 
+import math
 import pathlib
 import sys
 
@@ -10,14 +11,34 @@ for candidate in pathlib.Path(__file__).resolve().parents:
         sys.path.insert(0, str(candidate))
         break
 
+import pytest
+
 from app.cat_engine import (
+    SELECTION_ENV,
     Item,
+    ItemBank,
     Response,
     Session,
+    fisher_information,
+    gpcm_probabilities,
+    log_likelihood_derivatives,
+    logistic_3pl,
     register_item_bank,
+    select_next_item,
+    selection_from_env,
     update_theta_map,
 )
+from app.estimators import EapEstimator, EapGrid, MapEstimator
 from app.item_bank import ITEMS
+from app.item_matrix import InformationTable, ItemMatrix, PeakIndex
+from app.session_state import (
+    ItemCatalog,
+    ItemHistory,
+    ResponseLog,
+    SeenItems,
+    decode_raw_response,
+    encode_raw_response,
+)
 
 
 def test_update_theta_map_improves_theta_for_correct_answer():
@@ -105,3 +126,193 @@ def test_update_theta_map_uses_session_history_when_bank_changes():
 
     assert theta is not None
     assert se != float("inf")
+
+
+def test_item_matrix_information_matches_scalar_formula():
+    matrix = ItemMatrix(ITEMS)
+    for theta in (-2.5, -0.3, 0.0, 1.7):
+        batched = matrix.information(theta)
+        for item, value in zip(matrix.items, batched):
+            assert abs(value - fisher_information(item, theta)) < 1e-9
+
+
+def test_select_next_item_skips_seen_items():
+    session = Session(
+        id=str(uuid4()),
+        start_level="middle",
+        theta=0.0,
+        prior_mu=0.0,
+        prior_sigma=1.0,
+        se=float("inf"),
+    )
+    first = select_next_item(session, ITEMS)
+    assert first is not None and first.domain == "grammar"
+    session.pending_item_id = None
+    second = select_next_item(session, ITEMS)
+    assert second is not None and second.id != first.id
+    assert session.seen_items == {first.id, second.id}
+
+
+def test_map_estimator_matches_full_history_derivatives():
+    estimator = MapEstimator(prior_mu=0.0, prior_sigma=1.0)
+    answered = []
+    for index, item in enumerate(ITEMS[::37]):
+        score = float(len(item.correct_response())) if index % 2 else 0.0
+        estimator.add(item, score)
+        answered.append((item, score))
+    for theta in (-1.5, 0.0, 0.8):
+        expected = log_likelihood_derivatives(theta, answered)
+        actual = estimator.log_likelihood_derivatives(theta)
+        assert abs(actual[0] - expected[0]) < 1e-9
+        assert abs(actual[1] - expected[1]) < 1e-9
+        information = sum(fisher_information(item, theta) for item, _ in answered)
+        assert abs(estimator.information(theta) - information) < 1e-9
+
+
+def test_map_estimator_bisection_fallback_finds_stationary_point():
+    estimator = MapEstimator(prior_mu=0.0, prior_sigma=1.0)
+    for item in ITEMS[:5]:
+        estimator.add(item, 1.0)
+    newton_theta, _ = estimator.estimate(0.0)
+    bisected = estimator._bisect(3.0, 1e-6)
+    assert abs(newton_theta - bisected) < 1e-3
+    theta, se = estimator.estimate(0.0, max_iter=0)
+    assert abs(theta - newton_theta) < 1e-3
+    assert se != float("inf")
+
+
+def test_eap_columns_are_built_once_by_the_first_eap_session():
+    bank = ItemBank(ITEMS[:40])
+    assert not bank.eap_grid._columns
+    MapEstimator(0.0, 1.0)
+    assert not bank.eap_grid._columns
+    EapEstimator(bank.eap_grid, prior_mu=0.0, prior_sigma=1.0)
+    assert set(bank.eap_grid._columns) == {item.id for item in bank.items}
+    columns = bank.eap_grid.columns(bank.items[0])
+    EapEstimator(bank.eap_grid, prior_mu=0.5, prior_sigma=1.0)
+    assert bank.eap_grid.columns(bank.items[0]) is columns
+
+
+def test_eap_estimator_matches_direct_posterior():
+    grid = EapGrid(points=81)
+    estimator = EapEstimator(grid, prior_mu=0.0, prior_sigma=1.0)
+    answered = [(item, 1.0 if index % 3 else 0.0) for index, item in enumerate(ITEMS[::53])]
+    for item, score in answered:
+        estimator.add(item, score)
+    theta, se = estimator.estimate()
+
+    weights = []
+    for point in grid.points:
+        density = math.exp(-0.5 * point * point)
+        for item, score in answered:
+            if item.model.lower() == "gpcm":
+                density *= gpcm_probabilities(item, point)[int(score)]
+            else:
+                p = logistic_3pl(point, item.irt_a, item.irt_b, item.irt_c)
+                density *= p if score else 1.0 - p
+        weights.append(density)
+    total = sum(weights)
+    mean = sum(w * x for w, x in zip(weights, grid.points)) / total
+    variance = sum(w * (x - mean) ** 2 for w, x in zip(weights, grid.points)) / total
+    assert abs(theta - mean) < 1e-6
+    assert abs(se - math.sqrt(variance)) < 1e-6
+
+
+def test_service_runs_with_eap_estimation():
+    from app.service import AdaptiveTestService
+
+    service = AdaptiveTestService(estimation="eap")
+    test_id = UUID(
+        service.start_test({"start_level": "hard", "first_name": "Eap", "last_name": "User"})["test_id"]
+    )
+    service.resume_section(test_id)
+    item = service.get_next_item(test_id)
+    result = service.submit_answer(test_id, {"item_id": item["item_id"], "response": {"answer": 0}})
+    assert math.isfinite(result["se"])
+
+
+def test_information_table_walk_matches_interpolated_argmax():
+    matrix = ItemMatrix(item for item in ITEMS if item.domain == "listening")
+    table = InformationTable(matrix)
+    seen = bytearray(len(matrix))
+    for index in range(0, len(matrix), 3):
+        seen[index] = 1
+    for theta in (-3.99, -1.234, 0.0, 0.517, 2.025, 4.0):
+        expected = max(
+            (index for index in range(len(matrix)) if not seen[index]),
+            key=lambda index: table.information(theta, index),
+        )
+        assert table.best_index(theta, seen) == expected
+        exact = matrix.information(theta)
+        chosen = table.best_index(theta, seen)
+        assert exact[chosen] >= exact[matrix.best_index(theta, seen)] - 1e-3
+
+
+def test_exact_scan_is_the_default_and_other_candidates_are_scored_directly():
+    assert ItemBank(ITEMS[:5]).selection == "scan"
+    assert selection_from_env({}) == "scan"
+    assert selection_from_env({SELECTION_ENV: "table"}) == "table"
+    with pytest.raises(ValueError):
+        selection_from_env({SELECTION_ENV: "fastest"})
+
+    subset = [item for item in ITEMS if item.domain == "grammar"][::2]
+    matrix = ItemMatrix(subset)
+    for theta in (-1.3, 0.0, 0.7, 2.4):
+        session = Session(
+            id=str(uuid4()), start_level="middle", theta=theta, prior_mu=0.0, prior_sigma=1.0, se=float("inf")
+        )
+        session.seen_items.add(subset[0].id)
+        expected = matrix.items[matrix.best_index(theta, matrix.seen_mask(session.seen_items))]
+        assert select_next_item(session, subset) is expected
+
+
+def test_peak_index_matches_full_scan_with_bounded_window():
+    for domain in ("grammar", "listening", "english_in_use"):
+        matrix = ItemMatrix(item for item in ITEMS if item.domain == domain)
+        index = PeakIndex(matrix)
+        seen = bytearray(len(matrix))
+        for position in range(1, len(matrix), 4):
+            seen[position] = 1
+        for theta in (-3.2, -0.75, 0.0, 1.1, 3.6):
+            info = matrix.information(theta)
+            chosen, scored = index.search(theta, seen)
+            assert chosen == index.best_index(theta, seen) and not seen[chosen]
+            assert abs(info[chosen] - info[matrix.best_index(theta, seen)]) < 1e-12
+            if domain == "grammar":
+                assert scored < len(matrix) // 2
+
+
+def test_compact_session_state_round_trips_records():
+    catalog = ItemCatalog(ITEMS[:10])
+    outsider = Item(
+        id="outside-bank",
+        domain="grammar",
+        stem="?",
+        options=["a", "b"],
+        correct_key=0,
+        model="2PL",
+        irt_a=1.0,
+        irt_b=0.0,
+    )
+    seen = SeenItems(catalog, [ITEMS[3].id, outsider.id])
+    assert ITEMS[3].id in seen and outsider.id in seen and ITEMS[4].id not in seen
+    assert set(seen) == {ITEMS[3].id, outsider.id}
+
+    history = ItemHistory(catalog)
+    history[ITEMS[2].id] = ITEMS[2]
+    history[outsider.id] = outsider
+    assert history.get(ITEMS[2].id) is ITEMS[2]
+    assert history.get(outsider.id) is outsider
+    assert history.get(ITEMS[5].id) is None
+
+    log = ResponseLog(catalog)
+    payloads = [{"answer": 2}, {"answer": [0, 3]}, {"answer": "free text", "extra": True}, None]
+    for index, payload in enumerate(payloads):
+        item_id = outsider.id if index == 1 else ITEMS[index].id
+        log.append(Response(item_id, float(index), 0.1 * index, 0.2 * index, 0.5, payload))
+    assert len(log) == 4
+    assert [record.raw_response for record in log] == payloads
+    assert log[1].item_id == outsider.id
+    assert [record.item_id for record in log[2:]] == [ITEMS[2].id, ITEMS[3].id]
+    for payload in payloads:
+        assert decode_raw_response(encode_raw_response(payload)) == payload
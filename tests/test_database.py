@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import gc
+import pathlib
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+
+import pytest
+
+# Ensure the repository root (which contains the ``app`` package) is on sys.path
+for candidate in pathlib.Path(__file__).resolve().parents:
+    if (candidate / "app").exists():
+        sys.path.insert(0, str(candidate))
+        break
+
+from app import database
+from app.write_behind import WriteBehindQueue
+
+
+def test_connections_are_pooled_per_thread_in_wal_mode(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "pool.db"
+    database.init_db(path)
+    try:
+        writer = database._connect(path)
+        assert database._connect(path) is writer
+        assert writer.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+        other: list[sqlite3.Connection] = []
+        thread = threading.Thread(target=lambda: other.append(database._connect(path)))
+        thread.start()
+        thread.join()
+        assert other[0] is not writer
+
+        reader = database._read(path)
+        assert reader is not writer
+        with pytest.raises(sqlite3.OperationalError):
+            reader.execute("DELETE FROM tests")
+
+        with database._connect(path) as connection:
+            connection.execute(
+                "INSERT INTO tests (id, first_name, last_name, start_level, started_at) VALUES (?, ?, ?, ?, ?)",
+                ("t1", "Ada", "Lovelace", "easy", datetime.utcnow().isoformat()),
+            )
+        assert reader.execute("SELECT COUNT(*) FROM tests").fetchone()[0] == 1
+    finally:
+        database.close_connections(path)
+    with pytest.raises(sqlite3.ProgrammingError):
+        writer.execute("SELECT 1")
+
+
+def test_connections_are_closed_when_their_thread_ends(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "threads.db"
+    database.init_db(path)
+    opened: list[sqlite3.Connection] = []
+
+    def request() -> None:
+        opened.append(database._connect(path))
+        opened.append(database._read(path))
+
+    try:
+        for _ in range(20):
+            thread = threading.Thread(target=request)
+            thread.start()
+            thread.join()
+        gc.collect()
+        # Only the writer this thread opened in init_db is left.
+        assert database._pool(path).open_connections() == 1
+        for connection in opened:
+            with pytest.raises(sqlite3.ProgrammingError):
+                connection.execute("SELECT 1")
+    finally:
+        database.close_connections(path)
+
+
+def _count(path: pathlib.Path, table: str) -> int:
+    with sqlite3.connect(path) as connection:
+        return connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_write_behind_queue_group_commits_and_flushes_on_close(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "queue.db"
+    database.init_db(path)
+    writer = WriteBehindQueue(path, capacity=8, max_batch=64, max_delay=0.01)
+    now = datetime.utcnow()
+    try:
+        writer.record_test_start("t1", "Ada", "Lovelace", "easy", now, "grammar")
+        for index in range(200):
+            writer.record_response("t1", f"item-{index}", "grammar", 1.0, now)
+        assert writer.flush(timeout=10)
+        assert _count(path, "responses") == 200
+        stats = writer.stats()
+        assert stats.written == 201
+        assert stats.batches < 201
+        assert stats.backpressure_waits > 0
+        assert stats.max_queue_depth <= 8
+
+        writer.update_test_state("t1", "vocabulary", True)
+        writer.record_test_finish("t1", now)
+        writer.close()
+        with sqlite3.connect(path) as connection:
+            row = connection.execute("SELECT paused, finished_at FROM tests WHERE id = 't1'").fetchone()
+        assert row == (0, now.isoformat())
+    finally:
+        writer.close()
+        database.close_connections(path)
+
+
+def test_write_behind_group_mode_waits_for_commit(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "group.db"
+    database.init_db(path)
+    writer = WriteBehindQueue(path, durability="group")
+    try:
+        writer.record_response("t1", "item", "grammar", 0.5, datetime.utcnow())
+        assert _count(path, "responses") == 1
+    finally:
+        writer.close()
+        database.close_connections(path)
+    with pytest.raises(ValueError):
+        WriteBehindQueue(path, durability="eventually")
+
+
+def test_write_behind_keeps_the_rest_of_a_failing_batch(tmp_path: pathlib.Path, monkeypatch) -> None:
+    path = tmp_path / "failing.db"
+    database.init_db(path)
+    writer = WriteBehindQueue(path, max_delay=0.5, retry_delay=0.001)
+    now = datetime.utcnow()
+    locked = []
+
+    def flaky_batch(statements, batch_path=None):
+        if len(locked) < 2:
+            locked.append(True)
+            raise sqlite3.OperationalError("database is locked")
+        return database.execute_batch(statements, batch_path)
+
+    try:
+        monkeypatch.setattr("app.write_behind.execute_batch", flaky_batch)
+        writer.record_response("t1", "item-0", "grammar", 1.0, now)
+        writer.submit("INSERT INTO missing_table VALUES (?)", (1,))
+        writer.record_response("t1", "item-1", "grammar", 1.0, now)
+        with pytest.raises(sqlite3.OperationalError):
+            writer.flush(timeout=10)
+        assert _count(path, "responses") == 2
+        stats = writer.stats()
+        assert (stats.retries, stats.failed_batches, stats.lost_statements, stats.written) == (2, 1, 1, 2)
+
+        with pytest.raises(sqlite3.OperationalError, match="missing_table"):
+            writer.submit("INSERT INTO missing_table VALUES (?)", (2,), wait=True)
+        assert writer.stats().lost_statements == 2
+    finally:
+        writer.close()
+        database.close_connections(path)
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import pathlib
+import sqlite3
+import sys
+from dataclasses import replace
+
+import pytest
+
+for candidate in pathlib.Path(__file__).resolve().parents:
+    if (candidate / "app").exists():
+        sys.path.insert(0, str(candidate))
+        break
+
+from app.bank_snapshot import BankSnapshot, SnapshotError, load_item_bank, write_snapshot
+from app.item_bank import ITEMS
+from app.item_store import ItemBankRepository
+from app.shared_bank import SharedBank, attached_bank_from_env
+
+ITEM_FIELDS = (
+    "id",
+    "domain",
+    "stem",
+    "options",
+    "model",
+    "irt_a",
+    "irt_b",
+    "irt_c",
+    "max_plays",
+    "metadata",
+    "step_difficulties",
+)
+
+
+def assert_same_items(loaded, expected) -> None:
+    assert len(loaded) == len(expected)
+    for actual, original in zip(loaded, expected):
+        for name in ITEM_FIELDS:
+            assert getattr(actual, name) == getattr(original, name), name
+        assert actual.correct_response() == original.correct_response()
+
+
+def test_snapshot_round_trip(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "bank.bin"
+    version = write_snapshot(ITEMS, path)
+    snapshot = BankSnapshot.open(path)
+    assert snapshot.version == version
+    assert_same_items(snapshot.items, ITEMS)
+    assert_same_items(load_item_bank(path), ITEMS)
+
+
+def test_snapshot_rejects_foreign_files(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "bank.bin"
+    path.write_bytes(b"not a snapshot at all" * 8)
+    with pytest.raises(SnapshotError):
+        BankSnapshot.open(path)
+    assert load_item_bank(tmp_path / "missing.bin") is ITEMS
+    assert load_item_bank(path) is ITEMS
+
+
+def _attached_item_ids(name: str, queue) -> None:
+    from app.shared_bank import attach_bank
+
+    snapshot = attach_bank(name)
+    queue.put((snapshot.version, [item.id for item in snapshot.items], snapshot.items[-1].stem))
+
+
+def test_shared_bank_is_attachable_from_worker_processes() -> None:
+    import multiprocessing
+
+    with SharedBank(ITEMS) as published:
+        environ = {}
+        published.export(environ)
+        attached = attached_bank_from_env(environ)
+        assert attached is not None and attached.version == published.version
+        assert_same_items(attached.items, ITEMS)
+
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        worker = context.Process(target=_attached_item_ids, args=(published.name, queue))
+        worker.start()
+        version, ids, stem = queue.get(timeout=30)
+        worker.join(timeout=30)
+        assert worker.exitcode == 0
+        assert version == published.version
+        assert ids == [item.id for item in ITEMS]
+        assert stem == ITEMS[-1].stem
+
+
+def test_item_store_round_trip_and_incremental_reload(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "bank.db"
+    repository = ItemBankRepository(path)
+    first_version = repository.save(ITEMS)
+    assert repository.reload() == len(ITEMS)
+    assert_same_items(repository.items(), ITEMS)
+    assert repository.version == first_version
+
+    grammar = repository.load_domain("grammar")
+    assert [item.irt_b for item in grammar] == sorted(item.irt_b for item in grammar)
+    assert {item.domain for item in grammar} == {"grammar"}
+
+    assert repository.save(ITEMS) > first_version
+    assert repository.reload() == 0
+
+    recalibrated = replace(ITEMS[0], irt_b=ITEMS[0].irt_b + 0.5)
+    repository.save([recalibrated])
+    repository.retire([ITEMS[1].id])
+    assert repository.reload() == 2
+    current = {item.id: item for item in repository.items()}
+    assert current[ITEMS[0].id].irt_b == recalibrated.irt_b
+    assert ITEMS[1].id not in current
+    assert len(repository) == len(ITEMS) - 1
+    assert_same_items(load_item_bank(tmp_path / "missing.bin", store_path=path), repository.items())
+
+    with sqlite3.connect(path) as connection:
+        plan = " ".join(
+            str(row[-1])
+            for row in connection.execute(
+                "EXPLAIN QUERY PLAN SELECT * FROM items WHERE domain = ? ORDER BY irt_b", ("grammar",)
+            )
+        )
+    assert "idx_items_domain_b" in plan
+
+
+def test_bank_hot_swap_pins_sessions_and_releases_old_versions() -> None:
+    import gc
+    import threading
+    from uuid import uuid4
+
+    from app.cat_engine import Session, current_bank, live_bank_versions, register_item_bank, select_next_item
+
+    def new_session() -> Session:
+        session = Session(
+            id=str(uuid4()),
+            start_level="middle",
+            theta=0.0,
+            prior_mu=0.0,
+            prior_sigma=1.0,
+            se=float("inf"),
+        )
+        session.resume_current_part()
+        return session
+
+    original = register_item_bank(ITEMS)
+    pinned = new_session()
+    first = select_next_item(pinned)
+
+    shifted = [replace(item, irt_b=item.irt_b + 1.0) for item in ITEMS]
+    errors = []
+
+    def hammer() -> None:
+        try:
+            for _ in range(50):
+                session = new_session()
+                assert select_next_item(session) is not None
+        except Exception as exc:  # pragma: no cover - reported below
+            errors.append(exc)
+
+    worker = threading.Thread(target=hammer)
+    worker.start()
+    swapped = register_item_bank(shifted)
+    worker.join()
+    assert not errors
+
+    assert current_bank() is swapped and swapped.version > original.version
+    assert pinned.bank is original
+    assert pinned.lookup_item(first.id) is first
+    assert new_session().bank is swapped
+
+    original_version = original.version
+    del original, pinned, first
+    register_item_bank(ITEMS)
+    gc.collect()
+    assert original_version not in live_bank_versions()
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import gc
+import json
+import pathlib
+import sys
+import threading
+from uuid import UUID
+
+# Ensure the repository root (which contains the ``app`` package) is on sys.path
+for candidate in pathlib.Path(__file__).resolve().parents:
+    if (candidate / "app").exists():
+        sys.path.insert(0, str(candidate))
+        break
+
+from app import schemas
+from app.cat_engine import ItemBank, current_bank
+from app.database import reset_db
+from app.item_payloads import ItemPayloadCache
+from app.service import AdaptiveTestService
+from app.session_store import reset_store
+from app.session_token import SessionTokenCodec
+
+
+def _expected(item, **extra) -> bytes:
+    payload = schemas.ItemResponse(
+        item_id=item.id,
+        stem=item.stem,
+        options=item.options,
+        domain=item.domain,
+        model=item.model,
+        metadata=item.metadata,
+        max_plays=item.max_plays,
+    ).to_dict()
+    if "audio_url" in extra:
+        payload["metadata"] = {**payload["metadata"], "audio_url": extra.pop("audio_url")}
+    payload.update(extra)
+    return json.dumps(payload).encode("utf-8")
+
+
+def test_rendered_items_match_json_dumps_and_are_cached_per_bank() -> None:
+    cache = ItemPayloadCache()
+    bank = current_bank()
+    for item in bank.items:
+        assert cache.render(bank, item) == _expected(item)
+        assert cache.render(bank, item, session_token="tök") == _expected(item, session_token="tök")
+        if item.metadata and "audio_url" in item.metadata:
+            link = '/api/test/x/audio/"y"/0.1.z'
+            assert cache.render(bank, item, audio_url=link) == _expected(item, audio_url=link)
+    assert cache.versions() == {bank.version: len(bank)}
+    assert cache.misses == len(bank)
+
+    other = ItemBank(bank.items[:3])
+    cache.render(other, bank.items[0])
+    assert cache.versions()[other.version] == 1
+    del other
+    gc.collect()
+    assert list(cache.versions()) == [bank.version]
+
+
+def test_next_item_json_matches_the_dict_response() -> None:
+    reset_store()
+    reset_db()
+    for service in (AdaptiveTestService(), AdaptiveTestService(tokens=SessionTokenCodec(b"k" * 32))):
+        data = service.start_test({"start_level": "easy", "first_name": "A", "last_name": "B"})
+        test_id = UUID(data["test_id"])
+        token = data.get("session_token")
+        for _ in range(3):
+            encoded = service.get_next_item_json(test_id, token=token)
+            item = service.get_next_item(test_id, token=token)
+            assert encoded == json.dumps(item).encode("utf-8")
+            if item.get("pause"):
+                token = service.resume_section(test_id, token=token).get("session_token", token)
+                continue
+            answer = service.submit_answer(test_id, {"item_id": item["item_id"], "response": {"answer": 0}}, token=token)
+            token = answer.get("session_token", token)
+
+
+def test_hit_and_miss_counters_are_exact_under_concurrency() -> None:
+    cache = ItemPayloadCache()
+    bank = current_bank()
+    items = bank.items[:50]
+
+    def render_all() -> None:
+        for _ in range(20):
+            for item in items:
+                cache.render(bank, item)
+
+    threads = [threading.Thread(target=render_all) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.hits + cache.misses == 8 * 20 * len(items)
+    assert cache.versions()[bank.version] == len(items)
@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import asyncio
+import http.client
+import pathlib
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+from uuid import UUID
+
+# Ensure the repository root (which contains the ``app`` package) is on sys.path
+for candidate in pathlib.Path(__file__).resolve().parents:
+    if (candidate / "app").exists():
+        sys.path.insert(0, str(candidate))
+        break
+
+import pytest
+
+from app import server as server_module
+from app.cat_engine import current_bank, register_item_bank
+from app.database import reset_db
+from app.item_bank import ITEMS
+from app.media import (
+    AUDIO_DIR_ENV,
+    MEDIA_SECRET_ENV,
+    PREVIEW_BYTES,
+    AudioLibrary,
+    FileRegion,
+    MediaAccessDenied,
+    MediaSigner,
+    file_response,
+    media_from_env,
+)
+from app.server import AdaptiveHTTPRequestHandler, AsyncHTTPServer
+from app.service import AdaptiveTestService
+from app.session_store import SESSION_SHARD_ENV, reset_store
+from app.session_token import TOKEN_SECRET_ENV, SessionTokenCodec, TokenLedger
+
+AUDIO = bytes(range(256)) * 1024  # 256 KiB
+
+
+def _answer(item_id: str) -> dict:
+    item = next(item for item in ITEMS if item.id == item_id)
+    correct = list(item.correct_response()) if item.model.lower() == "gpcm" else item.correct_response()[0]
+    return {"item_id": item_id, "response": {"answer": correct}}
+
+
+def _listening_item(service: AdaptiveTestService, test_id: UUID) -> dict:
+    while True:
+        item = service.get_next_item(test_id)
+        if item.get("pause"):
+            service.resume_section(test_id)
+        elif item["domain"] == "listening":
+            return item
+        else:
+            service.submit_answer(test_id, _answer(item["item_id"]))
+
+
+def _link(url: str) -> tuple[str, str]:
+    parts = urlsplit(url).path.split("/")
+    return unquote(parts[5]), parts[6]
+
+
+def test_audio_links_are_signed_and_follow_the_play_counter(tmp_path: pathlib.Path) -> None:
+    reset_store()
+    reset_db()
+    for item in ITEMS:
+        if item.domain == "listening":
+            (tmp_path / pathlib.PurePosixPath(urlsplit(item.metadata["audio_url"]).path).name).write_bytes(AUDIO)
+    clock = [1_000_000.0]
+    library = AudioLibrary(tmp_path, MediaSigner(b"m" * 32, ttl=60, clock=lambda: clock[0]))
+    service = AdaptiveTestService(media=library)
+    test_id = UUID(service.start_test({"start_level": "middle", "first_name": "A", "last_name": "B"})["test_id"])
+
+    item = _listening_item(service, test_id)
+    item_id, preview = _link(item["metadata"]["audio_url"])
+    assert item_id == item["item_id"]
+    assert next(i for i in ITEMS if i.id == item_id).metadata["audio_url"].startswith("http")
+
+    # The preview link only covers the first bytes, enough to read the duration.
+    path, limit = service.audio_file(test_id, item_id, preview)
+    assert limit == PREVIEW_BYTES
+    status, headers, region = file_response(path, {}, limit)
+    assert status == 206 and headers["Content-Range"] == f"bytes 0-{PREVIEW_BYTES - 1}/{len(AUDIO)}"
+    with pytest.raises(MediaAccessDenied):
+        file_response(path, {"Range": f"bytes={PREVIEW_BYTES}-"}, limit)
+
+    first = service.record_play(test_id, {"item_id": item_id})["audio_url"]
+    path, limit = service.audio_file(test_id, item_id, _link(first)[1])
+    assert limit is None
+    status, headers, region = file_response(path, {"Range": "bytes=100-199"})
+    assert (status, headers["Content-Length"], region.offset, len(region)) == (206, "100", 100, 100)
+    assert b"".join(region.chunks()) == AUDIO[100:200]
+
+    second = service.record_play(test_id, {"item_id": item_id})["audio_url"]
+    with pytest.raises(MediaAccessDenied, match="play is over"):
+        service.audio_file(test_id, item_id, _link(first)[1])
+    service.audio_file(test_id, item_id, _link(second)[1])
+
+    forged = _link(second)[1].replace("2.", "3.", 1)
+    with pytest.raises(MediaAccessDenied, match="Invalid"):
+        service.audio_file(test_id, item_id, forged)
+    clock[0] += 61
+    with pytest.raises(MediaAccessDenied, match="expired"):
+        service.audio_file(test_id, item_id, _link(second)[1])
+
+    clock[0] -= 61
+    service.submit_answer(test_id, _answer(item_id))
+    with pytest.raises(MediaAccessDenied, match="current item"):
+        service.audio_file(test_id, item_id, _link(second)[1])
+
+
+def test_byte_ranges(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "clip.mp3"
+    path.write_bytes(AUDIO)
+    size = len(AUDIO)
+
+    status, headers, region = file_response(path, {})
+    assert (status, region.offset, len(region)) == (200, 0, size)
+    assert headers["Accept-Ranges"] == "bytes" and "Content-Range" not in headers
+    assert headers["Content-Type"] == "audio/mpeg"
+
+    status, headers, region = file_response(path, {"range": "bytes=-10"})
+    assert (status, region.offset, len(region)) == (206, size - 10, 10)
+    status, headers, region = file_response(path, {"Range": f"bytes={size - 5}-{size + 100}"})
+    assert headers["Content-Range"] == f"bytes {size - 5}-{size - 1}/{size}"
+
+    status, headers, region = file_response(path, {"Range": f"bytes={size}-"})
+    assert (status, headers["Content-Range"], len(region)) == (416, f"bytes */{size}", 0)
+    # Several ranges, other units and stale If-Range all get the whole file.
+    for extra in ({"Range": "bytes=0-1,5-6"}, {"Range": "items=0-1"}, {"Range": "bytes=0-1", "If-Range": '"old"'}):
+        assert file_response(path, extra)[0] == 200
+
+
+def _dispatch_region(path: pathlib.Path):
+    def dispatch(method, raw_path, body, headers=None):
+        return file_response(path, headers)
+
+    return dispatch
+
+
+def test_servers_send_file_regions(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    path = tmp_path / "clip.mp3"
+    path.write_bytes(AUDIO)
+    monkeypatch.setattr(server_module, "dispatch", _dispatch_region(path))
+    monkeypatch.setattr(server_module, "blocking", lambda method, raw_path: True)
+
+    def fetch(port: int) -> list[tuple[int, bytes]]:
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        replies = []
+        for headers in ({"Range": "bytes=1000-2999"}, {}):
+            connection.request("GET", "/audio", headers=headers)
+            response = connection.getresponse()
+            replies.append((response.status, response.read()))
+        connection.close()
+        return replies
+
+    expected = [(206, AUDIO[1000:3000]), (200, AUDIO)]
+
+    threaded = ThreadingHTTPServer(("127.0.0.1", 0), AdaptiveHTTPRequestHandler)
+    thread = threading.Thread(target=threaded.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert fetch(threaded.server_address[1]) == expected
+    finally:
+        threaded.shutdown()
+        threaded.server_close()
+
+    async def run_async() -> list[tuple[int, bytes]]:
+        server = AsyncHTTPServer()
+        _, port = await server.start()
+        try:
+            return await asyncio.to_thread(fetch, port)
+        finally:
+            await server.close()
+
+    assert asyncio.run(run_async()) == expected
+    assert isinstance(file_response(path)[2], FileRegion)
+
+
+def test_media_secret_is_shared_by_processes_that_share_the_token_secret(tmp_path: pathlib.Path) -> None:
+    base = {AUDIO_DIR_ENV: str(tmp_path)}
+    tokens = {**base, TOKEN_SECRET_ENV: "t" * 32}
+    signed = media_from_env(tokens).signer.sign("test", "item", 1, bytes(8))
+    assert media_from_env(tokens).signer.verify("test", "item", signed) == (1, bytes(8))
+    with pytest.raises(MediaAccessDenied):
+        media_from_env(base).signer.verify("test", "item", signed)
+    with pytest.raises(ValueError, match=MEDIA_SECRET_ENV):
+        media_from_env({**base, SESSION_SHARD_ENV: "0/2"})
+    sharded = {**base, SESSION_SHARD_ENV: "0/2", MEDIA_SECRET_ENV: "m" * 32}
+    signed = media_from_env(sharded).signer.sign("test", "item", 0, bytes(8))
+    assert media_from_env(sharded).signer.verify("test", "item", signed) == (0, bytes(8))
+
+
+def test_stateless_audio_links_follow_the_recorded_plays_and_the_pinned_bank(tmp_path: pathlib.Path) -> None:
+    reset_db()
+    for item in ITEMS:
+        if item.domain == "listening":
+            (tmp_path / pathlib.PurePosixPath(urlsplit(item.metadata["audio_url"]).path).name).write_bytes(AUDIO)
+    library = AudioLibrary(tmp_path, MediaSigner(b"m" * 32))
+    codec = SessionTokenCodec(b"k" * 32)
+    service = AdaptiveTestService(media=library, tokens=codec)
+    start = service.start_test({"start_level": "middle", "first_name": "A", "last_name": "B"})
+    test_id, token = UUID(start["test_id"]), start["session_token"]
+    while True:
+        item = service.get_next_item(test_id, token=token)
+        token = item["session_token"]
+        if item.get("pause"):
+            token = service.resume_section(test_id, token=token)["session_token"]
+        elif item["domain"] == "listening":
+            break
+        else:
+            token = service.submit_answer(test_id, _answer(item["item_id"]), token=token)["session_token"]
+    item_id = item["item_id"]
+
+    before_play = token
+    first = service.record_play(test_id, {"item_id": item_id}, token=token)
+    second = service.record_play(test_id, {"item_id": item_id}, token=first["session_token"])
+    with pytest.raises(MediaAccessDenied, match="play is over"):
+        service.audio_file(test_id, item_id, _link(first["audio_url"])[1])
+    # Another process cannot register the first play again from the older token.
+    other_process = AdaptiveTestService(media=library, tokens=codec, ledger=TokenLedger(ttl=60.0))
+    with pytest.raises(ValueError, match="superseded"):
+        other_process.record_play(test_id, {"item_id": item_id}, token=before_play)
+
+    # The link keeps resolving against the session's bank after a swap.
+    original = current_bank()
+    register_item_bank([item for item in ITEMS if item.id != item_id])
+    try:
+        path, limit = service.audio_file(test_id, item_id, _link(second["audio_url"])[1])
+        assert path.read_bytes() == AUDIO and limit is None
+    finally:
+        register_item_bank(original.items, selection=original.selection)
+
+    service.submit_answer(test_id, _answer(item_id), token=second["session_token"])
+    with pytest.raises(MediaAccessDenied, match="current item"):
+        service.audio_file(test_id, item_id, _link(second["audio_url"])[1])
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import json
+import pathlib
+import sys
+from dataclasses import asdict
+from uuid import uuid4
+
+# Ensure the repository root (which contains the ``app`` package) is on sys.path
+for candidate in pathlib.Path(__file__).resolve().parents:
+    if (candidate / "app").exists():
+        sys.path.insert(0, str(candidate))
+        break
+
+import pytest
+
+from app import schemas
+from app.http_router import dispatch
+
+
+def test_generated_to_dict_matches_asdict() -> None:
+    test_id = uuid4()
+    responses = [
+        schemas.ItemResponse("i1", "stem", ["a", "b"], "listening", "2pl", {"audio_url": "/a.mp3"}, 2),
+        schemas.ItemResponse("i2", "stem", ["a"], "grammar", "2pl"),
+        schemas.AnswerResponse(0.1, 0.9, True, 1.0, None),
+        schemas.PlayResponse(1, 2),
+        schemas.FinishResponse(0.1, 0.9, 51.0, "B1", True),
+        schemas.ResumeResponse("reading"),
+    ]
+    for response in responses:
+        assert response.to_dict() == asdict(response)
+    item = responses[0]
+    item.to_dict()["options"].append("c")
+    item.to_dict()["metadata"]["audio_url"] = "elsewhere"
+    assert item.options == ["a", "b"] and item.metadata == {"audio_url": "/a.mp3"}
+
+    started = schemas.StartTestResponse(test_id, 0.0, 1.0, "grammar", True, "grammar")
+    assert started.to_dict() == {**asdict(started), "test_id": str(test_id)}
+    assert schemas.PauseResponse(domain="reading").to_dict() == {
+        "pause": True,
+        "domain": "reading",
+        "message": "",
+        "questions": 0,
+    }
+    report = schemas.ReportResponse(
+        test_id,
+        0.1,
+        0.9,
+        51.0,
+        "B1",
+        [schemas.DomainBreakdown("listening", 0.5, "B1"), schemas.DomainBreakdown("grammar", 0.7, "B2")],
+    )
+    assert [domain["domain"] for domain in report.to_dict()["domains"]] == ["grammar", "listening"]
+    assert "sort_index" not in report.to_dict()["domains"][0]
+
+
+@pytest.mark.parametrize(
+    ("payload", "message"),
+    [
+        ([], "Expected a JSON object"),
+        ({"first_name": "A", "last_name": "B"}, "start_level is required"),
+        ({"start_level": 1, "first_name": "A", "last_name": "B"}, "start_level must be a string"),
+        ({"start_level": "easy", "first_name": "A", "last_name": None}, "last_name must be a string"),
+        ({"start_level": "expert", "first_name": "A", "last_name": "B"}, "start_level must be one of"),
+    ],
+)
+def test_generated_from_dict_validates(payload: object, message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        schemas.StartTestRequest.from_dict(payload)  # type: ignore[arg-type]
+
+
+def test_generated_from_dict_ignores_unknown_keys_and_normalizes() -> None:
+    request = schemas.StartTestRequest.from_dict(
+        {"start_level": "HARD", "first_name": " Ada ", "last_name": "Lovelace", "extra": True}
+    )
+    assert (request.start_level, request.first_name, request.last_name) == ("hard", "Ada", "Lovelace")
+    with pytest.raises(ValueError, match="response must be an object"):
+        schemas.AnswerRequest.from_dict({"item_id": "x", "response": [1]})
+
+    status, _, body = dispatch("POST", "/api/test/start", b'{"start_level": "easy"}')
+    assert status == 400 and json.loads(body) == {"detail": "first_name is required"}
@@ -0,0 +1,350 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import pathlib
+import socket
+import sys
+import threading
+import time
+from uuid import UUID
+
+# Ensure the repository root (which contains the ``app`` package) is on sys.path
+for candidate in pathlib.Path(__file__).resolve().parents:
+    if (candidate / "app").exists():
+        sys.path.insert(0, str(candidate))
+        break
+
+from app.server import (
+    PRIORITIES,
+    STATS_PATH,
+    AsyncHTTPServer,
+    PooledHTTPRequestHandler,
+    PooledHTTPServer,
+    classify,
+)
+
+
+def test_requests_are_classified_by_priority() -> None:
+    test_path = "/api/test/5f0c7a52-5f43-4d3b-9c55-1f6f0a3e8b1d"
+    assert PRIORITIES[classify("POST", f"{test_path}/answer")] == "answer"
+    assert PRIORITIES[classify("GET", f"{test_path}/next")] == "session"
+    assert PRIORITIES[classify("POST", "/api/test/start")] == "start"
+    assert PRIORITIES[classify("GET", "/static/app.js")] == "background"
+    assert PRIORITIES[classify("GET", "/api/report/abc")] == "background"
+
+
+def _send(port: int, request: bytes) -> socket.socket:
+    client = socket.create_connection(("127.0.0.1", port), timeout=10)
+    client.sendall(request)
+    return client
+
+
+def _read_status(client: socket.socket) -> int:
+    """Status of the next response, consuming all of it so the connection can be reused."""
+
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = client.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    head, _, body = data.partition(b"\r\n\r\n")
+    length = next(
+        (int(line.split(b":", 1)[1]) for line in head.split(b"\r\n") if line.lower().startswith(b"content-length:")),
+        0,
+    )
+    while len(body) < length:
+        chunk = client.recv(4096)
+        if not chunk:
+            break
+        body += chunk
+    return int(head.split(b" ", 2)[1])
+
+
+def _wait_for(condition, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def _start_pool(**options) -> tuple[PooledHTTPServer, int]:
+    server = PooledHTTPServer(("127.0.0.1", 0), PooledHTTPRequestHandler, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def _occupy_worker(server: PooledHTTPServer, port: int) -> socket.socket:
+    """A connection whose request line has arrived but whose headers have not."""
+
+    accepted = server.stats().accepted
+    blocker = _send(port, f"GET {STATS_PATH} HTTP/1.1\r\n".encode("ascii"))
+    _wait_for(lambda: server.stats().accepted > accepted and server.stats().busy_workers == 1)
+    return blocker
+
+
+STATIC = b"GET /static/app.js HTTP/1.1\r\nHost: x\r\n\r\n"
+ANSWER = b"POST /api/test/00000000-0000-0000-0000-000000000000/answer HTTP/1.1\r\nHost: x\r\nContent-Length: 2\r\n\r\n{}"
+
+
+def test_pooled_server_sheds_low_priority_load_with_503() -> None:
+    server, port = _start_pool(workers=1, queue_size=4)
+    clients = []
+    try:
+        blocker = _occupy_worker(server, port)
+        clients.append(blocker)
+
+        # Background requests may only take a quarter of the queue.
+        queued_static = _send(port, STATIC)
+        clients.append(queued_static)
+        _wait_for(lambda: server.stats().queue_depth == 1)
+        rejected = _send(port, STATIC)
+        clients.append(rejected)
+        assert _read_status(rejected) == 503
+        queued = [_send(port, ANSWER) for _ in range(3)]
+        clients.extend(queued)
+        _wait_for(lambda: server.stats().queue_depth == 4)
+        stats = server.stats()
+        assert stats.rejected == {"answer": 0, "session": 0, "start": 0, "background": 1}
+
+        blocker.sendall(b"Host: x\r\n\r\n")
+        assert _read_status(blocker) == 200
+        for client in queued:
+            assert _read_status(client) == 400  # unknown test id, but served first
+        assert _read_status(queued_static) == 200
+        stats = server.stats()
+        assert stats.max_queue_depth == 4
+        assert stats.accepted == 5
+        # Kept-alive connections wait in the reader stage, not on a worker.
+        _wait_for(lambda: server.stats().idle_connections == 5)
+        assert server.stats().busy_workers == 0
+    finally:
+        for client in clients:
+            client.close()
+        server.shutdown()
+        server.server_close()
+    assert json.loads(json.dumps(stats.to_dict()))["rejected"]["background"] == 1
+
+
+def test_pooled_server_classifies_each_request_when_its_line_arrives() -> None:
+    server, port = _start_pool(workers=1, queue_size=4)
+    clients = []
+    try:
+        # A keep-alive connection whose first request was an answer.
+        kept = _send(port, ANSWER)
+        clients.append(kept)
+        assert _read_status(kept) == 400
+        _wait_for(lambda: server.stats().idle_connections == 1)
+
+        blocker = _occupy_worker(server, port)
+        queued_static = _send(port, STATIC)
+        clients.extend([blocker, queued_static])
+        _wait_for(lambda: server.stats().queue_depth == 1)
+
+        # The request line arrives well after the connection was accepted,
+        # and must still be classified as background and shed.
+        late = socket.create_connection(("127.0.0.1", port), timeout=10)
+        clients.append(late)
+        time.sleep(0.3)
+        late.sendall(STATIC)
+        assert _read_status(late) == 503
+
+        # The second request on the kept connection is classified on its own.
+        kept.sendall(STATIC)
+        assert _read_status(kept) == 503
+        assert server.stats().rejected["background"] == 2
+
+        late_answer = socket.create_connection(("127.0.0.1", port), timeout=10)
+        clients.append(late_answer)
+        time.sleep(0.3)
+        late_answer.sendall(ANSWER)
+        _wait_for(lambda: server.stats().queue_depth == 2)
+        blocker.sendall(b"Host: x\r\n\r\n")
+        assert _read_status(blocker) == 200
+        assert _read_status(late_answer) == 400
+        assert _read_status(queued_static) == 200
+    finally:
+        for client in clients:
+            client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def _serve_async(server: AsyncHTTPServer) -> tuple[asyncio.AbstractEventLoop, int]:
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    address: list[int] = []
+
+    def run() -> None:
+        asyncio.set_event_loop(loop)
+        address.append(loop.run_until_complete(server.start())[1])
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    assert ready.wait(10)
+    return loop, address[0]
+
+
+def _read_response(stream) -> tuple[int, dict[str, str], bytes]:
+    status = int(stream.readline().split(b" ", 2)[1])
+    headers = {}
+    while True:
+        line = stream.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.lower()] = value.strip()
+    return status, headers, stream.read(int(headers.get("content-length", "0")))
+
+
+def test_async_server_keeps_alive_pipelines_and_enforces_limits() -> None:
+    server = AsyncHTTPServer(max_header_bytes=1024, max_body_bytes=256, keep_alive_timeout=0.5)
+    loop, port = _serve_async(server)
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=10) as client:
+            stream = client.makefile("rb")
+            start = json.dumps({"start_level": "easy", "first_name": "A", "last_name": "S"}).encode()
+            # Three pipelined requests in one write, the last with a chunked body.
+            client.sendall(
+                b"GET /api/health HTTP/1.1\r\nHost: x\r\n\r\n"
+                + b"POST /api/test/start HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n\r\n%s" % (len(start), start)
+                + b"POST /api/test/start HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n"
+                + b"%x\r\n%s\r\n0\r\n\r\n" % (len(start), start)
+            )
+            assert _read_response(stream)[0] == 200
+            status, headers, body = _read_response(stream)
+            assert status == 200 and headers["connection"] == "keep-alive"
+            test_id = json.loads(body)["test_id"]
+            assert _read_response(stream)[0] == 200
+            # The same connection stays usable; the template is read on the thread pool.
+            client.sendall(f"GET /api/test/{test_id}/next HTTP/1.1\r\nHost: x\r\n\r\nGET / HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+            assert _read_response(stream)[0] == 200
+            assert _read_response(stream)[0] == 200
+            # Idle keep-alive connections are closed after the timeout.
+            assert stream.read(1) == b""
+
+        with socket.create_connection(("127.0.0.1", port), timeout=10) as client:
+            client.sendall(b"GET / HTTP/1.1\r\nX-Big: " + b"x" * 2048 + b"\r\n\r\n")
+            assert _read_response(client.makefile("rb"))[0] == 431
+        with socket.create_connection(("127.0.0.1", port), timeout=10) as client:
+            client.sendall(b"POST /api/test/start HTTP/1.1\r\nContent-Length: 1000\r\n\r\n")
+            status, headers, _ = _read_response(client.makefile("rb"))
+            assert status == 413 and headers["connection"] == "close"
+    finally:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+
+
+
+def test_inline_dispatch_does_not_wait_for_a_session_lock() -> None:
+    from app.http_router import blocking, dispatch, dispatch_inline
+    from app.service import SESSION_LOCKS
+
+    start = json.dumps({"start_level": "easy", "first_name": "A", "last_name": "S"}).encode()
+    assert blocking("POST", "/api/test/start")
+    test_id = json.loads(dispatch("POST", "/api/test/start", start)[2])["test_id"]
+    assert blocking("POST", f"/api/test/{test_id}/answer")
+    assert not blocking("GET", f"/api/test/{test_id}/next")
+
+    # Another thread takes the session after ``blocking`` said it was free.
+    taken, release = threading.Event(), threading.Event()
+
+    def hold() -> None:
+        with SESSION_LOCKS.hold(UUID(test_id)):
+            taken.set()
+            release.wait(10)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    try:
+        assert taken.wait(10)
+        assert dispatch_inline("GET", f"/api/test/{test_id}/next", b"") is None
+        assert dispatch_inline("GET", "/api/health", b"")[0] == 200
+    finally:
+        release.set()
+        holder.join()
+    assert dispatch_inline("GET", f"/api/test/{test_id}/next", b"")[0] == 200
+
+async def _asgi_request(app, method: str, path: str, chunks: tuple[bytes, ...] = (), headers: tuple = ()) -> tuple[int, bytes]:
+    messages = [{"type": "http.request", "body": chunk, "more_body": index < len(chunks) - 1} for index, chunk in enumerate(chunks)]
+    messages = messages or [{"type": "http.request", "body": b"", "more_body": False}]
+    sent: list[dict] = []
+
+    async def receive() -> dict:
+        return messages.pop(0)
+
+    async def send(message: dict) -> None:
+        sent.append(message)
+
+    await app({"type": "http", "method": method, "path": path, "headers": list(headers)}, receive, send)
+    return sent[0]["status"], sent[1]["body"]
+
+
+def test_asgi_app_streams_bodies_offloads_blocking_routes_and_times_them() -> None:
+    from app.api import AdaptiveASGIApp
+    from app.service import REAPER, SESSION_LOCKS
+
+    app = AdaptiveASGIApp(workers=2, max_body_bytes=512)
+
+    async def scenario() -> None:
+        lifespan = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        replies: list[dict] = []
+
+        async def send(message: dict) -> None:
+            replies.append(message)
+
+        start = json.dumps({"start_level": "easy", "first_name": "A", "last_name": "S"}).encode()
+        status, body = await _asgi_request(app, "POST", "/api/test/start", (start[:10], start[10:30], start[30:]))
+        assert status == 200
+        test_id = json.loads(body)["test_id"]
+        length = (b"content-length", str(len(start)).encode())
+        assert (await _asgi_request(app, "POST", "/api/test/start", (start,), (length,)))[0] == 200
+        assert (await _asgi_request(app, "GET", f"/api/test/{test_id}/next"))[0] == 200
+        assert (await _asgi_request(app, "POST", f"/api/test/{test_id}/finish", (b"{}",)))[0] == 200
+        assert (await _asgi_request(app, "POST", "/api/test/start", (b"x" * 600,)))[0] == 413
+
+        status, body = await _asgi_request(app, "GET", STATS_PATH)
+        routes = json.loads(body)["routes"]
+        assert routes["POST /api/test/start"]["count"] == 3
+        assert routes["GET /api/test/{id}/next"]["offloaded"] == 0
+        assert routes["POST /api/test/{id}/finish"]["offloaded"] == 1
+        assert routes["POST /api/test/{id}/finish"]["max_seconds"] > 0
+
+        # A session locked by another thread is served from the pool; the loop keeps running.
+        taken, release = threading.Event(), threading.Event()
+
+        def hold() -> None:
+            with SESSION_LOCKS.hold(UUID(test_id)):
+                taken.set()
+                release.wait(10)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        assert taken.wait(10)
+        report = asyncio.ensure_future(_asgi_request(app, "GET", f"/api/report/{test_id}"))
+        await asyncio.sleep(0.05)
+        assert (await _asgi_request(app, "GET", "/api/health"))[0] == 200
+        assert not report.done()
+        release.set()
+        assert (await report)[0] == 200
+        holder.join()
+        status, body = await _asgi_request(app, "GET", STATS_PATH)
+        assert json.loads(body)["routes"]["GET /api/report/{id}"]["offloaded"] == 1
+
+        reaper_running = []
+
+        async def receive() -> dict:
+            reaper_running.append(REAPER.running)
+            return await _pop(lifespan)
+
+        await app({"type": "lifespan"}, receive, send)
+        assert [reply["type"] for reply in replies] == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+        assert reaper_running == [False, True] and not REAPER.running
+
+    asyncio.run(scenario())
+
+
+async def _pop(messages: list) -> dict:
+    return messages.pop(0)
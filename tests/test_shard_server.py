@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import http.client
+import json
+import pathlib
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+from uuid import UUID
+
+# Ensure the repository root (which contains the ``app`` package) is on sys.path
+for candidate in pathlib.Path(__file__).resolve().parents:
+    if (candidate / "app").exists():
+        sys.path.insert(0, str(candidate))
+        break
+
+import pytest
+
+from app.item_bank import ITEMS
+from app.session_store import build_session, configure_shard, shard_of
+from app.shard_server import ShardSupervisor, create_front
+from app.shared_bank import SHARED_BANK_ENV, attach_bank
+
+
+def test_sessions_are_minted_for_the_configured_shard() -> None:
+    previous = configure_shard(2, 3)
+    try:
+        ids = [build_session("easy", "A", "B").id for _ in range(20)]
+    finally:
+        configure_shard(*previous)
+    assert all(shard_of(test_id, 3) == 2 for test_id in ids)
+    assert shard_of(UUID(ids[0]), 3) == 2
+
+
+def _request(port: int, method: str, path: str, payload: dict | None = None) -> tuple[int, dict]:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b"{}")
+    finally:
+        connection.close()
+
+
+def test_front_routes_by_test_id_and_restarts_crashed_workers() -> None:
+    supervisor = ShardSupervisor(2, probe_interval=0.1, probe_timeout=1.0)
+    supervisor.start()
+    front = create_front("127.0.0.1", 0, supervisor)
+    thread = threading.Thread(target=front.serve_forever, daemon=True)
+    thread.start()
+    port = front.server_address[1]
+    try:
+        shards = set()
+        for _ in range(4):
+            status, started = _request(port, "POST", "/api/test/start", {"start_level": "easy", "first_name": "S", "last_name": "H"})
+            assert status == 200
+            test_id = started["test_id"]
+            shards.add(shard_of(test_id, 2))
+            # Any other worker would answer 404 for a session it does not hold.
+            assert _request(port, "GET", f"/api/test/{test_id}/next")[0] == 200
+            assert _request(port, "POST", f"/api/test/{test_id}/resume")[0] == 200
+        assert shards == {0, 1}
+
+        pid = supervisor.pid(0)
+        supervisor._workers[0].process.kill()  # simulate a crash
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and not (supervisor.restarts()[0] == 1 and supervisor.address(0)):
+            time.sleep(0.05)
+        assert supervisor.restarts() == [1, 0]
+        assert supervisor.pid(0) != pid
+        assert _request(port, "GET", "/api/health")[0] == 200
+        assert _request(port, "GET", "/api/test/not-a-uuid/next")[0] == 400
+        shared = supervisor._environ[SHARED_BANK_ENV]
+        assert len(attach_bank(shared).items) == len(ITEMS)
+    finally:
+        front.shutdown()
+        front.server_close()
+        supervisor.stop()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=shared)
+
+
+class _HangingRestartSupervisor(ShardSupervisor):
+    """Worker 0 never reports ready once it has been restarted."""
+
+    def _command(self, worker):
+        if worker.index == 0 and worker.restarts > 0:
+            return [sys.executable, "-c", "import time; time.sleep(60)"]
+        return super()._command(worker)
+
+
+def test_a_hanging_start_does_not_hold_up_other_workers() -> None:
+    supervisor = _HangingRestartSupervisor(2, probe_interval=0.1, probe_timeout=1.0, start_timeout=20.0)
+    supervisor.start()
+    try:
+        supervisor._workers[0].process.kill()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and supervisor.restarts()[0] == 0:
+            time.sleep(0.05)
+        supervisor._workers[1].process.kill()
+        while time.monotonic() < deadline and not (supervisor.restarts()[1] == 1 and supervisor.address(1)):
+            time.sleep(0.05)
+        assert supervisor.restarts() == [1, 1]
+        assert supervisor.address(1) and not supervisor.address(0)
+    finally:
+        supervisor.stop(timeout=1.0)
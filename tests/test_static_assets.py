@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import gzip
+import os
+import pathlib
+import sys
+
+# Ensure the repository root (which contains the ``app`` package) is on sys.path
+for candidate in pathlib.Path(__file__).resolve().parents:
+    if (candidate / "app").exists():
+        sys.path.insert(0, str(candidate))
+        break
+
+from app.static_assets import IMMUTABLE, REVALIDATE, StaticAssets
+
+
+def _site(tmp_path: pathlib.Path) -> tuple[pathlib.Path, pathlib.Path]:
+    static, templates = tmp_path / "static", tmp_path / "templates"
+    static.mkdir()
+    templates.mkdir()
+    (static / "app.js").write_text("console.log('exam');\n" * 40)
+    (static / "logo.png").write_bytes(b"\x89PNG" + bytes(300))
+    (templates / "index.html").write_text('<link href="/static/app.js"><img src="/static/logo.png">')
+    return static, templates
+
+
+def test_assets_are_served_from_memory_with_validators(tmp_path: pathlib.Path) -> None:
+    static, templates = _site(tmp_path)
+    assets = StaticAssets(static, templates)
+    assert assets.preload() == 3
+
+    status, headers, page = assets.respond("/")
+    fingerprinted = assets.url_for("/static/app.js")
+    assert status == 200 and headers["Cache-Control"] == REVALIDATE
+    assert fingerprinted.encode() in page and b'"/static/app.js"' not in page
+
+    # Served from memory: removing the file does not matter without reload.
+    (static / "app.js").unlink()
+    assert assets.cached(fingerprinted)
+    status, headers, body = assets.respond(fingerprinted, {"Accept-Encoding": "br, gzip;q=0.8"})
+    assert status == 200 and headers["Cache-Control"] == IMMUTABLE
+    assert headers["Content-Encoding"] == "gzip" and headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(body) == b"console.log('exam');\n" * 40
+
+    plain = assets.respond("/static/app.js", {"Accept-Encoding": "gzip;q=0"})
+    assert plain is not None and "Content-Encoding" not in plain[1]
+    assert plain[1]["Cache-Control"] == REVALIDATE and plain[1]["ETag"] != headers["ETag"]
+
+    for conditional in ({"If-None-Match": headers["ETag"]}, {"If-None-Match": f'W/{plain[1]["ETag"]}, "x"'}):
+        status, not_modified, body = assets.respond("/static/app.js", conditional)
+        assert (status, body) == (304, b"")
+        assert "Content-Length" not in not_modified
+    assert assets.respond("/static/app.js", {"If-Modified-Since": plain[1]["Last-Modified"]})[0] == 304
+    assert assets.respond("/static/app.js", {"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"})[0] == 200
+
+    # Binary files are not compressed; stale fingerprints are not cached forever.
+    logo = assets.respond("/static/logo.png", {"Accept-Encoding": "gzip"})
+    assert logo is not None and "Content-Encoding" not in logo[1] and "Vary" not in logo[1]
+    assert assets.respond("/static/app.000000000000.js")[1]["Cache-Control"] == REVALIDATE
+    assert assets.respond("/static/../templates/index.html") is None
+    assert assets.respond("/static/missing.js") is None
+
+
+def test_reload_picks_up_changed_files(tmp_path: pathlib.Path) -> None:
+    static, templates = _site(tmp_path)
+    assets = StaticAssets(static, templates, reload=True)
+    before = assets.url_for("/static/app.js")
+    page_etag = assets.respond("/")[1]["ETag"]
+    assert not assets.cached(before)
+
+    script = static / "app.js"
+    script.write_text("console.log('changed');\n" * 40)
+    stat = script.stat()
+    os.utime(script, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    after = assets.url_for("/static/app.js")
+    assert after != before
+    status, headers, page = assets.respond("/")
+    assert headers["ETag"] != page_etag and after.encode() in page